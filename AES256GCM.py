@@ -1,6 +1,7 @@
 from Cryptodome.Cipher import AES
 from Cryptodome.Random import get_random_bytes
-from Cryptodome.Protocol.KDF import scrypt
+from Cryptodome.Protocol.KDF import scrypt, HKDF
+from Cryptodome.Hash import SHA256
 import os
 
 # 鍵導出のためのパラメータ (本番環境ではより大きなNを推奨)
@@ -8,20 +9,63 @@ SCRYPT_N = 2**17
 SCRYPT_R = 20
 SCRYPT_P = 3
 
+# マニフェストのレコードに記録する鍵導出方式 (無い場合は旧形式のファイル毎scrypt)
+KDF_HKDF = "hkdf-sha256"
+# 重複排除チャンク: チャンク鍵はマスター鍵とコンテンツIDから導出する
+KDF_CONTENT = "hkdf-sha256-content"
+
 def derive_key(password, salt):
     """パスワードとソルトから鍵を導出します。"""
     return scrypt(password.encode(), salt, 32, N=SCRYPT_N, r=SCRYPT_R, p=SCRYPT_P)
 
-def encrypt_chunk(chunk_data, base_key, chunk_index, original_filepath_hint=None):
+def derive_subkey(parent_key, salt, context):
     """
-    データチャンクをAES-256-GCMで暗号化します。
-    各チャンクは独立して暗号化され、固有のノンスとタグを持ちます。
+    親鍵からHKDF-SHA256でサブ鍵を導出します。
+    scryptと違いメモリも時間もほとんど使わないため、ファイル毎・チャンク毎に呼んでも問題ありません。
     """
-    # 各チャンクごとに新しいランダムなノンスを生成
-    nonce = get_random_bytes(AES.block_size) # AES.block_size (16バイト) はGCMのノンスサイズとして一般的
-    
-    cipher = AES.new(base_key, AES.MODE_GCM, nonce=nonce)
+    return HKDF(parent_key, 32, salt, SHA256, context=context)
+
+def derive_file_key(master_key, file_salt):
+    """マスター鍵とファイル固有ソルトからファイル鍵を導出します。"""
+    return derive_subkey(master_key, file_salt, b"pycryptodrive:file")
+
+def derive_chunk_key(file_key, chunk_index):
+    """ファイル鍵からチャンク毎のサブ鍵を導出します。"""
+    return derive_subkey(file_key, b"", b"pycryptodrive:chunk:" + str(chunk_index).encode())
+
+def derive_content_id_key(master_key):
+    """コンテンツID (平文の鍵付きハッシュ) 用の鍵を導出します。"""
+    return derive_subkey(master_key, b"", b"pycryptodrive:content-id")
+
+def derive_content_key(master_key, content_id_hex):
+    """重複排除チャンクの鍵をコンテンツIDから導出します。同じ内容なら同じ鍵になるので共有できます。"""
+    return derive_subkey(master_key, bytes.fromhex(content_id_hex), b"pycryptodrive:content-chunk")
+
+def derive_file_hash_key(master_key):
+    """差分バックアップでファイル内容を確認するための鍵付きハッシュ用の鍵を導出します。"""
+    return derive_subkey(master_key, b"", b"pycryptodrive:file-hash")
+
+def content_aad(content_id_hex, codec=None):
+    """重複排除チャンクのAAD。複数のファイルから参照されるのでチャンク番号やパスは含めない。"""
+    aad = b"content_id:" + content_id_hex.encode()
+    if codec:
+        aad += b";codec:" + codec.encode()
+    return aad
+
+def aad_field(associated_data, name):
+    """
+    AADから name の値を取り出します (無ければ None)。
+    original_filepath は任意の文字を含み得るので、それ以降は見ない。
+    """
+    for part in associated_data.split(b";"):
+        if part.startswith(b"original_filepath:"):
+            break
+        if part.startswith(name + b":"):
+            return part[len(name) + 1:].decode()
+    return None
 
+def chunk_aad(chunk_index, original_filepath_hint=None, codec=None):
+    """encrypt_chunk が付けるAAD (chunk_index:<番号>[;codec:<コーデック>][;original_filepath:<パス>])。"""
     # 関連データ (AAD) の構築
     # チャンクインデックスと元のファイルパスのヒントをAADに含めることで、
     # 復号時にチャンクが正しい順序で、正しいファイルの一部であることを検証する手助けになる。
@@ -29,13 +73,44 @@ def encrypt_chunk(chunk_data, base_key, chunk_index, original_filepath_hint=None
     aad_parts = [
         b"chunk_index:" + str(chunk_index).encode(),
     ]
+    if codec:
+        aad_parts.append(b"codec:" + codec.encode())
     if original_filepath_hint:
         aad_parts.append(b"original_filepath:" + original_filepath_hint.encode())
     
-    associated_data = b";".join(aad_parts) # AADはセミコロンで結合
+    return b";".join(aad_parts) # AADはセミコロンで結合
+
+def encrypt_chunk(chunk_data, base_key, chunk_index, original_filepath_hint=None, codec=None):
+    """
+    データチャンクをAES-256-GCMで暗号化します。
+    各チャンクは独立して暗号化され、固有のノンスとタグを持ちます。
+    chunk_data を圧縮してある場合は codec を渡すとAADに記録されます。
+    """
+    associated_data = chunk_aad(chunk_index, original_filepath_hint, codec)
+    return encrypt_chunk_with_aad(chunk_data, base_key, associated_data)
+
+def encrypt_chunk_with_aad(chunk_data, base_key, associated_data):
+    """任意のAADを付けてデータチャンクをAES-256-GCMで暗号化します (形式は encrypt_chunk と同じ)。"""
+    return b"".join(encrypt_chunk_parts(chunk_data, base_key, associated_data))
+
+def encrypt_chunk_parts(chunk_data, base_key, associated_data, output=None):
+    """
+    encrypt_chunk_with_aad と同じ形式のブロックを (ヘッダー, 暗号文, タグ) の3つに分けて返します。
+    output に chunk_data 以上の長さの書き込み可能なバッファを渡すと暗号文をそこへ書き込み、
+    その先頭部分の memoryview を返します。os.writev でそのまま書き出せば、ブロック全体を連結する
+    コピーも、チャンク毎の大きなメモリ確保も起きません。
+    """
+    # 各チャンクごとに新しいランダムなノンスを生成
+    nonce = get_random_bytes(AES.block_size) # AES.block_size (16バイト) はGCMのノンスサイズとして一般的
+    cipher = AES.new(base_key, AES.MODE_GCM, nonce=nonce)
     cipher.update(associated_data)
 
-    ciphertext, tag = cipher.encrypt_and_digest(chunk_data)
+    if output is None:
+        ciphertext = cipher.encrypt(chunk_data)
+    else:
+        ciphertext = memoryview(output)[:len(chunk_data)]
+        cipher.encrypt(chunk_data, output=ciphertext)
+    tag = cipher.digest()
 
     # チャンクごとに保存する情報: ノンス、関連データ、暗号文、タグ
     # 関連データの長さも一緒に保存すると、復号時に便利
@@ -45,11 +120,13 @@ def encrypt_chunk(chunk_data, base_key, chunk_index, original_filepath_hint=None
         associated_data
     )
     
-    return chunk_header + ciphertext + tag
+    return chunk_header, ciphertext, tag
 
-def decrypt_chunk(encrypted_chunk_data, base_key):
+def decrypt_chunk(encrypted_chunk_data, base_key, output=None):
     """
     暗号化されたデータチャンクをAES-256-GCMで復号します。
+    encrypted_chunk_data には bytes の他に memoryview も渡せます (スライスでコピーしない)。
+    output に書き込み可能なバッファを渡すと平文をそこへ復号し、その先頭部分の memoryview を返します。
     """
     # ヘッダーからノンス、関連データ長、関連データを読み込む
     nonce_size = AES.block_size # 16バイト
@@ -60,24 +137,28 @@ def decrypt_chunk(encrypted_chunk_data, base_key):
     if len(encrypted_chunk_data) < nonce_size + aad_len_size + tag_size:
         raise ValueError("暗号化されたチャンクデータが不正です (短すぎます)。")
 
-    nonce = encrypted_chunk_data[0:nonce_size]
+    nonce = bytes(encrypted_chunk_data[0:nonce_size])
     aad_len = int.from_bytes(encrypted_chunk_data[nonce_size : nonce_size + aad_len_size], 'big')
     
     # AADの長さがデータ範囲外の場合もエラー
     if len(encrypted_chunk_data) < nonce_size + aad_len_size + aad_len + tag_size:
         raise ValueError("暗号化されたチャンクデータが不正です (AAD長が不正)。")
 
-    associated_data = encrypted_chunk_data[nonce_size + aad_len_size : nonce_size + aad_len_size + aad_len]
+    associated_data = bytes(encrypted_chunk_data[nonce_size + aad_len_size : nonce_size + aad_len_size + aad_len])
     ciphertext_start_index = nonce_size + aad_len_size + aad_len
     
     ciphertext = encrypted_chunk_data[ciphertext_start_index : -tag_size]
-    tag = encrypted_chunk_data[-tag_size:]
+    tag = bytes(encrypted_chunk_data[-tag_size:])
 
     cipher = AES.new(base_key, AES.MODE_GCM, nonce=nonce)
     cipher.update(associated_data)
 
     try:
-        plaintext = cipher.decrypt_and_verify(ciphertext, tag)
+        if output is not None:
+            plaintext = memoryview(output)[:len(ciphertext)]
+            cipher.decrypt_and_verify(ciphertext, tag, output=plaintext)
+        else:
+            plaintext = cipher.decrypt_and_verify(ciphertext, tag)
         return plaintext, associated_data # 復号された平文とAADを返す
     except ValueError as e:
         raise ValueError(f"チャンクの認証に失敗しました。データが改ざんされた可能性があります: {e}")
@@ -0,0 +1,99 @@
+"""
+ディレクトリ走査のベンチマーク。
+
+合成したツリー (1ディレクトリあたり --per-dir 個の空ファイル) に対して、
+  before: traverse_iterative + os.path.isfile / abspath での絞り込み + 暗号化時の os.stat
+  after:  scanner.scan_tree (scandir の DirEntry を使い、stat はファイル毎に1回)
+の files/sec を比較する。after はスレッド数を変えて測る。
+
+    python benchmarks/bench_scan.py --files 1000000
+    python benchmarks/bench_scan.py --root /mnt/nfs/tree   # 既存のツリーを測る
+
+ページキャッシュの影響を受けるので、各方式を一度空回ししてから測る。
+"""
+import argparse
+import os
+import shutil
+import sys
+import tempfile
+import time
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), ".."))
+
+import scanner
+
+
+def traverse_iterative(start_paths):
+    """変更前の main.py の走査 (os.listdir でスタックに積み、isdir / exists を1パスずつ呼ぶ)。"""
+    stack = [os.path.abspath(p) for p in start_paths]
+    while stack:
+        current_path = stack.pop()
+        if not os.path.exists(current_path):
+            continue
+        if os.path.isdir(current_path):
+            yield current_path
+            try:
+                for entry_name in reversed(os.listdir(current_path)):
+                    stack.append(os.path.join(current_path, entry_name))
+            except OSError:
+                pass
+        else:
+            yield current_path
+
+
+def make_tree(root, files, per_dir):
+    for i in range(files):
+        directory = os.path.join(root, f"d{i // per_dir // 1000:03d}", f"d{i // per_dir:06d}")
+        if i % per_dir == 0:
+            os.makedirs(directory, exist_ok=True)
+        os.close(os.open(os.path.join(directory, f"f{i:08d}.dat"), os.O_WRONLY | os.O_CREAT, 0o600))
+
+
+def bench_before(root):
+    """変更前の __main__ と同じ絞り込みに、暗号化時の stat を加えたもの。"""
+    start = time.perf_counter()
+    excluded_paths = [os.path.abspath(os.path.join(root, "masterkey.enc"))]
+    paths = [p for p in traverse_iterative([root])
+             if os.path.isfile(p) and os.path.abspath(p) not in excluded_paths]
+    for path in paths:
+        os.stat(path)
+    return len(paths), time.perf_counter() - start
+
+
+def bench_after(root, jobs):
+    start = time.perf_counter()
+    records = list(scanner.scan_tree([root], jobs=jobs, skip_paths=[os.path.join(root, "masterkey.enc")]))
+    return len(records), time.perf_counter() - start
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--files", type=int, default=1000000, help="合成するファイル数")
+    parser.add_argument("--per-dir", type=int, default=1000, help="1ディレクトリあたりのファイル数")
+    parser.add_argument("--root", default=None, help="合成せずに既存のツリーを測る")
+    parser.add_argument("--jobs", type=int, nargs="+", default=[1, 4, 16], help="scan_tree のスレッド数")
+    args = parser.parse_args()
+
+    work = None
+    root = args.root
+    if root is None:
+        work = tempfile.mkdtemp()
+        root = os.path.join(work, "tree")
+        start = time.perf_counter()
+        make_tree(root, args.files, args.per_dir)
+        print(f"合成したツリー: {args.files} ファイル ({time.perf_counter() - start:.1f}s)")
+
+    try:
+        # 1回目はページキャッシュ (dentry/inode) を温めるために捨てる
+        bench_before(root)
+        count, seconds = bench_before(root)
+        print(f"before (traverse_iterative + isfile/abspath + stat): {count} files in {seconds:.2f}s "
+              f"-> {count / seconds:,.0f} files/sec")
+        baseline = count / seconds
+        for jobs in args.jobs:
+            count, seconds = bench_after(root, jobs)
+            print(f"after  (scan_tree, jobs={jobs}): {count} files in {seconds:.2f}s "
+                  f"-> {count / seconds:,.0f} files/sec ({count / seconds / baseline:.1f}x)")
+    finally:
+        if work is not None:
+            shutil.rmtree(work)
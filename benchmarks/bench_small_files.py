@@ -0,0 +1,100 @@
+"""
+小さなファイルが大量にあるツリーでの暗号化速度 (files/sec) を計測するベンチマーク。
+
+before: 旧方式 (ファイル毎にランダムパスワードを生成してscryptで鍵導出)
+after : 新方式 (マスター鍵のscryptは一度だけ、ファイル鍵・チャンク鍵はHKDF)。CLI と同じく、ツリーを
+        scanner.scan_tree で走査し、engine.encrypt_paths を1回だけ呼んでマニフェストまで書く
+
+使い方:
+    python benchmarks/bench_small_files.py --files 2000 --legacy-files 10
+"""
+import argparse
+import hashlib
+import os
+import sys
+import tempfile
+import time
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), ".."))
+
+import AES256GCM
+import gen_rndstring
+import scanner
+from engine import encrypt_paths
+from manifest import ManifestWriter, path_sort_key
+
+
+def make_tree(root, count, size):
+    paths = []
+    for i in range(count):
+        sub = os.path.join(root, f"d{i // 1000:04d}")
+        os.makedirs(sub, exist_ok=True)
+        path = os.path.join(sub, f"f{i:07d}.bin")
+        with open(path, "wb") as h:
+            h.write(os.urandom(size))
+        paths.append(path)
+    return paths
+
+
+def bench_legacy(paths, output_dir):
+    """旧方式: ファイル毎に scrypt を実行する。"""
+    start = time.perf_counter()
+    for path in paths:
+        password = gen_rndstring.generate_random_string(120)
+        base_salt = AES256GCM.get_random_bytes(AES256GCM.AES.block_size)
+        base_key = AES256GCM.derive_key(password, base_salt)
+        with open(path, "rb") as h:
+            block = AES256GCM.encrypt_chunk(h.read(), base_key, 0, path)
+        with open(os.path.join(output_dir, hashlib.sha256(os.urandom(16)).hexdigest() + ".enc"), "wb") as h:
+            h.write(block)
+    return time.perf_counter() - start
+
+
+def bench_hkdf(root, output_dir, master_password, jobs=1):
+    """
+    新方式: CLI の encrypt と同じ経路。マスター鍵を一度だけ導出し、root を走査して
+    全ファイルを1回の encrypt_paths で暗号化し、マニフェストを書く。暗号化したファイル数と秒数を返す。
+    """
+    start = time.perf_counter()
+    master_key = AES256GCM.derive_key(master_password, AES256GCM.get_random_bytes(16))
+    records = sorted(scanner.scan_tree([root], jobs=jobs), key=lambda record: path_sort_key(record.path))
+    with ManifestWriter(os.path.join(output_dir, "masterkey.enc"), master_key) as manifest_writer:
+        entries = encrypt_paths(records, output_dir, master_key, jobs=jobs)
+        for entry in entries:
+            manifest_writer.add(entry)
+    return len(records), time.perf_counter() - start
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--files", type=int, default=2000, help="新方式で暗号化するファイル数")
+    parser.add_argument("--legacy-files", type=int, default=10, help="旧方式で暗号化するファイル数 (1ファイル数秒かかる)")
+    parser.add_argument("--size", type=int, default=4096, help="1ファイルのバイト数")
+    parser.add_argument("--jobs", type=int, default=1, help="新方式のワーカー数 (CLI の --jobs)")
+    parser.add_argument("--scrypt-n", type=int, default=None, help="SCRYPT_N を上書きする (既定は AES256GCM.SCRYPT_N)")
+    args = parser.parse_args()
+
+    if args.scrypt_n:
+        AES256GCM.SCRYPT_N = args.scrypt_n
+
+    with tempfile.TemporaryDirectory() as work:
+        src = os.path.join(work, "src")
+        out_legacy = os.path.join(work, "out_legacy")
+        out_hkdf = os.path.join(work, "out_hkdf")
+        for d in (out_legacy, out_hkdf):
+            os.makedirs(d)
+        paths = make_tree(src, args.files, args.size)
+        legacy_src = os.path.join(work, "src_legacy")
+        legacy_paths = make_tree(legacy_src, args.legacy_files, args.size)
+
+        legacy = bench_legacy(legacy_paths, out_legacy)
+        hkdf_files, hkdf = bench_hkdf(src, out_hkdf, "benchmark-master-password", args.jobs)
+
+    legacy_rate = args.legacy_files / legacy if legacy else 0.0
+    hkdf_rate = hkdf_files / hkdf if hkdf else 0.0
+    print(f"scrypt N={AES256GCM.SCRYPT_N} r={AES256GCM.SCRYPT_R} p={AES256GCM.SCRYPT_P}, {args.size} bytes/file")
+    print(f"before (per-file scrypt): {args.legacy_files} files in {legacy:.2f}s -> {legacy_rate:.2f} files/sec")
+    print(f"after  (scrypt once + HKDF, encrypt_paths over the tree): {hkdf_files} files in {hkdf:.2f}s "
+          f"-> {hkdf_rate:.2f} files/sec")
+    if legacy_rate:
+        print(f"speedup: {hkdf_rate / legacy_rate:.1f}x")
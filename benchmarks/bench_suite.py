@@ -0,0 +1,472 @@
+"""
+段階別のベンチマークスイート。
+
+合成したツリー (大量の小さなファイル・少数の巨大なファイル・エントロピーの異なる中くらいのファイル) に対して、
+次の段階を別々に測り、MB/s・files/s と段階毎のピークRSSを表示して JSON に保存する。
+
+  traverse          scanner.scan_tree による走査 (files/s)
+  kdf[N,r,p]        derive_key (scrypt) 1回の秒数と作業領域。--scrypt で複数のパラメータを比べられる
+  cipher[SIZE]      encrypt_chunk / decrypt_chunk のチャンクサイズ毎のスループット (MB/s)
+  manifest          ManifestWriter での書き込みと open_manifest での読み込み (entries/s)
+  encrypt[SIZE]     走査・暗号化・マニフェストの書き込みまで (MB/s, files/s。鍵導出の時間は kdf_seconds に分けて記録)
+  restore[SIZE]     マニフェストからの復元 (MB/s, files/s)
+
+各段階は別のプロセスで実行するので、peak_rss_mb はその段階だけのピーク (インタプリタ本体を含む) になる。
+
+    python benchmarks/bench_suite.py --out results.json
+    python benchmarks/bench_suite.py --quick --out new.json --compare results.json --threshold 0.1
+    python benchmarks/bench_suite.py --scrypt 17,20,3 --scrypt 16,8,2 --chunk-sizes 1M,8M,50M --only kdf,cipher
+
+--compare を指定すると、前回の結果と共通の指標を比べて threshold (割合) を超えて悪化したものを表示し、
+1つでもあれば終了コード 1 で終わる (*_per_s は小さくなると、seconds と peak_rss_mb は大きくなると悪化)。
+外部のサービスや追加のパッケージは使わない。ページキャッシュに載った状態で測るので、ディスク自体の速度ではない。
+"""
+import argparse
+import datetime
+import json
+import os
+import platform
+import random
+import resource
+import shutil
+import subprocess
+import sys
+import tempfile
+import time
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), ".."))
+
+import AES256GCM
+from engine import CHUNK_SIZE
+from main import parse_size
+
+RESULTS_VERSION = 1
+STAGES = ("traverse", "kdf", "cipher", "manifest", "encrypt", "restore")
+PASSWORD = "benchmark-master-password"
+
+# 中くらいのファイルの中身の種類 (乱数・ゼロ・テキスト風) で、圧縮のしやすさが変わる
+_WORDS = b"the quick brown fox jumps over lazy dog archive chunk manifest backup restore key salt".split()
+
+
+def _random_text(rng, size):
+    words = []
+    length = 0
+    while length < size:
+        word = _WORDS[rng.randrange(len(_WORDS))]
+        words.append(word)
+        length += len(word) + 1
+    return b" ".join(words)[:size]
+
+
+def _write_file(path, size, kind, rng):
+    with open(path, "wb") as h:
+        remaining = size
+        while remaining:
+            n = min(remaining, 8 * 1024 * 1024)
+            if kind == "random":
+                h.write(os.urandom(n))
+            elif kind == "zero":
+                h.write(bytes(n))
+            else:
+                h.write(_random_text(rng, n))
+            remaining -= n
+
+
+def make_tree(root, tiny_files, tiny_max, huge_files, huge_size, mixed_files, mixed_size, seed=0):
+    """
+    合成したツリーを root に作り、(ファイル数, 合計バイト数) を返す。
+    tiny: 0〜tiny_max バイトの乱数のファイル (1000個ずつのディレクトリ)
+    huge: huge_size バイトの乱数のファイル
+    mixed: mixed_size バイトで、乱数・ゼロ・テキスト風を順に繰り返す
+    """
+    rng = random.Random(seed)
+    total = 0
+    for i in range(tiny_files):
+        directory = os.path.join(root, "tiny", f"d{i // 1000:04d}")
+        if i % 1000 == 0:
+            os.makedirs(directory, exist_ok=True)
+        size = rng.randrange(tiny_max + 1)
+        with open(os.path.join(directory, f"f{i:07d}.bin"), "wb") as h:
+            h.write(os.urandom(size))
+        total += size
+    os.makedirs(os.path.join(root, "huge"), exist_ok=True)
+    for i in range(huge_files):
+        _write_file(os.path.join(root, "huge", f"h{i:03d}.bin"), huge_size, "random", rng)
+        total += huge_size
+    os.makedirs(os.path.join(root, "mixed"), exist_ok=True)
+    kinds = ("random", "zero", "text")
+    for i in range(mixed_files):
+        kind = kinds[i % len(kinds)]
+        _write_file(os.path.join(root, "mixed", f"m{i:05d}.{kind}"), mixed_size, kind, rng)
+        total += mixed_size
+    return tiny_files + huge_files + mixed_files, total
+
+
+def _set_scrypt(params):
+    if params is not None:
+        AES256GCM.SCRYPT_N = 2 ** params[0]
+        AES256GCM.SCRYPT_R = params[1]
+        AES256GCM.SCRYPT_P = params[2]
+
+
+def _best(fn, repeat):
+    """fn を repeat 回実行し、最短の秒数を返す。"""
+    return min(_timed(fn) for _ in range(max(repeat, 1)))
+
+
+def _timed(fn):
+    start = time.perf_counter()
+    fn()
+    return time.perf_counter() - start
+
+
+# --- 各段階 (子プロセスで実行する) ---
+
+def stage_traverse(spec):
+    import scanner
+    count = []
+    seconds = _best(lambda: count.append(sum(1 for _ in scanner.scan_tree([spec["root"]], jobs=spec["jobs"]))),
+                    spec["repeat"])
+    return {"files": count[-1], "seconds": seconds, "files_per_s": count[-1] / seconds}
+
+
+def stage_kdf(spec):
+    _set_scrypt(spec["scrypt"])
+    salt = AES256GCM.get_random_bytes(16)
+    seconds = _best(lambda: AES256GCM.derive_key(PASSWORD, salt), spec["repeat"])
+    return {"seconds": seconds, "memory_mb": 128 * AES256GCM.SCRYPT_N * AES256GCM.SCRYPT_R / 2**20}
+
+
+def stage_cipher(spec):
+    size = spec["chunk_size"]
+    data = os.urandom(size)
+    key = AES256GCM.get_random_bytes(32)
+    # 小さなチャンクは1回では短すぎるので、合計が約 spec["bytes"] になるまで繰り返したものを1回として測る
+    rounds = max(1, spec["bytes"] // size)
+    block = AES256GCM.encrypt_chunk(data, key, 0)
+
+    def encrypt():
+        for i in range(rounds):
+            AES256GCM.encrypt_chunk(data, key, i)
+
+    def decrypt():
+        for _ in range(rounds):
+            AES256GCM.decrypt_chunk(block, key)
+
+    total = rounds * size
+    encrypt_seconds = _best(encrypt, spec["repeat"])
+    decrypt_seconds = _best(decrypt, spec["repeat"])
+    return {"encrypt_mb_per_s": total / encrypt_seconds / 2**20, "decrypt_mb_per_s": total / decrypt_seconds / 2**20}
+
+
+def _synthetic_entry(i):
+    return {
+        "name": f"f{i:07d}.bin", "path": ["", "data", f"d{i // 1000:04d}"], "chunkpath": "/archive",
+        "file_size": 4096, "mtime_ns": 1700000000000000000 + i, "inode": 1000 + i,
+        "kdf": AES256GCM.KDF_HKDF, "key_salt": os.urandom(16).hex(),
+        "chunks": [{"chunk_id": 0, "chunk_name": f"/archive/{os.urandom(32).hex()}.enc", "offset": 0, "size": 4096}],
+    }
+
+
+def stage_manifest(spec):
+    from manifest import ManifestWriter, open_manifest
+    key = AES256GCM.get_random_bytes(32)
+    entries = [_synthetic_entry(i) for i in range(spec["entries"])]
+    path = os.path.join(spec["work"], "bench-manifest.enc")
+
+    def write():
+        writer = ManifestWriter(path, key)
+        for entry in entries:
+            writer.add(entry)
+        writer.close()
+
+    def parse():
+        with open_manifest(path, key) as manifest:
+            for _ in manifest:
+                pass
+
+    write_seconds = _best(write, spec["repeat"])
+    parse_seconds = _best(parse, spec["repeat"])
+    result = {"entries": len(entries), "bytes_per_entry": os.path.getsize(path) / len(entries),
+              "write_entries_per_s": len(entries) / write_seconds, "parse_entries_per_s": len(entries) / parse_seconds}
+    os.remove(path)
+    return result
+
+
+def stage_encrypt(spec):
+    import scanner
+    from engine import encrypt_paths
+    from manifest import ManifestWriter, path_sort_key
+    out = spec["out"]
+    os.makedirs(out, exist_ok=True)
+    salt = AES256GCM.get_random_bytes(16)
+    kdf_start = time.perf_counter()
+    master_key = AES256GCM.derive_key(PASSWORD, salt)
+    kdf_seconds = time.perf_counter() - kdf_start
+
+    start = time.perf_counter()
+    records = sorted(scanner.scan_tree([spec["root"]], jobs=spec["jobs"]), key=lambda r: path_sort_key(r.path))
+    writer = ManifestWriter(os.path.join(out, "masterkey.enc"), master_key)
+    total = 0
+    for entry in encrypt_paths(records, out, master_key, jobs=spec["jobs"], executor=spec["executor"],
+                               chunk_size=spec["chunk_size"]):
+        writer.add(entry)
+        total += entry["file_size"]
+    writer.close()
+    seconds = time.perf_counter() - start
+    with open(os.path.join(out, "master_salt.txt"), "w") as h:
+        h.write(salt.hex())
+    return {"files": len(records), "bytes": total, "seconds": seconds, "kdf_seconds": kdf_seconds,
+            "mb_per_s": total / seconds / 2**20, "files_per_s": len(records) / seconds}
+
+
+def stage_restore(spec):
+    import main
+    archive = main.open_archive(PASSWORD, spec["out"])
+    if archive is None:
+        raise RuntimeError("ベンチマークのアーカイブを開けません")
+    manifest, master_key = archive
+    start = time.perf_counter()
+    with manifest:
+        progress = main.restore_directory_structure(spec["restore"], manifest, master_key, spec["jobs"])
+    seconds = time.perf_counter() - start
+    if progress.failures:
+        raise RuntimeError(f"{len(progress.failures)} 個のファイルの復元に失敗しました")
+    return {"files": progress.total_files, "bytes": progress.total_bytes, "seconds": seconds,
+            "mb_per_s": progress.total_bytes / seconds / 2**20, "files_per_s": progress.total_files / seconds}
+
+
+_STAGE_FUNCTIONS = {
+    "traverse": stage_traverse, "kdf": stage_kdf, "cipher": stage_cipher,
+    "manifest": stage_manifest, "encrypt": stage_encrypt, "restore": stage_restore,
+}
+
+
+def peak_rss_mb():
+    """
+    このプロセスのピークRSS (MB)。ru_maxrss は fork/exec の前の親プロセスの分を引き継ぐことがあるので、
+    exec でリセットされる /proc/self/status の VmHWM を優先する。
+    """
+    try:
+        with open("/proc/self/status") as h:
+            for line in h:
+                if line.startswith("VmHWM:"):
+                    return int(line.split()[1]) / 1024
+    except OSError:
+        pass
+    return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024
+
+
+def run_child(spec):
+    """子プロセス側: 段階を1つ実行し、結果にピークRSSを加えて spec["result"] に書く。"""
+    _set_scrypt(spec.get("e2e_scrypt"))
+    result = _STAGE_FUNCTIONS[spec["stage"]](spec)
+    result["peak_rss_mb"] = peak_rss_mb()
+    with open(spec["result"], "w") as h:
+        json.dump(result, h)
+
+
+def run_stage(spec, verbose=False):
+    """段階を子プロセスで実行して結果を返す。"""
+    fd, result_path = tempfile.mkstemp(suffix=".json")
+    os.close(fd)
+    try:
+        spec = dict(spec, result=result_path)
+        subprocess.run([sys.executable, os.path.abspath(__file__), "--child", json.dumps(spec)], check=True,
+                       stdout=None if verbose else subprocess.DEVNULL)
+        with open(result_path) as h:
+            return json.load(h)
+    finally:
+        os.remove(result_path)
+
+
+# --- 結果の比較 ---
+
+def _direction(metric):
+    """大きいほど良い指標なら 1、小さいほど良い指標なら -1、比べない指標なら 0。"""
+    if metric.endswith("_per_s"):
+        return 1
+    if metric in ("seconds", "peak_rss_mb"):
+        return -1
+    return 0
+
+
+def compare_results(old, new, threshold):
+    """前回 old と今回 new の共通の指標を比べ、(段階, 指標, 前回, 今回, 変化率, 悪化したか) のリストを返す。"""
+    rows = []
+    for name, metrics in new["results"].items():
+        previous = old.get("results", {}).get(name)
+        if previous is None:
+            continue
+        for metric, value in metrics.items():
+            direction = _direction(metric)
+            if not direction or metric not in previous or not previous[metric]:
+                continue
+            change = (value - previous[metric]) / previous[metric]
+            rows.append((name, metric, previous[metric], value, change, direction * change < -threshold))
+    return rows
+
+
+def _git_commit():
+    try:
+        return subprocess.run(["git", "rev-parse", "--short", "HEAD"], cwd=os.path.dirname(os.path.abspath(__file__)),
+                              capture_output=True, text=True, check=True).stdout.strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+
+def _parse_scrypt(text):
+    """'17,20,3' (log2(N), r, p) を (17, 20, 3) に変換する。"""
+    try:
+        log2n, r, p = (int(part) for part in text.split(","))
+    except ValueError:
+        raise argparse.ArgumentTypeError(f"--scrypt は log2(N),r,p の形で指定してください: {text}")
+    return log2n, r, p
+
+
+def _format_metrics(metrics):
+    return ", ".join(f"{key} {value:,.2f}" if isinstance(value, float) else f"{key} {value:,}"
+                     for key, value in metrics.items())
+
+
+def build_arg_parser():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--out", default=None, help="結果を書く JSON ファイル")
+    parser.add_argument("--compare", default=None, metavar="JSON", help="比べる前回の結果")
+    parser.add_argument("--threshold", type=float, default=0.10, help="悪化とみなす変化の割合 (既定: 0.10)")
+    parser.add_argument("--quick", action="store_true", help="小さなツリーと少ない繰り返しで短時間に測る")
+    parser.add_argument("--only", default=",".join(STAGES), help=f"測る段階 (カンマ区切り, 既定: 全て: {','.join(STAGES)})")
+    parser.add_argument("--tree", default=None, help="合成せずに既存のツリーを traverse/encrypt/restore で使う")
+    parser.add_argument("--work", default=None, help="合成したツリーとアーカイブを置くディレクトリ (既定: 一時ディレクトリ)")
+    parser.add_argument("--tiny-files", type=int, default=None, help="小さなファイルの数 (既定: 20000, --quick: 2000)")
+    parser.add_argument("--tiny-max", type=parse_size, default=4096, help="小さなファイルの最大サイズ")
+    parser.add_argument("--huge-files", type=int, default=None, help="巨大なファイルの数 (既定: 2, --quick: 1)")
+    parser.add_argument("--huge-size", type=parse_size, default=None, help="巨大なファイルのサイズ (既定: 512M, --quick: 64M)")
+    parser.add_argument("--mixed-files", type=int, default=None, help="中くらいのファイルの数 (既定: 150, --quick: 30)")
+    parser.add_argument("--mixed-size", type=parse_size, default=parse_size("4M"), help="中くらいのファイルのサイズ")
+    parser.add_argument("--manifest-entries", type=int, default=None, help="manifest で書くエントリ数 (既定: 200000, --quick: 20000)")
+    parser.add_argument("--chunk-sizes", default=None,
+                        help="cipher で測るチャンクサイズ (カンマ区切り, 既定: 64K,1M,8M,50M, --quick: 64K,1M,8M)")
+    parser.add_argument("--e2e-chunk-sizes", default=None,
+                        help=f"encrypt/restore で使うチャンクサイズ (カンマ区切り, 既定: {CHUNK_SIZE // 2**20}M)")
+    parser.add_argument("--scrypt", type=_parse_scrypt, action="append", default=None, metavar="LOG2N,R,P",
+                        help="kdf で測る scrypt のパラメータ (複数指定可, 既定: AES256GCM の現在の値)")
+    parser.add_argument("--e2e-scrypt", type=_parse_scrypt, default=None, metavar="LOG2N,R,P",
+                        help="encrypt/restore でのマスター鍵の導出に使うパラメータ (既定: AES256GCM の現在の値)")
+    parser.add_argument("--jobs", "-j", type=int, default=1, help="走査・暗号化・復元のワーカー数")
+    parser.add_argument("--executor", choices=["pipeline", "thread", "process"], default="pipeline")
+    parser.add_argument("--repeat", type=int, default=None, help="traverse/kdf/cipher/manifest の繰り返し回数 (最良値を使う, 既定: 3, --quick: 1)")
+    parser.add_argument("--verbose", action="store_true", help="各段階の出力 (進捗など) も表示する")
+    return parser
+
+
+def main():
+    args = build_arg_parser().parse_args()
+    quick = args.quick
+    repeat = args.repeat or (1 if quick else 3)
+    stages = [stage.strip() for stage in args.only.split(",") if stage.strip()]
+    unknown = [stage for stage in stages if stage not in STAGES]
+    if unknown:
+        print(f"エラー: 不明な段階です: {', '.join(unknown)}")
+        sys.exit(2)
+    if "restore" in stages and "encrypt" not in stages:
+        stages.insert(stages.index("restore"), "encrypt") # 復元するアーカイブを作る
+    chunk_sizes = [parse_size(s) for s in (args.chunk_sizes or ("64K,1M,8M" if quick else "64K,1M,8M,50M")).split(",")]
+    e2e_chunk_sizes = [parse_size(s) for s in (args.e2e_chunk_sizes or str(CHUNK_SIZE)).split(",")]
+    current_scrypt = (AES256GCM.SCRYPT_N.bit_length() - 1, AES256GCM.SCRYPT_R, AES256GCM.SCRYPT_P)
+    scrypt_params = args.scrypt or [current_scrypt]
+
+    work = args.work or tempfile.mkdtemp(prefix="bench-suite-")
+    os.makedirs(work, exist_ok=True)
+    config = {
+        "quick": quick, "repeat": repeat, "jobs": args.jobs, "executor": args.executor,
+        "chunk_sizes": chunk_sizes, "e2e_chunk_sizes": e2e_chunk_sizes,
+        "scrypt": [list(p) for p in scrypt_params], "e2e_scrypt": list(args.e2e_scrypt or current_scrypt),
+    }
+    results = {}
+    try:
+        root = args.tree
+        if root is None and {"traverse", "encrypt", "restore"} & set(stages):
+            root = os.path.join(work, "tree")
+            tree = dict(
+                tiny_files=args.tiny_files if args.tiny_files is not None else (2000 if quick else 20000),
+                tiny_max=args.tiny_max,
+                huge_files=args.huge_files if args.huge_files is not None else (1 if quick else 2),
+                huge_size=args.huge_size or parse_size("64M" if quick else "512M"),
+                mixed_files=args.mixed_files if args.mixed_files is not None else (30 if quick else 150),
+                mixed_size=args.mixed_size,
+            )
+            start = time.perf_counter()
+            files, total = make_tree(root, **tree)
+            config["tree"] = tree
+            print(f"合成したツリー: {files} ファイル, {total / 2**20:.1f} MB ({time.perf_counter() - start:.1f}s)")
+
+        base = {"repeat": repeat, "jobs": args.jobs, "work": work, "e2e_scrypt": args.e2e_scrypt}
+        specs = []
+        for stage in stages:
+            if stage == "traverse":
+                specs.append(("traverse", dict(base, stage=stage, root=root)))
+            elif stage == "kdf":
+                for params in scrypt_params:
+                    specs.append((f"kdf[N=2^{params[0]},r={params[1]},p={params[2]}]", dict(base, stage=stage, scrypt=params)))
+            elif stage == "cipher":
+                for size in chunk_sizes:
+                    specs.append((f"cipher[{size // 1024}K]", dict(base, stage=stage, chunk_size=size,
+                                                                  bytes=parse_size("64M" if quick else "256M"))))
+            elif stage == "manifest":
+                entries = args.manifest_entries or (20000 if quick else 200000)
+                specs.append(("manifest", dict(base, stage=stage, entries=entries)))
+            elif stage in ("encrypt", "restore"):
+                for size in e2e_chunk_sizes:
+                    specs.append((f"{stage}[{size // 1024}K]", dict(
+                        base, stage=stage, root=root, chunk_size=size, executor=args.executor,
+                        out=os.path.join(work, f"archive-{size}"), restore=os.path.join(work, f"restore-{size}"))))
+
+        for name, spec in specs:
+            if spec["stage"] == "encrypt":
+                shutil.rmtree(spec["out"], ignore_errors=True)
+            if spec["stage"] == "restore":
+                shutil.rmtree(spec["restore"], ignore_errors=True)
+            results[name] = run_stage(spec, args.verbose)
+            print(f"{name}: {_format_metrics(results[name])}")
+    finally:
+        if args.work is None:
+            shutil.rmtree(work, ignore_errors=True)
+
+    document = {
+        "version": RESULTS_VERSION,
+        "created": datetime.datetime.now(datetime.timezone.utc).isoformat(timespec="seconds"),
+        "commit": _git_commit(),
+        "host": {"python": platform.python_version(), "platform": platform.platform(), "cpus": os.cpu_count()},
+        "config": config,
+        "results": results,
+    }
+    if args.out:
+        with open(args.out, "w") as h:
+            json.dump(document, h, indent=2, ensure_ascii=False)
+        print(f"結果を {args.out} に保存しました。")
+
+    if args.compare:
+        with open(args.compare) as h:
+            old = json.load(h)
+        rows = compare_results(old, document, args.threshold)
+        regressions = [row for row in rows if row[5]]
+        print(f"\n前回 ({old.get('commit') or old.get('created')}) との比較 (しきい値 {args.threshold:.0%}):")
+        differing = sorted(key for key in set(config) | set(old.get("config", {}))
+                           if config.get(key) != old.get("config", {}).get(key))
+        if differing or old.get("host") != document["host"]:
+            print(f"  注意: 設定またはマシンが前回と異なります ({', '.join(differing) or 'host'})。比較は参考値です。")
+        for name, metric, before, after, change, regressed in rows:
+            mark = "悪化" if regressed else ""
+            print(f"  {name:<28} {metric:<22} {before:>12,.2f} -> {after:>12,.2f} ({change:+.1%}) {mark}")
+        if regressions:
+            print(f"しきい値を超えて悪化した指標が {len(regressions)} 個あります。")
+            sys.exit(1)
+        print("しきい値を超えて悪化した指標はありません。")
+
+
+if __name__ == "__main__":
+    if len(sys.argv) == 3 and sys.argv[1] == "--child":
+        run_child(json.loads(sys.argv[2]))
+    else:
+        main()
@@ -0,0 +1,181 @@
+"""
+メモリ予算 (--memory-limit)。
+
+メモリを大きく使うのは次の2つで、どちらも同時に実行する数で使用量が決まる。
+* scrypt による鍵導出: 1回あたり 128 * N * r バイト (現在のパラメータで約335MB)。
+  マスター鍵の導出と、旧形式のアーカイブを復元するときのファイル毎の導出。
+* チャンクのバッファ: 平文と暗号文 (圧縮する場合は圧縮結果、パックに入れる場合は連結したブロックも)。
+
+実行前に plan_encrypt / plan_restore で上限に収まるようにワーカー数とチャンクサイズを決め、
+実行中は MemoryBudget で「これから使う分」を予約してから仕事を投入する (収まらなければ、先に投入した
+仕事が終わって解放されるまで待つ)。予約の合計のピークを最後に表示する。
+数字は Python のオブジェクトの細かいオーバーヘッドを含まない目安なので、上限には余裕を持たせること。
+"""
+import collections
+import threading
+
+import AES256GCM
+
+# インタプリタ本体・マニフェストのセグメント・索引など、チャンク以外で常に使う分の見積もり
+BASE_OVERHEAD = 64 * 1024 * 1024
+# ワーカープロセス (process executor と CDCの分割用) 1つ分のインタプリタの見積もり
+PROCESS_OVERHEAD = 32 * 1024 * 1024
+# チャンクサイズを小さくするときも、この大きさまではワーカー数より優先して小さくする
+PREFERRED_MIN_CHUNK_SIZE = 8 * 1024 * 1024
+MIN_CHUNK_SIZE = 1024 * 1024
+# cdc.scan_file が1ファイルの分割中に持つバッファ (読み込み単位 max_size * 4 + 繰り越し分)
+CDC_SCAN_FACTOR = 5
+
+
+def scrypt_bytes():
+    """derive_key 1回分の作業領域 (scrypt の V 配列) のバイト数。p 個のブロックは順に計算される。"""
+    return 128 * AES256GCM.SCRYPT_N * AES256GCM.SCRYPT_R
+
+
+def chunk_cost(length, compression=False, packed=False):
+    """
+    暗号化するチャンク1つが処理中に使うバイト数。
+    平文と暗号文で2つ分、圧縮するなら圧縮結果、パックに入れるなら連結したブロックがもう1つ分ずつ。
+    """
+    return length * (2 + bool(compression) + bool(packed))
+
+
+def restore_cost(size):
+    """復元するチャンク1つ分: 暗号文・平文のバッファと、展開する場合の展開結果。"""
+    return size * 3
+
+
+def encrypt_working_set(workers, chunk_size, executor, compression=False, cdc_max=None):
+    """ワーカー数とチャンクサイズから、暗号化中に同時に使う最大のバイト数を見積もる。"""
+    per_chunk = chunk_cost(chunk_size, compression)
+    if executor == "pipeline":
+        # 平文・暗号文のバッファが (workers + 1) 組、圧縮結果は暗号化中のチャンクの分だけ
+        total = 2 * (workers + 1) * chunk_size + (workers * chunk_size if compression else 0)
+    else:
+        total = workers * per_chunk
+        if executor == "process" and workers > 1:
+            total += workers * PROCESS_OVERHEAD
+    if cdc_max is not None:
+        total += workers * CDC_SCAN_FACTOR * cdc_max
+        if executor != "process" or workers == 1:
+            # 分割用のワーカープロセス (engine._make_scan_executor)
+            total += workers * PROCESS_OVERHEAD
+    return total
+
+
+def _candidates(jobs, chunk_size, adjustable):
+    """試す (ワーカー数, チャンクサイズ) を優先順に返す。"""
+    sizes = [chunk_size]
+    if adjustable:
+        while sizes[-1] // 2 >= MIN_CHUNK_SIZE:
+            sizes.append(sizes[-1] // 2)
+    preferred = [size for size in sizes if size >= PREFERRED_MIN_CHUNK_SIZE] or sizes[:1]
+    # まずチャンクを PREFERRED_MIN_CHUNK_SIZE まで小さくし、それでも足りなければワーカーを減らす
+    for workers in range(max(jobs, 1), 0, -1):
+        for size in preferred:
+            yield workers, size
+    for size in sizes[len(preferred):]:
+        yield 1, size
+
+
+def _available(limit):
+    available = limit - BASE_OVERHEAD
+    if available < scrypt_bytes():
+        raise ValueError(f"メモリの上限が小さすぎます: 鍵導出 (scrypt) だけで "
+                         f"{(scrypt_bytes() + BASE_OVERHEAD) / 2**20:.0f} MB 必要です")
+    return available
+
+
+Plan = collections.namedtuple("Plan", ["jobs", "chunk_size", "working_set"])
+
+
+def plan_encrypt(limit, jobs, chunk_size, executor, compression=False, cdc_max=None):
+    """
+    上限 limit (バイト) に収まる暗号化のワーカー数とチャンクサイズを Plan として返す。
+    CDC (cdc_max を指定) ではチャンクの境界を変えると重複排除が効かなくなるので、ワーカー数だけを減らす。
+    scrypt はチャンクの処理より前に1回だけ行うので、チャンクの分とは同時に数えない。
+    どうしても収まらなければ ValueError。
+    """
+    available = _available(limit)
+    size = cdc_max if cdc_max is not None else chunk_size
+    for workers, size in _candidates(jobs, size, cdc_max is None):
+        working_set = encrypt_working_set(workers, size, executor, compression, cdc_max)
+        if working_set <= available:
+            return Plan(workers, size, working_set)
+    raise ValueError(f"メモリの上限が小さすぎます: チャンク1つの処理に "
+                     f"{(encrypt_working_set(1, size, executor, compression, cdc_max) + BASE_OVERHEAD) / 2**20:.0f} MB 必要です")
+
+
+def plan_restore(limit, jobs, chunk_size):
+    """
+    上限 limit に収まる復元のワーカー数を Plan として返す (チャンクサイズはアーカイブで決まっている)。
+    旧形式のファイル毎の scrypt は実行時に予算から予約するので、ここではマスター鍵の分だけを確かめる。
+    """
+    available = _available(limit)
+    for workers in range(max(jobs, 1), 0, -1):
+        if workers * restore_cost(chunk_size) <= available:
+            return Plan(workers, chunk_size, workers * restore_cost(chunk_size))
+    return Plan(1, chunk_size, restore_cost(chunk_size))
+
+
+class MemoryBudget:
+    """
+    使用中 (予約済み) のバイト数を limit 以下に保つ。limit が None なら制限せずに集計だけする。
+    used と peak には最初から overhead (チャンク以外に常に使う分の見積もり) を含める。
+    何も予約されていないときは limit を超える予約も受け付ける (1つも進められずに止まらないように)。
+    複数のスレッドから使える。
+    """
+    def __init__(self, limit=None, overhead=BASE_OVERHEAD):
+        self.limit = limit
+        self.overhead = overhead
+        self.used = overhead
+        self.peak = overhead
+        self._condition = threading.Condition()
+
+    def _fits(self, nbytes):
+        return self.limit is None or self.used == self.overhead or self.used + nbytes <= self.limit
+
+    def _take(self, nbytes):
+        self.used += nbytes
+        self.peak = max(self.peak, self.used)
+
+    def try_acquire(self, nbytes):
+        """収まれば予約して True、収まらなければ何もせずに False を返す。"""
+        with self._condition:
+            if not self._fits(nbytes):
+                return False
+            self._take(nbytes)
+            return True
+
+    def acquire(self, nbytes):
+        """収まるまで待ってから予約する。"""
+        with self._condition:
+            self._condition.wait_for(lambda: self._fits(nbytes))
+            self._take(nbytes)
+
+    def release(self, nbytes):
+        with self._condition:
+            self.used -= nbytes
+            self._condition.notify_all()
+
+    def reserve(self, nbytes):
+        """with 文の間だけ nbytes を予約する。"""
+        return _Reservation(self, nbytes)
+
+    def line(self):
+        limit = "無制限" if self.limit is None else f"{self.limit / 2**20:.0f} MB"
+        return f"ピーク {self.peak / 2**20:.1f} MB / 上限 {limit}"
+
+
+class _Reservation:
+    def __init__(self, budget, nbytes):
+        self.budget = budget
+        self.nbytes = nbytes
+
+    def __enter__(self):
+        self.budget.acquire(self.nbytes)
+        return self
+
+    def __exit__(self, *exc):
+        self.budget.release(self.nbytes)
+        return False
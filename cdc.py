@@ -0,0 +1,175 @@
+"""
+FastCDC方式のコンテンツ定義チャンク分割 (content-defined chunking)。
+
+固定オフセットで分割すると1バイトの挿入で以降の全チャンクが変わってしまうが、
+ローリングハッシュ (Gear hash) の値で切れ目を決めるので、挿入・削除の影響は近傍のチャンクに限られる。
+平均サイズ付近に切れ目が集まるよう、平均サイズまでは厳しいマスク、以降は緩いマスクを使う (normalized chunking)。
+
+切れ目の探索は numpy があればベクトル化して行い (1コアで約100MB/s)、無ければ純粋な Python で1バイトずつ
+計算する (1コアで約8MB/s)。どちらも同じ位置で切るので、混在しても重複排除は効く。
+"""
+import collections
+import hashlib
+import hmac
+
+try:
+    import numpy
+except ImportError:
+    numpy = None
+
+_MASK64 = (1 << 64) - 1
+
+# Gearテーブルは固定シードから作る (実行ごと・マシンごとに切れ目が変わらないように)
+GEAR = [int.from_bytes(hashlib.sha256(b"pycryptodrive-gear" + bytes([i])).digest()[:8], "big") for i in range(256)]
+
+CDCParams = collections.namedtuple("CDCParams", ["min_size", "avg_size", "max_size"])
+
+DEFAULT_PARAMS = CDCParams(1024*1024, 4*1024*1024, 16*1024*1024)
+
+# 切れ目の探索の実装 ("numpy" または "python")
+SCAN_BACKEND = "numpy" if numpy is not None else "python"
+
+# Gear ハッシュは直前の64バイトだけで決まる (それより前のバイトはシフトで押し出される)
+_WINDOW = 64
+# numpy で一度に調べる位置の数 (作業用の配列が CPU のキャッシュに収まる大きさ)
+_NUMPY_BLOCK = 16 * 1024
+# 純粋な Python で、64ビットに切り詰めずにまとめて進めるバイト数
+_PYTHON_BLOCK = 128
+
+if numpy is not None:
+    _GEAR_ARRAY = numpy.array(GEAR, dtype=numpy.uint64)
+
+
+def _masks(avg_size):
+    bits = max(avg_size.bit_length() - 1, 2)
+    # シフトで古いバイトほど上位ビットへ押し出されるので、マスクは上位ビット側に置く
+    mask_s = ((1 << (bits + 2)) - 1) << (64 - bits - 2)
+    mask_l = ((1 << (bits - 2)) - 1) << (64 - bits + 2)
+    return mask_s, mask_l
+
+
+def validate_params(params):
+    if not (0 < params.min_size <= params.avg_size <= params.max_size):
+        raise ValueError(f"CDCのサイズ指定が不正です (min <= avg <= max): {tuple(params)}")
+    return params
+
+
+def cut_point(data, start, end, params):
+    """data[start:end] の先頭から次の切れ目までの長さを返す。"""
+    n = end - start
+    if n <= params.min_size:
+        return n
+    if n > params.max_size:
+        n = params.max_size
+    normal = min(params.avg_size, n)
+    mask_s, mask_l = _masks(params.avg_size)
+    first = start + params.min_size
+    search = _search_numpy if numpy is not None else _search_python
+    with memoryview(data) as view:
+        # ハッシュは first から計算し始める (それより前のバイトは 0 とみなす)
+        for lo, hi, mask in ((first, start + normal, mask_s), (start + normal, start + n, mask_l)):
+            found = search(view, first, lo, hi, mask)
+            if found is not None:
+                return found + 1 - start
+    return n
+
+
+def _search_python(view, first, lo, hi, mask):
+    """位置 lo..hi-1 で、そこまでのハッシュが mask に掛からない最初の位置を返す (無ければ None)。"""
+    gear = GEAR
+    h = 0
+    for i in range(max(first, lo - _WINDOW + 1), lo):
+        h = ((h << 1) + gear[view[i]]) & _MASK64
+    pos = lo
+    while pos < hi:
+        stop = min(pos + _PYTHON_BLOCK, hi)
+        start_h = h
+        # ブロックの中では切り詰めない (下位64ビットは同じなので判定は変わらない)。添字を数えずに回し、
+        # 見つかったときだけブロックをやり直して位置を求める
+        for byte in view[pos:stop]:
+            h = h + h + gear[byte]
+            if not h & mask:
+                break
+        else:
+            h &= _MASK64
+            pos = stop
+            continue
+        h = start_h
+        for i in range(pos, stop):
+            h = ((h << 1) + gear[view[i]]) & _MASK64
+            if not h & mask:
+                return i
+    return None
+
+
+def _search_numpy(view, first, lo, hi, mask):
+    """_search_python と同じ位置を、_NUMPY_BLOCK 個ずつまとめて計算して探す。"""
+    mask = numpy.uint64(mask)
+    for block in range(lo, hi, _NUMPY_BLOCK):
+        stop = min(block + _NUMPY_BLOCK, hi)
+        hits = numpy.flatnonzero((_window_hashes(view, first, block, stop) & mask) == 0)
+        if len(hits):
+            return block + int(hits[0])
+    return None
+
+
+def _window_hashes(view, first, lo, hi):
+    """
+    位置 lo..hi-1 の Gear ハッシュを uint64 の配列で返す (first より前のバイトは 0 とみなす)。
+    h_i = sum(GEAR[b_{i-k}] << k, k=0..63) mod 2^64 を、シフト幅を倍々にした6回の加算で求める。
+    """
+    pad = min(_WINDOW - 1, lo - first)
+    g = _GEAR_ARRAY[numpy.frombuffer(view[lo - pad:hi], dtype=numpy.uint8)]
+    if pad < _WINDOW - 1:
+        g = numpy.concatenate((numpy.zeros(_WINDOW - 1 - pad, dtype=numpy.uint64), g))
+    width = 1
+    while width < _WINDOW:
+        g[width:] += g[:-width] << numpy.uint64(width)
+        width *= 2
+    return g[_WINDOW - 1:]
+
+
+def iter_chunks(f, params=DEFAULT_PARAMS, read_size=None):
+    """
+    ファイルオブジェクト f をCDCで分割し、(offset, chunk) を順に yield する。
+    バッファは max_size の数倍程度しか持たないので、ファイルサイズに関係なくメモリは一定。
+    """
+    read_size = read_size or params.max_size * 4
+    buffer = bytearray()
+    base = 0  # buffer[0] のファイル内オフセット
+    pos = 0
+    eof = False
+    while True:
+        if not eof and len(buffer) - pos < params.max_size:
+            del buffer[:pos]
+            base += pos
+            pos = 0
+            block = f.read(read_size)
+            if block:
+                buffer += block
+            else:
+                eof = True
+        if pos >= len(buffer):
+            if eof:
+                return
+            continue
+        n = cut_point(buffer, pos, len(buffer), params)
+        if n == len(buffer) - pos and not eof and n < params.max_size:
+            # まだ続きがあるのに末尾で切れてしまった場合は、読み足してからやり直す
+            continue
+        yield base + pos, bytes(buffer[pos:pos + n])
+        pos += n
+
+
+def content_id(id_key, data):
+    """平文の鍵付きハッシュ (HMAC-SHA256)。鍵を知らなければ内容の推測に使えない。"""
+    return hmac.new(id_key, data, hashlib.sha256).hexdigest()
+
+
+def scan_file(file_path, params, id_key):
+    """ファイルをCDCで分割し、[(offset, length, content_id), ...] を返す (ワーカー上で実行される)。"""
+    chunks = []
+    with open(file_path, "rb") as f:
+        for offset, chunk in iter_chunks(f, params):
+            chunks.append((offset, len(chunk), content_id(id_key, chunk)))
+    return chunks
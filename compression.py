@@ -0,0 +1,101 @@
+"""
+暗号化前の圧縮ステージ。
+
+標準ライブラリのコーデック (zlib, lzma) でチャンクを圧縮する。
+JPEGやアーカイブのように既に圧縮済み・高エントロピーのデータは、チャンクの一部を
+試しに圧縮してみて縮まなければ圧縮せずにそのまま保存し、CPU時間を無駄にしない。
+使ったコーデックはチャンクのAADに記録されるので、復元時は圧縮・非圧縮のチャンクが混在していてもよい。
+"""
+import collections
+import lzma
+import threading
+import zlib
+
+CODEC_NONE = "none"
+CODECS = (CODEC_NONE, "zlib", "lzma")
+
+DEFAULT_LEVELS = {"zlib": 6, "lzma": 6}
+
+# 試し圧縮に使うサンプル (先頭・中央・末尾から SAMPLE_SIZE ずつ)
+SAMPLE_SIZE = 64 * 1024
+# サンプルがこの比率より縮まなければ圧縮しない
+INCOMPRESSIBLE_RATIO = 0.95
+
+CompressionSettings = collections.namedtuple("CompressionSettings", ["codec", "level"])
+
+
+def make_settings(codec, level=None):
+    if codec not in CODECS:
+        raise ValueError(f"不明な圧縮コーデックです: {codec}")
+    if codec == CODEC_NONE:
+        return None
+    return CompressionSettings(codec, DEFAULT_LEVELS[codec] if level is None else level)
+
+
+def looks_incompressible(data):
+    """チャンクの一部を zlib (最速レベル) で試し圧縮し、ほとんど縮まなければ True を返す。"""
+    size = len(data)
+    if size <= SAMPLE_SIZE * 3:
+        sample = data
+    else:
+        middle = size // 2
+        sample = b"".join((data[:SAMPLE_SIZE], data[middle:middle + SAMPLE_SIZE], data[-SAMPLE_SIZE:]))
+    if not sample:
+        return True
+    return len(zlib.compress(sample, 1)) >= len(sample) * INCOMPRESSIBLE_RATIO
+
+
+def compress_chunk(data, settings):
+    """
+    チャンクを圧縮し、(実際に使ったコーデック, データ) を返す。
+    圧縮しない設定・圧縮に向かないデータ・圧縮しても縮まなかった場合は (CODEC_NONE, data) を返す。
+    """
+    if settings is None or looks_incompressible(data):
+        return CODEC_NONE, data
+    if settings.codec == "zlib":
+        compressed = zlib.compress(data, settings.level)
+    else:
+        compressed = lzma.compress(data, preset=settings.level)
+    if len(compressed) >= len(data):
+        return CODEC_NONE, data
+    return settings.codec, compressed
+
+
+def decompress_chunk(data, codec):
+    if codec in (None, CODEC_NONE):
+        return data
+    if codec == "zlib":
+        return zlib.decompress(data)
+    if codec == "lzma":
+        return lzma.decompress(data)
+    raise ValueError(f"不明な圧縮コーデックです: {codec}")
+
+
+class CompressionStats:
+    """実行全体の圧縮の統計 (入出力バイト数・圧縮/スキップしたチャンク数・CPU時間)。"""
+    def __init__(self):
+        self.input_bytes = 0
+        self.output_bytes = 0
+        self.compressed_chunks = 0
+        self.skipped_chunks = 0
+        self.cpu_seconds = 0.0
+        self._lock = threading.Lock()
+
+    def add(self, input_bytes, output_bytes, codec, cpu_seconds):
+        with self._lock:
+            self.input_bytes += input_bytes
+            self.output_bytes += output_bytes
+            if codec == CODEC_NONE:
+                self.skipped_chunks += 1
+            else:
+                self.compressed_chunks += 1
+            self.cpu_seconds += cpu_seconds
+
+    @property
+    def ratio(self):
+        return self.output_bytes / self.input_bytes if self.input_bytes else 1.0
+
+    def line(self):
+        return (f"{self.input_bytes / 2**20:.1f} MB -> {self.output_bytes / 2**20:.1f} MB "
+                f"(比率 {self.ratio:.3f}), 圧縮 {self.compressed_chunks} チャンク, "
+                f"スキップ {self.skipped_chunks} チャンク, CPU時間 {self.cpu_seconds:.2f} 秒")
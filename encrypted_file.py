@@ -0,0 +1,175 @@
+"""
+アーカイブ内のファイルを復元せずにその場で読むための、ファイルライクなクラス。
+
+    manifest, master_key = main.open_archive(password, "./encrypted_archive")
+    with EncryptedFile.from_manifest(manifest, master_key, "/home/user/logs/app.log") as f:
+        f.seek(-4096, io.SEEK_END)
+        tail = f.read()
+
+バイト位置をチャンクに対応付け、必要なチャンクだけを復号する。復号したチャンクはバイト数で上限を
+決めたLRUキャッシュに保持するので、同じチャンク内への読み込みは2回目以降は復号しない。
+readahead を指定すると、先頭から順に読んでいる間は次のチャンクをバックグラウンドで復号しておく
+(メモリはキャッシュの上限 + 先読みするチャンク数分)。
+行単位で読みたい場合は io.BufferedReader / io.TextIOWrapper で包むこと。
+S3 のアーカイブは open_archive に渡したのと同じ storage を渡して開く:
+
+    store = storage.open_storage("s3://bucket/archive")
+    manifest, master_key = main.open_archive(password, None, storage=store)
+    f = open_encrypted(manifest, master_key, "/home/user/logs/app.log", storage=store)
+"""
+import bisect
+import collections
+import concurrent.futures
+import io
+
+from main import decrypt_chunk_file, is_positioned, resolve_file_key
+
+DEFAULT_CACHE_SIZE = 256 * 1024 * 1024
+
+
+class EncryptedFile(io.RawIOBase):
+    """
+    マニフェストのエントリ1つ分の読み取り専用ファイル。
+    cache_size は復号済みチャンクのキャッシュの上限 (バイト)。1チャンクがこれより大きい場合も
+    読んでいるチャンク1つだけは保持する。readahead は順次読み込み時に先読みするチャンク数 (0 なら無効)。
+    storage (storage.S3Storage など) を指定すると、チャンクをその保存先から読む (マニフェストを
+    その storage で開いた場合は必ず指定する)。
+    """
+    def __init__(self, entry, master_key, cache_size=DEFAULT_CACHE_SIZE, readahead=0, storage=None):
+        super().__init__()
+        chunks = entry.get("chunks", [])
+        if not is_positioned(chunks):
+            raise ValueError("平文の位置情報が無い旧形式のエントリはランダムアクセスできません。decrypt で復元してください。")
+        self.name = "/".join(entry["path"] + [entry["name"]])
+        self._chunks = sorted(chunks, key=lambda c: c["offset"])
+        self._starts = [c["offset"] for c in self._chunks]
+        self._size = entry.get("file_size", sum(c["size"] for c in self._chunks))
+        self._file_key, self._per_chunk_keys = resolve_file_key(entry, master_key)
+        self._storage = storage
+        self._position = 0
+        self.cache_size = cache_size
+        self._cache = collections.OrderedDict()
+        self._cached_bytes = 0
+        self.readahead = readahead
+        self._prefetch = {}
+        self._pool = concurrent.futures.ThreadPoolExecutor(max_workers=readahead) if readahead else None
+        self._last_chunk = None
+        self.hits = 0
+        self.misses = 0
+
+    @classmethod
+    def from_manifest(cls, manifest, master_key, path, **kwargs):
+        """manifest (manifest.open_manifest の返り値) から元の絶対パス path のファイルを開く。"""
+        entry = manifest.lookup(path)
+        if entry is None or entry.get("deleted"):
+            raise FileNotFoundError(f"アーカイブにファイルがありません: {path}")
+        return cls(entry, master_key, **kwargs)
+
+    def readable(self):
+        return True
+
+    def seekable(self):
+        return True
+
+    @property
+    def size(self):
+        return self._size
+
+    def tell(self):
+        self._checkClosed()
+        return self._position
+
+    def seek(self, offset, whence=io.SEEK_SET):
+        self._checkClosed()
+        if whence == io.SEEK_SET:
+            position = offset
+        elif whence == io.SEEK_CUR:
+            position = self._position + offset
+        elif whence == io.SEEK_END:
+            position = self._size + offset
+        else:
+            raise ValueError(f"whence の値が不正です: {whence}")
+        if position < 0:
+            raise ValueError(f"負の位置にはシークできません: {position}")
+        self._position = position
+        return position
+
+    def readinto(self, buffer):
+        self._checkClosed()
+        view = memoryview(buffer).cast("B")
+        written = 0
+        while written < len(view) and self._position < self._size:
+            number = bisect.bisect_right(self._starts, self._position) - 1
+            chunk = self._chunks[number]
+            data = self._chunk_data(number)
+            start = self._position - chunk["offset"]
+            n = min(len(view) - written, len(data) - start)
+            if n <= 0:
+                break # マニフェストのサイズとチャンクの中身が食い違っている
+            view[written:written + n] = data[start:start + n]
+            written += n
+            self._position += n
+        return written
+
+    def _chunk_data(self, number):
+        data = self._cache.get(number)
+        if data is not None:
+            self.hits += 1
+            self._cache.move_to_end(number)
+        else:
+            self.misses += 1
+            future = self._prefetch.pop(number, None)
+            if future is not None:
+                data = future.result()
+            else:
+                data = self._decrypt(number)
+            self._remember(number, data)
+        # 直前のチャンクの次を読んだら順次読み込みとみなして先読みする
+        if self._pool is not None and self._last_chunk is not None and number == self._last_chunk + 1:
+            self._start_readahead(number)
+        self._last_chunk = number
+        return data
+
+    def _decrypt(self, number):
+        # decrypt_chunk_file はスレッド毎のバッファ上の memoryview を返すので、キャッシュ用にコピーする
+        return bytes(decrypt_chunk_file(self._chunks[number], self._file_key, self._per_chunk_keys,
+                                        storage=self._storage))
+
+    def _start_readahead(self, number):
+        window = range(number + 1, number + 1 + self.readahead)
+        # シークで外れた先読みは捨てる
+        for stale in [n for n in self._prefetch if n not in window]:
+            self._prefetch.pop(stale).cancel()
+        for ahead in range(number + 1, min(number + 1 + self.readahead, len(self._chunks))):
+            if ahead not in self._cache and ahead not in self._prefetch:
+                self._prefetch[ahead] = self._pool.submit(self._decrypt, ahead)
+
+    def _remember(self, number, data):
+        self._cache[number] = data
+        self._cached_bytes += len(data)
+        # 上限を超えたら古いものから捨てる (今読んでいるチャンクは残す)
+        while self._cached_bytes > self.cache_size and len(self._cache) > 1:
+            _evicted, old = self._cache.popitem(last=False)
+            self._cached_bytes -= len(old)
+
+    def close(self):
+        if not self.closed:
+            if self._pool is not None:
+                for future in self._prefetch.values():
+                    future.cancel()
+                self._pool.shutdown(wait=True)
+            self._prefetch.clear()
+            self._cache.clear()
+            self._cached_bytes = 0
+        super().close()
+
+
+def open_encrypted(manifest, master_key, path, cache_size=DEFAULT_CACHE_SIZE, readahead=0, buffering=True,
+                   storage=None):
+    """
+    アーカイブ内のファイルを開く。buffering=True なら io.BufferedReader で包んで返す
+    (readline や小さな read が速くなる)。storage は EncryptedFile と同じ。
+    """
+    raw = EncryptedFile.from_manifest(manifest, master_key, path, cache_size=cache_size, readahead=readahead,
+                                      storage=storage)
+    return io.BufferedReader(raw) if buffering else raw
@@ -0,0 +1,555 @@
+"""
+暗号化エンジン。
+
+ファイル単位・チャンク単位の暗号化ジョブをスレッドプール/プロセスプールに投入し、
+結果 (マニフェストのファイル毎のエントリ) を投入順どおりに返す。
+AES-GCM (pycryptodome) は処理中にGILを解放するので、通常はスレッドで十分。
+デフォルトの executor ("pipeline") は読み込み・暗号化・書き出しを別々のスレッドで重ねて行う (pipeline.py)。
+"""
+import collections
+import concurrent.futures
+import contextlib
+import hashlib
+import hmac
+import multiprocessing
+import os
+import time
+
+from AES256GCM import *
+from budget import chunk_cost
+import cdc
+from compression import CODEC_NONE
+from manifest import entry_key
+from pipeline import ChunkJob, ChunkPipeline, encrypt_job
+from storage import LocalStorage, shard_key
+
+CHUNK_SIZE = 1024*1024*50 # 50MB ごとのチャンク
+
+
+def _chunk_object_name(chunkbase, chunk_index):
+    nfname=f"{chunkbase}_{chunk_index:05d}"
+    return hashlib.sha256(nfname.encode("utf-8")).hexdigest()
+
+
+# チャンクのレコードのうち保存場所を表すフィールド
+LOCATION_FIELDS = ("chunk_name", "pack_offset", "pack_length")
+
+# CDCの分割を待つ間に投入済みのジョブの回収に切り替えるまでの秒数
+_PLAN_WAIT = 1.0
+
+# 投入待ちの列でファイルの始まり・終わりと、前回の実行で書き終えたチャンクを表す印
+_FILE_BEGIN = object()
+_FILE_END = object()
+_RESUMED = object()
+
+
+# 暗号化したブロックのヘッダー (ノンス + AADの長さ) とタグの大きさ
+BLOCK_OVERHEAD = AES.block_size + 4 + 16
+
+
+def expected_block_length(entry, chunk):
+    """
+    エントリ entry のチャンク chunk を暗号化したブロックの正確な長さ。圧縮されたチャンクと
+    旧形式のチャンクは暗号文の長さが記録から分からないので None。
+    重複排除で参照したチャンクのレコードにも参照先のコーデックが記録されている (_collect)。
+    """
+    codec = chunk.get("codec")
+    if codec not in (None, CODEC_NONE) or "size" not in chunk or entry.get("kdf") not in (KDF_HKDF, KDF_CONTENT):
+        return None
+    # CODEC_NONE は圧縮を試して縮まなかったチャンクを以前の版が記録したもので、AADにも入っている
+    if chunk.get("cas"):
+        aad = content_aad(chunk["cas"], codec)
+    else:
+        aad = chunk_aad(chunk["chunk_id"], entry_key(entry), codec)
+    return BLOCK_OVERHEAD + len(aad) + chunk["size"]
+
+
+def file_content_hash(file_path, hash_key):
+    """ファイル全体の鍵付きハッシュ (HMAC-SHA256)。差分バックアップで内容の変化を確認するのに使う。"""
+    mac = hmac.new(hash_key, digestmod=hashlib.sha256)
+    with open(file_path, 'rb') as f:
+        for block in iter(lambda: f.read(1024*1024), b""):
+            mac.update(block)
+    return mac.hexdigest()
+
+
+def file_base_record(file_path, output_dir, st, hash_key=None):
+    """
+    ファイル単位の共通レコードを作る。st は読み出し前に取った os.stat の結果。
+    size / mtime_ns / inode は次回の差分バックアップで変更の有無を判定するのに使う。
+    """
+    base_db={}
+    filepath=file_path.split("/")
+    base_db["name"]=filepath[-1]
+    base_db["path"]=filepath[:-1]
+    base_db["chunkpath"]=output_dir
+    base_db["file_size"]=st.st_size
+    base_db["mtime_ns"]=st.st_mtime_ns
+    base_db["inode"]=st.st_ino
+    if hash_key is not None:
+        base_db["content_hash"]=file_content_hash(file_path, hash_key)
+    return base_db
+
+
+def _resumable(base_db, st):
+    """前回の実行で途中まで暗号化したファイル (base_db) が、その後変更されていなければ True。"""
+    return (base_db.get("file_size") == st.st_size and base_db.get("mtime_ns") == st.st_mtime_ns and
+            base_db.get("inode") == st.st_ino and base_db.get("kdf") == KDF_HKDF)
+
+
+def plan_file(file_path, output_dir, master_key, chunk_size=CHUNK_SIZE, hash_key=None, st=None, resume=None,
+              storage=None):
+    """
+    1ファイル分の暗号化ジョブを計画する。st は走査時に取った stat (省略すると stat し直す)。
+    (レコードの共通部分, ファイル鍵, [(chunk_index, offset, length, chunk_filename), ...]) を返す。
+    resume に前回の実行のジャーナルにある (レコードの共通部分, 書き終えたチャンクの数) を渡すと、
+    同じファイル鍵で続きのチャンクだけを計画する (ファイルが変更されていないことは呼び出し側が確かめる)。
+    チャンクは storage (省略時は output_dir の storage.LocalStorage) の ab/cd/ に振り分けて置く。
+    """
+    if storage is None:
+        storage = LocalStorage(output_dir)
+    if st is None:
+        st = os.stat(file_path)
+    done = 0
+    if resume is not None:
+        base_db, done = dict(resume[0]), resume[1]
+        file_salt = bytes.fromhex(base_db["key_salt"])
+    else:
+        base_db = file_base_record(file_path, output_dir, st, hash_key)
+        #ファイル鍵はマスター鍵とこのソルトから導出するので、ソルトだけを保存すればよい
+        file_salt = get_random_bytes(AES.block_size)
+        base_db["kdf"]=KDF_HKDF
+        base_db["key_salt"]=file_salt.hex()
+    filename = base_db["name"]
+    chunkrnd=os.urandom(16)
+    chunkbase=hashlib.sha256(chunkrnd+filename.encode("utf-8")+chunkrnd).hexdigest()
+    file_key = derive_file_key(master_key, file_salt)
+
+    file_size = st.st_size
+    chunks = []
+    for chunk_index, offset in enumerate(range(0, file_size, chunk_size)):
+        if chunk_index < done:
+            continue
+        chunk_filename = storage.prepare(shard_key(f"{_chunk_object_name(chunkbase, chunk_index)}.enc"))
+        chunks.append((chunk_index, offset, min(chunk_size, file_size - offset), chunk_filename))
+    return base_db, file_key, chunks
+
+
+class ChunkIndex:
+    """
+    重複排除用のチャンク索引 (コンテンツID -> 保存場所)。
+    出力ディレクトリの既存オブジェクト (振り分け用のサブディレクトリと、旧形式の直下のもの) を最初に一度だけ
+    列挙し、パックに入っているチャンクは前回のマニフェストから add_entry で登録する。
+    以後は実行中に書いたものを追加していく。
+    重複排除で参照するチャンクのコーデックは、この実行で書いたものは記録から、それ以外はブロックのAADから読む。
+    あわせて重複排除の統計 (全チャンク/新規チャンクの数とバイト数) を持つ。
+    """
+    def __init__(self, output_dir):
+        # 保存場所は LOCATION_FIELDS の辞書。None は「この実行で書き出し中」
+        self.locations = {}
+        storage = LocalStorage(output_dir)
+        for item in storage.list():
+            if item.key.endswith(".enc"):
+                name = item.key.rsplit("/", 1)[-1]
+                self.locations[name[:-len(".enc")]] = {"chunk_name": storage.path(item.key)}
+        self._existing_packs = {}
+        # コンテンツID -> コーデック (圧縮していなければ None)。分かっているものだけ
+        self.codecs = {}
+        self.chunks = 0
+        self.bytes = 0
+        self.new_chunks = 0
+        self.new_bytes = 0
+
+    def claim(self, content_id_hex, size):
+        """チャンクを登録し、新たに書き出す必要があれば True を返す。"""
+        self.chunks += 1
+        self.bytes += size
+        if content_id_hex in self.locations:
+            return False
+        self.locations[content_id_hex] = None
+        self.new_chunks += 1
+        self.new_bytes += size
+        return True
+
+    def locate(self, content_id_hex):
+        return self.locations[content_id_hex]
+
+    def record_location(self, content_id_hex, location, codec=None):
+        self.locations[content_id_hex] = location
+        self.codecs[content_id_hex] = codec
+
+    def codec(self, content_id_hex):
+        """保存済みのチャンクのコーデック (圧縮していなければ None)。"""
+        if content_id_hex not in self.codecs:
+            self.codecs[content_id_hex] = _stored_codec(self.locations[content_id_hex])
+        return self.codecs[content_id_hex]
+
+    def add_entry(self, entry):
+        """前回のマニフェストのエントリから、パックに入っている重複排除チャンクの場所を登録する。"""
+        existing_packs = self._existing_packs
+        for record in entry.get("chunks", []):
+            content_id_hex = record.get("cas")
+            if not content_id_hex or "pack_offset" not in record or content_id_hex in self.locations:
+                continue
+            pack_path = record["chunk_name"]
+            if pack_path not in existing_packs:
+                existing_packs[pack_path] = os.path.exists(pack_path)
+            if existing_packs[pack_path]:
+                self.locations[content_id_hex] = {field: record[field] for field in LOCATION_FIELDS}
+
+    @property
+    def saved_bytes(self):
+        return self.bytes - self.new_bytes
+
+    @property
+    def dedup_ratio(self):
+        return self.bytes / self.new_bytes if self.new_bytes else (1.0 if not self.bytes else float("inf"))
+
+
+def _stored_codec(location):
+    """保存場所 location のブロックのヘッダーからAADだけを読み、記録されたコーデックを返す。"""
+    with open(location["chunk_name"], "rb") as f:
+        f.seek(location.get("pack_offset", 0))
+        header = f.read(AES.block_size + 4)
+        associated_data = f.read(int.from_bytes(header[AES.block_size:], "big"))
+    return aad_field(associated_data, b"codec")
+
+
+def plan_content_file(file_path, output_dir, st, scanned, hash_key=None, storage=None):
+    """
+    CDCで分割したファイル (scanned = [(offset, length, content_id), ...]) の暗号化ジョブを計画する。
+    チャンクのオブジェクト名はコンテンツIDそのもの。
+    """
+    if storage is None:
+        storage = LocalStorage(output_dir)
+    base_db = file_base_record(file_path, output_dir, st, hash_key)
+    base_db["kdf"]=KDF_CONTENT
+    chunks = []
+    for chunk_index, (offset, length, content_id_hex) in enumerate(scanned):
+        chunks.append((chunk_index, offset, length, storage.prepare(shard_key(f"{content_id_hex}.enc")), content_id_hex))
+    return base_db, chunks
+
+
+class _InlineExecutor:
+    """jobs=1 用。submit したその場で実行する (並列時と同じコードで直列に処理するため)。"""
+    def submit(self, fn, *args):
+        future = concurrent.futures.Future()
+        try:
+            future.set_result(fn(*args))
+        except BaseException as e:
+            future.set_exception(e)
+        return future
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        return False
+
+
+def _make_executor(jobs, executor):
+    if executor == "pipeline":
+        return ChunkPipeline(jobs)
+    if jobs <= 1:
+        return _InlineExecutor()
+    if executor == "process":
+        return concurrent.futures.ProcessPoolExecutor(max_workers=jobs)
+    if executor == "thread":
+        return concurrent.futures.ThreadPoolExecutor(max_workers=jobs)
+    raise ValueError(f"不明な executor です: {executor}")
+
+
+def _make_scan_executor(jobs, executor, cdc_params):
+    """
+    CDCの分割 (cdc.scan_file) 用の executor。分割は GIL を持ったまま計算するので、スレッドではなく
+    jobs 個のプロセスで行う。暗号化の executor がプロセスプールならそれを使うので、with で None になる。
+    プロセスはスレッドを起動済みのこのプロセスからではなく、forkserver から作る。
+    """
+    if cdc_params is None or (executor == "process" and jobs > 1):
+        return contextlib.nullcontext()
+    return concurrent.futures.ProcessPoolExecutor(max_workers=max(jobs, 1),
+                                                  mp_context=multiprocessing.get_context("forkserver"))
+
+
+def _path_and_stat(item):
+    """paths の要素はパス文字列か、走査時に stat 済みの scanner.ScanRecord。"""
+    if isinstance(item, str):
+        return item, os.stat(item)
+    return item.path, item
+
+
+def _planned_files(pool, paths, output_dir, master_key, chunk_size, cdc_params, lookahead, hash_key, resume=None,
+                   storage=None):
+    """
+    ファイル毎の計画 (パス, レコードの共通部分, 鍵, 暗号化するチャンク, 前回の実行で書き終えたチャンクのレコード)
+    を paths の順に yield する。
+    CDCモードではファイルの分割 (ローリングハッシュ) を pool で先行して lookahead 件まで進めておく。
+    分割を _PLAN_WAIT 秒待っても終わらなければ、先に None を yield する。
+    """
+    if cdc_params is None:
+        for item in paths:
+            path, st = _path_and_stat(item)
+            prior, done = (resume or {}).get(path, (None, []))
+            if prior is None or not _resumable(prior, st):
+                prior, done = None, []
+            base_db, file_key, chunks = plan_file(path, output_dir, master_key, chunk_size, hash_key, st,
+                                                  (prior, len(done)) if done else None, storage)
+            yield path, base_db, file_key, [chunk + (None,) for chunk in chunks], done
+        return
+
+    id_key = derive_content_id_key(master_key)
+    scans = collections.deque()
+    paths = iter(paths)
+    while True:
+        for item in paths:
+            # stat は読み出しより前に取る (読み出し中に変更されても次回の差分バックアップで拾えるように)
+            path, st = _path_and_stat(item)
+            scans.append((path, st, pool.submit(cdc.scan_file, path, cdc_params, id_key)))
+            if len(scans) >= lookahead:
+                break
+        if not scans:
+            return
+        path, st, future = scans.popleft()
+        try:
+            scanned = future.result(timeout=_PLAN_WAIT)
+        except concurrent.futures.TimeoutError:
+            yield None # 分割に時間がかかっているので、待つ間に投入済みのジョブを回収してもらう
+            scanned = future.result()
+        base_db, chunks = plan_content_file(path, output_dir, st, scanned, hash_key, storage)
+        yield path, base_db, master_key, chunks, []
+
+
+def encrypt_paths(paths, output_dir, master_key, jobs=1, executor="pipeline", chunk_size=CHUNK_SIZE,
+                  cdc_params=None, index=None, hash_key=None, compression=None, compression_stats=None,
+                  packer=None, budget=None, journal=None, resume=None, metrics=None, storage=None):
+    """
+    paths の各ファイル (パス文字列か scanner.ScanRecord) を暗号化し、ファイル毎のエントリ (ファイル単位の情報と "chunks" にチャンクの
+    レコードのリスト) を yield する。空のファイルは "chunks" が空のエントリになる。
+    jobs > 1 の場合はファイルと大きなファイルのチャンクを並列に暗号化する。
+    エントリは並列度に関係なく paths の順で、チャンクは chunk_id の順で返される。
+    executor が "pipeline" の場合は読み込み・暗号化・書き出しを pipeline.ChunkPipeline で重ねて行い、
+    jobs は暗号化のスレッド数になる ("thread"/"process" は1チャンクの処理を丸ごとワーカーに任せる)。
+
+    cdc_params (cdc.CDCParams) を指定するとCDCで分割し、index (ChunkIndex) に既にあるチャンクは
+    暗号化も書き出しもせずに参照だけをレコードに残す (重複排除)。分割は executor に関係なく
+    jobs 個のワーカープロセスで行う。
+    hash_key を指定するとファイル全体の鍵付きハッシュ (content_hash) もエントリに記録する。
+    compression (compression.CompressionSettings) を指定すると暗号化の前にチャンクを圧縮し、
+    compression_stats (compression.CompressionStats) に統計を集計する。
+    packer (pack.PackWriter) を指定すると、小さなチャンクは個別のファイルではなくパックファイルに追記する。
+    budget (budget.MemoryBudget) を指定すると、チャンクのバッファ分を予約できたジョブだけを投入し、
+    予約できなければ先に投入したジョブを回収して空くのを待つ。
+    journal (journal.JournalWriter) を指定すると、回収したチャンクと完了したファイルを記録していく。
+    resume ({パス: (レコードの共通部分, 書き終えたチャンクのレコード)}、固定長の分割のみ) にあるファイルは、
+    変更されていなければ書き終えたチャンクを引き継いで続きから暗号化する。
+    metrics (metrics.Metrics) を指定すると、バイト数・チャンク数・暗号化と読み書きの時間・ファイル毎の処理時間を記録する。
+    チャンクは output_dir の ab/cd/<ハッシュ>.enc に振り分けて書く。storage (storage.LocalStorage) を渡すと、
+    作ったディレクトリをその sync (journal を使う場合はその flush) で fsync する。
+
+    いずれかのジョブが失敗した場合は残りのジョブを取り消し、この呼び出しで
+    書き出したチャンクファイルを削除してから例外を送出する。
+    マニフェストは呼び出し側が最後に書くため、既存のアーカイブは壊れない。
+    journal を指定した場合は、記録済みのチャンクとパックは消さずに残す (--resume で引き継ぐ)。
+    """
+    if cdc_params is not None and index is None:
+        index = ChunkIndex(output_dir)
+    if storage is None:
+        storage = LocalStorage(output_dir)
+    id_key = derive_content_id_key(master_key) if cdc_params is not None else None
+
+    written = []
+    pending = collections.deque()
+    try:
+        with _make_executor(jobs, executor) as pool, _make_scan_executor(jobs, executor, cdc_params) as scan_pool:
+            # 投入済みで未回収のジョブ数を制限し、メモリ使用量 (チャンク×並列数) を抑える。
+            # パイプラインはバッファの数で使用量が決まるので、3つの段が埋まるだけ流しておく
+            if isinstance(pool, ChunkPipeline):
+                max_inflight = pool.depth * 3
+            else:
+                max_inflight = max(jobs, 1) * 2
+            collected = []
+            try:
+                planned = _planned_files(scan_pool or pool, paths, output_dir, master_key, chunk_size, cdc_params, max_inflight,
+                                         hash_key, resume, storage)
+                for plan in planned:
+                    if plan is None:
+                        # 次の計画を待つ間に、投入済みのジョブを全て回収して記録しておく
+                        while pending:
+                            entry = _advance(pending, collected, index, packer, compression_stats, budget, journal, metrics)
+                            if entry is not None:
+                                yield entry
+                        if journal is not None:
+                            if packer is not None:
+                                packer.sync()
+                            journal.flush()
+                        continue
+                    path, base_db, file_key, chunks, done = plan
+                    file_started = time.monotonic()
+                    pending.append((_FILE_BEGIN, base_db))
+                    pending.extend((_RESUMED, chunkdb) for chunkdb in done)
+                    for chunk_index, offset, length, chunk_filename, content_id_hex in chunks:
+                        if packer is not None and packer.accepts(length):
+                            chunk_filename = None
+                        if content_id_hex is None:
+                            job = ChunkJob(
+                                path, offset, length, derive_chunk_key(file_key, chunk_index), chunk_index,
+                                None, None, chunk_filename, compression)
+                        elif index.claim(content_id_hex, length):
+                            # 分割後にファイルが書き換えられていないか、読み直した内容のコンテンツIDで確認する
+                            job = ChunkJob(
+                                path, offset, length, derive_content_key(master_key, content_id_hex), chunk_index,
+                                content_id_hex, id_key, chunk_filename, compression)
+                        else:
+                            job = None # 既に出力先にあるチャンクは参照するだけ
+                        future = None
+                        cost = 0
+                        if job is not None:
+                            if budget is not None:
+                                cost = chunk_cost(length, compression, chunk_filename is None)
+                                while pending and not budget.try_acquire(cost):
+                                    entry = _advance(pending, collected, index, packer, compression_stats, budget, journal, metrics)
+                                    if entry is not None:
+                                        yield entry
+                                if not pending:
+                                    budget.acquire(cost)
+                            future = pool.submit(encrypt_job, job)
+                            if chunk_filename is not None:
+                                written.append(chunk_filename)
+                        pending.append((future, chunk_index, chunk_filename, offset, length, content_id_hex, cost))
+                        while len(pending) >= max_inflight:
+                            entry = _advance(pending, collected, index, packer, compression_stats, budget, journal, metrics)
+                            if entry is not None:
+                                yield entry
+                    pending.append((_FILE_END, base_db, file_started))
+                while pending:
+                    entry = _advance(pending, collected, index, packer, compression_stats, budget, journal, metrics)
+                    if entry is not None:
+                        yield entry
+                if packer is not None:
+                    packer.close()
+                if journal is not None:
+                    journal.flush()
+            except BaseException:
+                for future, *_ in pending:
+                    if isinstance(future, concurrent.futures.Future):
+                        future.cancel()
+                raise
+    except BaseException:
+        if journal is not None:
+            # 回収済みのチャンクを記録して残し、記録されないチャンク (回収前のジョブの分) だけを消す
+            if packer is not None:
+                packer.sync()
+            journal.flush()
+            written = [item[2] for item in pending if isinstance(item[0], concurrent.futures.Future) and item[2]]
+        elif packer is not None:
+            packer.abort()
+        for chunk_filename in written:
+            for leftover in (chunk_filename, chunk_filename + ".tmp"):
+                try:
+                    os.remove(leftover)
+                except OSError:
+                    pass
+        raise
+
+
+def _advance(pending, collected, index=None, packer=None, compression_stats=None, budget=None, journal=None,
+             metrics=None):
+    """
+    pending の先頭を1つ回収する。チャンクのレコードは collected に溜め、
+    ファイルの終わりに達したらそのファイルのエントリを返す (それ以外は None)。
+    journal があれば回収したものを記録し、まとめて書く時期ならパックとジャーナルを fsync する。
+    metrics があれば回収したチャンクと完了したファイルを計測に加える。
+    """
+    item = pending.popleft()
+    entry = None
+    if item[0] is _FILE_BEGIN:
+        if journal is not None:
+            journal.begin(item[1])
+    elif item[0] is _FILE_END:
+        entry = item[1].copy()
+        entry["chunks"] = list(collected)
+        collected.clear()
+        if journal is not None:
+            journal.end(entry)
+        if metrics is not None:
+            metrics.add("files")
+            metrics.observe("file_latency", time.monotonic() - item[2])
+    elif item[0] is _RESUMED:
+        collected.append(item[1])
+        if metrics is not None:
+            metrics.add("bytes_processed", item[1]["size"])
+        if journal is not None:
+            journal.chunk(item[1], written=False)
+    else:
+        chunkdb = _collect(item, index, packer, compression_stats, metrics)
+        collected.append(chunkdb)
+        if budget is not None and item[-1]:
+            budget.release(item[-1])
+        if journal is not None:
+            journal.chunk(chunkdb, written=item[0] is not None)
+    if journal is not None and journal.due():
+        if packer is not None:
+            packer.sync()
+        journal.flush()
+    return entry
+
+
+def _collect(pending_item, index=None, packer=None, compression_stats=None, metrics=None):
+    """
+    ジョブの結果を回収してチャンクのレコードを作る。投入順に呼ばれるので、パックへの追記順も
+    重複排除で参照する側より参照される側が先になることも並列度に関係なく決まる。
+    """
+    future, chunk_index, chunk_filename, offset, length, content_id_hex, _cost = pending_item
+    if future is None:
+        # 重複排除で参照だけしたチャンク。コーデックは参照先のチャンクのものを記録する
+        chunkdb = _chunk_record(chunk_index, index.locate(content_id_hex), offset, length)
+        codec = index.codec(content_id_hex)
+        if codec is not None:
+            chunkdb["codec"] = codec
+        if metrics is not None:
+            metrics.add("chunks_deduplicated")
+            metrics.add("bytes_processed", length)
+    else:
+        result = future.result()
+        if metrics is not None:
+            _record_chunk(metrics, result)
+        if result.blob is not None:
+            started = time.perf_counter()
+            location = packer.append(result.blob)
+            if metrics is not None:
+                metrics.add_time("io_wait", time.perf_counter() - started, count=0)
+        else:
+            location = {"chunk_name": chunk_filename}
+        # 試して圧縮しなかったチャンク (CODEC_NONE) は、圧縮を使わない場合と同じくコーデックを記録しない
+        codec = None if result.codec == CODEC_NONE else result.codec
+        if content_id_hex is not None:
+            index.record_location(content_id_hex, location, codec)
+        chunkdb = _chunk_record(chunk_index, location, offset, result.size)
+        if codec is not None:
+            chunkdb["codec"] = codec
+        if result.codec is not None and compression_stats is not None:
+            compression_stats.add(result.size, result.stored_size, result.codec, result.compress_seconds)
+    if content_id_hex is not None:
+        chunkdb["cas"] = content_id_hex
+    return chunkdb
+
+
+def _record_chunk(metrics, result):
+    """暗号化したチャンク1つ分の結果 (pipeline.ChunkResult) を計測に加える。"""
+    metrics.add("chunks")
+    metrics.add("bytes_processed", result.size)
+    metrics.add("bytes_read", result.size)
+    metrics.add("bytes_written", result.block_size)
+    metrics.add_time("io_wait", result.read_seconds + result.write_seconds)
+    metrics.add_time("cipher", result.cipher_seconds)
+    if result.compress_seconds:
+        metrics.add_time("compress", result.compress_seconds)
+
+
+def _chunk_record(chunk_index, location, offset, size):
+    chunkdb={}
+    chunkdb["chunk_id"]=chunk_index
+    chunkdb.update(location)
+    chunkdb["offset"]=offset
+    chunkdb["size"]=size
+    return chunkdb
@@ -0,0 +1,421 @@
+"""
+暗号化の進捗ジャーナル (--resume)。
+
+マニフェスト (masterkey.enc) は全ファイルの処理が終わってから確定するので、途中で強制終了・クラッシュすると
+それまでに書いたチャンクはどこからも参照されなくなる。暗号化の実行中は出力ディレクトリの masterkey.journal に
+書き終えたチャンクと完了したファイルを追記していき、--resume で再実行したときは完了済みのファイルを
+引き継ぎ、途中までのファイルは書き終えたチャンクの次から暗号化してマニフェストを完成させる。
+
+形式:
+    MAGIC (8) | マスターソルト (16) | レコード | レコード | ...
+    レコード: 長さ (4, ビッグエンディアン) | 暗号化したブロック (AES256GCM.encrypt_chunk_with_aad と同じ形式)
+ブロックの中身は JSON で、AADはファイル先頭からの通し番号 (journal:<番号>) なので、レコードの入れ替えや
+途中の削除は復号時に検出できる。末尾の書きかけのレコードは無視する。
+マスターソルトは scrypt より前に必要なので平文で持つ (マスターパスワードが無ければ意味を持たない)。
+
+レコードの種類 ("t"):
+    run    実行 (セクション) の開始。"o" にチャンクの分割方法などのオプション
+    begin  ファイルの開始。"e" にファイル単位の情報 (チャンクを除いたエントリ)
+    chunk  書き終えたチャンク。"c" にチャンクのレコード
+    end    ファイルの完了
+    file   完了したファイルのエントリ全体 (begin〜end をまとめて書けた場合)
+1つのセクションの中ではファイルは path_sort_key の順に並び、1ファイルのレコードは連続する。
+再開するたびに新しいセクションを追記する (前のセクションは書き換えない)。
+
+レコードはメモリに溜めて一定件数・一定時間ごとにまとめて書き、その前に記録するチャンクのファイル
+(パックは PackWriter.sync) と出力ディレクトリを fsync するので、記録されたチャンクはクラッシュ後もディスクにある。
+"""
+import collections
+import heapq
+import json
+import os
+import struct
+import time
+
+from AES256GCM import *
+from engine import BLOCK_OVERHEAD, expected_block_length
+from manifest import entry_key, path_sort_key
+from storage import LocalStorage
+
+MAGIC = b"PCDJRNL1"
+_LENGTH = struct.Struct(">I")
+_HEADER_SIZE = len(MAGIC) + AES.block_size
+
+SYNC_RECORDS = 1024
+SYNC_INTERVAL = 1.0
+
+
+def derive_journal_key(master_key):
+    """ジャーナルのレコード用の鍵を導出する。"""
+    return derive_subkey(master_key, b"", b"pycryptodrive:journal")
+
+
+def _record_aad(sequence):
+    return b"journal:" + str(sequence).encode()
+
+
+def read_salt(path):
+    """ジャーナルのヘッダーからマスターソルトを読む。ジャーナルでなければ None。"""
+    with open(path, "rb") as f:
+        header = f.read(_HEADER_SIZE)
+    if len(header) < _HEADER_SIZE or not header.startswith(MAGIC):
+        return None
+    return header[len(MAGIC):]
+
+
+class JournalWriter:
+    """
+    ジャーナルに追記する。begin/chunk/end はメインスレッドから処理順に呼ぶ。
+    resume_from (JournalReader) を渡すと、その有効な末尾から新しいセクションを追記する
+    (書きかけのレコードは切り捨てる)。渡さなければ新しいジャーナルを作る。
+    storage (storage.LocalStorage、ジャーナルを置く出力ディレクトリのもの) を渡すと、書き込みの前に
+    その sync で記録するチャンクと、チャンク用に作ったディレクトリをまとめて fsync する。
+    """
+    def __init__(self, path, master_key, salt, options, resume_from=None,
+                 sync_records=SYNC_RECORDS, sync_interval=SYNC_INTERVAL, storage=None):
+        self.path = path
+        self.storage = storage or LocalStorage(os.path.dirname(os.path.abspath(path)))
+        self.sync_records = sync_records
+        self.sync_interval = sync_interval
+        self._key = derive_journal_key(master_key)
+        if resume_from is None:
+            self._file = open(path, "wb")
+            self._file.write(MAGIC + salt)
+            self._sequence = 0
+        else:
+            self._file = open(path, "r+b")
+            self._file.truncate(resume_from.end)
+            self._file.seek(resume_from.end)
+            self._sequence = resume_from.records
+        self._pending = []
+        self._current = None # 処理中のファイルの begin がまだ _pending にあれば、その位置
+        self._last_sync = time.monotonic()
+        self._append({"t": "run", "o": options, "s": time.time_ns()})
+        self.flush()
+
+    def _append(self, record):
+        data = json.dumps(record, separators=(",", ":")).encode()
+        block = encrypt_chunk_with_aad(data, self._key, _record_aad(self._sequence))
+        self._sequence += 1
+        self._pending.append(_LENGTH.pack(len(block)) + block)
+
+    def begin(self, base_db):
+        self._current = len(self._pending)
+        self._append({"t": "begin", "e": base_db})
+
+    def chunk(self, chunkdb, written=True):
+        """書き終えたチャンクを記録する。written ならこの実行で書いたので、次の書き込みの前に fsync する。"""
+        if written and "pack_offset" not in chunkdb:
+            self.storage.note(chunkdb["chunk_name"])
+        self._append({"t": "chunk", "c": chunkdb})
+
+    def end(self, entry):
+        if self._current is not None:
+            # begin からまだ書いていなければ、エントリ全体の1レコードにまとめる
+            self._sequence -= len(self._pending) - self._current
+            del self._pending[self._current:]
+            self._append({"t": "file", "e": entry})
+        else:
+            self._append({"t": "end"})
+        self._current = None
+
+    def due(self):
+        """まとめて書く時期なら True。"""
+        return bool(self._pending) and (len(self._pending) >= self.sync_records or
+                                        time.monotonic() - self._last_sync >= self.sync_interval)
+
+    def flush(self):
+        """
+        溜めたレコードを書いて fsync する。その前に記録するチャンクのファイルと出力ディレクトリを fsync する
+        (パックに入れたチャンクは、呼び出し側が先に PackWriter.sync を呼ぶこと)。
+        """
+        if self._pending:
+            # チャンクとそのディレクトリをディレクトリ毎に1回ずつ fsync する。確定したパックのリネームも
+            # 残るように、出力ディレクトリ (storage の root) は毎回 fsync される
+            self.storage.sync()
+            self._file.write(b"".join(self._pending))
+            self._file.flush()
+            os.fsync(self._file.fileno())
+            self._pending.clear()
+            self._current = None
+        self._last_sync = time.monotonic()
+
+    def close(self):
+        """溜めたレコードを書いて閉じる (ジャーナルは残すので --resume で再開できる)。"""
+        if self._file is not None:
+            self.flush()
+            self._file.close()
+            self._file = None
+
+    def remove(self):
+        """マニフェストが確定した後に、ジャーナルを削除する。"""
+        if self._file is not None:
+            self._file.close()
+            self._file = None
+        os.remove(self.path)
+
+
+# 1ファイル分のレコード。section は何番目のセクションか、complete は end まで記録されているか
+_Group = collections.namedtuple("_Group", ["base_db", "chunks", "complete", "section"])
+
+
+class JournalReader:
+    """
+    ジャーナルを読む。最初に全体を一度読んで、有効なレコードの末尾 (end) と数 (records)、
+    各セクションの範囲とオプション、最初の実行の開始時刻 (started_ns) を調べる。
+    復号できないレコード以降は書きかけとみなす。
+    先頭のレコードも復号できなければ (パスワードが違う) ValueError。
+    """
+    def __init__(self, path, master_key):
+        self.path = path
+        self._key = derive_journal_key(master_key)
+        self.sections = [] # (開始位置, 終了位置, 最初のレコードの番号, オプション)
+        self.records = 0
+        self.end = _HEADER_SIZE
+        self.started_ns = None
+        start = None
+        for offset, next_offset, record in self._records(_HEADER_SIZE, None, 0):
+            if record["t"] == "run":
+                if start is not None:
+                    self.sections.append((start[0], offset, start[1], start[2]))
+                start = (offset, self.records, record["o"])
+                if self.started_ns is None:
+                    self.started_ns = record["s"]
+            self.records += 1
+            self.end = next_offset
+        if start is None:
+            raise ValueError("ジャーナルを復号できません。マスターパスワードが異なるか、ジャーナルが壊れています。")
+        self.sections.append((start[0], self.end, start[1], start[2]))
+
+    def _records(self, offset, end, sequence):
+        """offset から (位置, 次の位置, レコード) を順に返す。end (None なら末尾) か復号できないレコードで止まる。"""
+        with open(self.path, "rb") as f:
+            f.seek(offset)
+            while end is None or offset < end:
+                length = f.read(_LENGTH.size)
+                if len(length) < _LENGTH.size:
+                    return
+                (size,) = _LENGTH.unpack(length)
+                block = f.read(size)
+                if len(block) < size:
+                    return
+                try:
+                    data, aad = decrypt_chunk(block, self._key)
+                except ValueError:
+                    return
+                if aad != _record_aad(sequence):
+                    return
+                next_offset = offset + _LENGTH.size + size
+                yield offset, next_offset, json.loads(bytes(data))
+                offset = next_offset
+                sequence += 1
+
+    def groups(self, section):
+        """セクション section のファイル毎のレコードを _Group として順に返す。"""
+        start, end, sequence, _options = self.sections[section]
+        current = None
+        for _offset, _next, record in self._records(start, end, sequence):
+            kind = record["t"]
+            if kind == "file":
+                entry = record["e"]
+                yield _Group({k: v for k, v in entry.items() if k != "chunks"}, entry.get("chunks", []), True, section)
+            elif kind == "begin":
+                if current is not None:
+                    yield current
+                current = _Group(record["e"], [], False, section)
+            elif kind == "chunk" and current is not None:
+                current.chunks.append(record["c"])
+            elif kind == "end" and current is not None:
+                yield current._replace(complete=True)
+                current = None
+        if current is not None:
+            yield current
+
+    def options(self, section):
+        return self.sections[section][3]
+
+
+class Recovery:
+    """
+    ジャーナルから再開に使える情報を求める。作るときに一度だけ全体を調べて、
+    * 書きかけのパック (.pack.tmp) は記録されている範囲の終わりで切り詰めて確定し、
+    * 書きかけのチャンク (.enc.tmp) と、中断した実行が書いたがジャーナルに記録される前だったチャンクと
+      パック (最初の実行の開始より後に作られて、記録されていないもの) を削除し、
+    * 各セクションの最後に記録したチャンク (クラッシュの直前に書いたもの) は
+      check_chunk(ファイル単位の情報, チャンクのレコード) で復号して確かめる (False か例外なら使わない)。
+    完了済みでチャンクが全て揃っているファイルのエントリは、イテレートすると path_sort_key の順に返す
+    (何度でも読める)。同じファイルが複数のセクションにあれば最後のものを使う。
+    途中までのファイルは partial ({パス: (ファイル単位の情報, 書き終えたチャンクのレコード, オプション)})。
+    """
+    def __init__(self, reader, output_dir, check_chunk=None):
+        self.reader = reader
+        self.output_dir = output_dir
+        self.storage = LocalStorage(output_dir)
+        self.partial = {}
+        self.complete = 0
+        self.chunks = 0
+        self.removed = 0
+        self._referenced = set()
+        self._bad = set()
+        self._pack_ends = {}
+        self._pack_sizes = {}
+        self._sizes = {}
+
+        if check_chunk is not None:
+            for section in range(len(reader.sections)):
+                last = None
+                for group in reader.groups(section):
+                    if group.chunks:
+                        last = (group.base_db, group.chunks[-1])
+                if last is not None and not self._check(check_chunk, *last):
+                    self._bad.add(self._location(last[1]))
+                    if "pack_offset" not in last[1]:
+                        # 壊れたチャンクが重複排除の索引に拾われないように消しておく
+                        try:
+                            os.remove(last[1]["chunk_name"])
+                        except OSError:
+                            pass
+                        self._sizes.pop(last[1]["chunk_name"], None)
+
+        for group in self._latest():
+            chunks = self._usable_chunks(group)
+            if group.complete and len(chunks) == len(group.chunks):
+                self.complete += 1
+            else:
+                path = entry_key(group.base_db)
+                self.partial[path] = (group.base_db, chunks, reader.options(group.section))
+            self.chunks += len(chunks)
+            for chunk in chunks:
+                self._referenced.add(os.path.basename(chunk["chunk_name"]))
+                if "pack_offset" in chunk and not self._exists(chunk["chunk_name"]):
+                    end = chunk["pack_offset"] + chunk["pack_length"]
+                    self._pack_ends[chunk["chunk_name"]] = max(self._pack_ends.get(chunk["chunk_name"], 0), end)
+        self._finish_packs()
+        self._remove_leftovers()
+
+    def _check(self, check_chunk, base_db, chunk):
+        if "pack_offset" in chunk and not self._exists(chunk["chunk_name"]):
+            chunk = dict(chunk, chunk_name=chunk["chunk_name"] + ".tmp") # 確定前のパック
+        try:
+            return check_chunk(base_db, chunk)
+        except (OSError, ValueError):
+            return False
+
+    @staticmethod
+    def _location(chunk):
+        return chunk["chunk_name"], chunk.get("pack_offset")
+
+    def _size(self, path):
+        if path not in self._sizes:
+            try:
+                self._sizes[path] = os.stat(path).st_size
+            except FileNotFoundError:
+                self._sizes[path] = None
+        return self._sizes[path]
+
+    def _exists(self, path):
+        return self._size(path) is not None
+
+    def _present(self, base_db, chunk):
+        """記録されたチャンクがディスクに揃っているか (大きさまで確かめる)。"""
+        if self._location(chunk) in self._bad:
+            return False
+        if "pack_offset" in chunk:
+            size = self._size(chunk["chunk_name"])
+            if size is None:
+                size = self._size(chunk["chunk_name"] + ".tmp") # 確定前のパック
+            return size is not None and size >= chunk["pack_offset"] + chunk["pack_length"]
+        size = self._size(chunk["chunk_name"])
+        expected = expected_block_length(base_db, chunk)
+        return size is not None and (size == expected if expected is not None else size >= BLOCK_OVERHEAD)
+
+    def _usable_chunks(self, group):
+        """チャンク番号の順に、先頭から揃っている分だけを返す。"""
+        usable = []
+        for chunk in sorted(group.chunks, key=lambda c: c["chunk_id"]):
+            if chunk["chunk_id"] != len(usable) or not self._present(group.base_db, chunk):
+                break
+            usable.append(chunk)
+        return usable
+
+    def _latest(self):
+        """全セクションのファイルをパス順に、同じパスは最後のセクションのものだけを返す。"""
+        sections = [self.reader.groups(section) for section in range(len(self.reader.sections))]
+        merged = heapq.merge(*sections, key=lambda group: (path_sort_key(entry_key(group.base_db)), group.section))
+        previous = None
+        for group in merged:
+            if previous is not None and entry_key(previous.base_db) != entry_key(group.base_db):
+                yield previous
+            previous = group
+        if previous is not None:
+            yield previous
+
+    def _finish_packs(self):
+        """書きかけのパックを、記録された範囲で切り詰めて確定する。"""
+        for pack_path, end in self._pack_ends.items():
+            with open(pack_path + ".tmp", "r+b") as f:
+                f.truncate(end)
+                f.flush()
+                os.fsync(f.fileno())
+            os.replace(pack_path + ".tmp", pack_path)
+            self._sizes[pack_path] = end
+
+    def _remove_leftovers(self):
+        """
+        中断した実行の書きかけのファイルと、記録されなかったチャンク・パックを削除する。
+        開始より前からあるオブジェクト (前回までのマニフェストが参照している) には触れない。
+        """
+        for item in list(self.storage.list()):
+            name = item.key.rsplit("/", 1)[-1]
+            if name.endswith(".enc.tmp") or name.endswith(".pack.tmp"):
+                leftover = True
+            elif name.endswith(".enc") or name.endswith(".pack"):
+                leftover = name not in self._referenced and item.mtime_ns >= self.reader.started_ns
+            else:
+                leftover = False
+            if leftover:
+                self.storage.delete(item.key)
+                self.removed += 1
+        self.storage.sync()
+
+    def __iter__(self):
+        for group in self._latest():
+            if not group.complete:
+                continue
+            chunks = self._usable_chunks(group)
+            if len(chunks) != len(group.chunks):
+                continue
+            entry = dict(group.base_db)
+            entry["chunks"] = chunks
+            yield entry
+
+    def resumable(self, chunk_size):
+        """
+        固定長で分割していて、今回と同じチャンクサイズのセクションで途中までになっているファイルを
+        encrypt_paths の resume に渡す形 ({パス: (ファイル単位の情報, 書き終えたチャンク)}) で返す。
+        """
+        return {path: (base_db, chunks) for path, (base_db, chunks, options) in self.partial.items()
+                if options.get("chunking") == "fixed" and options.get("chunk_size") == chunk_size and chunks}
+
+    def overlay(self, prior_entries):
+        """前回のマニフェストのエントリに、ジャーナルの完了済みのエントリを重ねたもの (同じパスはジャーナル優先)。"""
+        return _Overlay(prior_entries, self)
+
+
+class _Overlay:
+    """2つの path_sort_key 順のエントリの列を1つにする (何度でも読める)。"""
+    def __init__(self, older, newer):
+        self.older = older
+        self.newer = newer
+
+    def __iter__(self):
+        tagged = heapq.merge(((path_sort_key(entry_key(e)), 0, e) for e in self.older),
+                             ((path_sort_key(entry_key(e)), 1, e) for e in self.newer),
+                             key=lambda item: item[:2])
+        previous = None
+        for item in tagged:
+            if previous is not None and previous[0] != item[0]:
+                yield previous[2]
+            previous = item
+        if previous is not None:
+            yield previous[2]
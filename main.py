@@ -1,358 +1,1176 @@
 #from pipeline import Pipe as pp
 import os
 from AES256GCM import *
-import hashlib
-import io
-import zipfile
-import json
-import gen_rndstring
+from engine import CHUNK_SIZE, ChunkIndex, encrypt_paths, file_content_hash
+from budget import BASE_OVERHEAD, MemoryBudget, plan_encrypt, plan_restore, restore_cost, scrypt_bytes
+import cdc
+import compression
+from pack import DEFAULT_PACK_SIZE, PackWriter
+from journal import JournalReader, JournalWriter, Recovery, read_salt
+from metrics import PROFILE_MODES, JSONLinesSink, Metrics, PrometheusSink, Profiler, ProgressSink, timed
+from manifest import ManifestWriter, PathFilter, entry_key, open_manifest, path_sort_key
+from storage import LocalStorage, is_remote, object_key, open_storage
+import scanner
 import sys
+import zlib
+import lzma
+import argparse
+import atexit
+import threading
+import time
+import concurrent.futures
+import resource
+import tempfile
 
-def compress(binary_data):
-    # メモリ上のバッファを作成
-    zip_buffer = io.BytesIO()
+##暗号化部分
+def encrypt(file_path,output_dir,key):
+    """
+    ファイルをチャンクに分割して暗号化し、マニフェストのエントリを返す。
+    key はマスター鍵 (実行ごとに一度だけscryptで導出したもの)。
+    ファイル鍵・チャンク鍵はHKDFで導出するため、ファイル毎のscryptは行わない。
+    """
+    # ジェネレータを最後まで回す (途中で止めると失敗とみなされ、書いたチャンクが削除される)
+    entry, = encrypt_paths([file_path], output_dir, key)
+    return entry
 
-    with zipfile.ZipFile(zip_buffer, 'w', zipfile.ZIP_DEFLATED) as zf:
-        # "file.bin"という名前でバイナリデータを書き込む
-        zf.writestr("file.bin", binary_data)
 
-    # ZIPデータはzip_buffer.getvalue()で取得できる
-    result_zip_data = zip_buffer.getvalue()
-    return result_zip_data
-def traverse_iterative(start_paths=[os.getcwd()]):
+###復号
+def resolve_file_key(record, master_key):
     """
-    ディレクトリを再帰的に走査し、ファイルとディレクトリのパスをyieldします。
-    非再帰的なアプローチ（スタックを使用）なので、RecursionErrorの心配がありません。
+    レコードからファイル鍵を求める。(ファイル鍵, チャンク毎サブ鍵を使うか) を返す。
+    旧形式 (ファイル毎にpasswordとbase_saltを持つ) はscryptで導出する。
     """
-    # 探索対象のパスを保持するスタック（リスト）
-    # 初期値として、指定された開始パスを追加
-    # os.curdir は '.' を意味します
-    stack = [os.path.abspath(p) for p in start_paths] # 絶対パスに変換すると安全
+    if record.get("kdf") == KDF_HKDF:
+        return derive_file_key(master_key, bytes.fromhex(record["key_salt"])), True
+    if record.get("kdf") == KDF_CONTENT:
+        # 重複排除チャンクの鍵はマスター鍵とコンテンツIDから導出する
+        return master_key, True
+    #旧形式: ファイル毎のscrypt
+    return derive_key(record["password"], bytes.fromhex(record["base_salt"])), False
 
-    while stack:
-        current_path = stack.pop() # スタックから一つパスを取り出す
+def read_chunk_into(chunk_filename, buffer, offset=0, length=None, storage=None):
+    """
+    暗号化チャンクファイルを buffer (bytearray) に readinto で読み込み、中身の memoryview を返す。
+    buffer はチャンクより小さければ拡張されるので、同じバッファを使い回せる。
+    パックファイルに入っているチャンクは offset と length を指定して位置指定で読み込む。
+    storage (storage.S3Storage など) を指定すると、chunk_filename をそのキーとして保存先から読む。
+    """
+    if storage is not None:
+        return storage.read_into(chunk_filename, buffer, offset, length)
+    with open(chunk_filename, 'rb', buffering=0) as f_chunk:
+        size = os.fstat(f_chunk.fileno()).st_size if length is None else length
+        if len(buffer) < size:
+            buffer.extend(bytes(size - len(buffer)))
+        view = memoryview(buffer)[:size]
+        read = 0
+        while read < size:
+            n = os.preadv(f_chunk.fileno(), [view[read:]], offset + read)
+            if not n:
+                break
+            read += n
+    return view[:read]
 
-        if not os.path.exists(current_path):
-            continue # パスが存在しない場合はスキップ
+# 暗号文・平文のバッファはスレッド毎に1組だけ持ち、チャンク間で使い回す
+_chunk_buffers = threading.local()
 
-        if os.path.isdir(current_path):
-            yield current_path # ディレクトリ自体をyield
+class ChunkAADError(ValueError):
+    """GCMの検証は通ったが、AADが別のチャンク (別の番号・別のコンテンツ) のものだった。"""
 
-            try:
-                # ディレクトリ内のエントリを逆順でスタックに追加
-                # これにより、スタックから取り出すときに「正しい順序」になる
-                for entry_name in reversed(os.listdir(current_path)):
-                    full_path = os.path.join(current_path, entry_name)
-                    stack.append(full_path)
-            except OSError:
-                # 権限エラーなど
-                pass
+def decrypt_chunk_file(line, file_key, per_chunk_keys=False, metrics=None, storage=None):
+    """
+    チャンクファイルを1つ読み込んで復号・検証し、平文の memoryview を返す。
+    返り値は呼び出したスレッドのバッファ上にあるので、次のチャンクを復号する前に使い終えること。
+    復号・検証に失敗した場合は ValueError (AADが期待値と異なる場合は ChunkAADError) を送出する。
+    metrics (metrics.Metrics) を指定すると、読み込み・復号・展開の時間とバイト数を記録する。
+    storage を指定すると、チャンクをファイルではなくその保存先から読む (read_chunk_into を参照)。
+    """
+    if not hasattr(_chunk_buffers, "encrypted"):
+        _chunk_buffers.encrypted = bytearray()
+        _chunk_buffers.plain = bytearray()
+    try:
+        return _decrypt_chunk_into(line, file_key, per_chunk_keys, _chunk_buffers.encrypted, _chunk_buffers.plain,
+                                   metrics, storage)
+    except BaseException:
+        # 例外のトレースバックがバッファの memoryview を掴んだままになる (サイズを変えられない) ので作り直す
+        _chunk_buffers.encrypted = bytearray()
+        _chunk_buffers.plain = bytearray()
+        raise
+
+def _decrypt_chunk_into(line, file_key, per_chunk_keys, encrypted_buffer, plain_buffer, metrics=None, storage=None):
+    i=line["chunk_id"]
+    chunk_filename=line["chunk_name"]
+    content_id_hex=line.get("cas")
+    try:
+        with timed(metrics, "io_wait"):
+            encrypted_data_block = read_chunk_into(chunk_filename, encrypted_buffer,
+                                                   line.get("pack_offset", 0), line.get("pack_length"), storage)
+        if len(plain_buffer) < len(encrypted_data_block):
+            plain_buffer.extend(bytes(len(encrypted_data_block) - len(plain_buffer)))
+
+        if content_id_hex:
+            chunk_key = derive_content_key(file_key, content_id_hex)
         else:
-            yield current_path # ファイルをyield
-def compute_sha256(text: str) -> str:
-    # 文字列をUTF-8にエンコードしてSHA-256ハッシュ値を計算
-    return hashlib.sha256(text).hexdigest()
+            chunk_key = derive_chunk_key(file_key, i) if per_chunk_keys else file_key
+        with timed(metrics, "cipher"):
+            decrypted_chunk, aad_from_chunk = decrypt_chunk(encrypted_data_block, chunk_key, output=plain_buffer)
+        # 圧縮されたチャンクはAADにコーデックが記録されている (圧縮・非圧縮のチャンクが混在してよい)
+        codec = aad_field(aad_from_chunk, b"codec")
+        if codec is not None:
+            with timed(metrics, "compress"):
+                decrypted_chunk = compression.decompress_chunk(decrypted_chunk, codec)
+    except ValueError as e:
+        raise ValueError(f"チャンク {i} の復号に失敗しました: {e}")
+    except (zlib.error, lzma.LZMAError) as e:
+        raise ValueError(f"チャンク {i} の展開に失敗しました: {e}")
 
-def jsonl_write(line,fname="dirinfo.json"):
-    with open(fname,"a") as h:
-        h.write(json.dumps(line)+"\n")
+    # AADからチャンクインデックスを検証する (同じ鍵で暗号化された別のチャンクとの入れ替えを検出する)
+    # 重複排除チャンクは複数ファイルで共有されるので、コンテンツIDで検証する
+    if content_id_hex:
+        expected = (b"content_id", content_id_hex)
+    else:
+        expected = (b"chunk_index", str(i))
+    if aad_field(aad_from_chunk, expected[0]) != expected[1]:
+        raise ChunkAADError(f"チャンク {i} のAADが期待値と異なります。改ざんまたは入れ替えの可能性があります。")
+    if metrics is not None:
+        metrics.add("chunks")
+        metrics.add("bytes_read", len(encrypted_data_block))
+    return decrypted_chunk
 
+def is_positioned(chunk_list):
+    """新形式のレコードは平文のオフセットとサイズを持つので、位置指定で (並列に) 書き込める。"""
+    return all("offset" in line and "size" in line for line in chunk_list)
 
+def open_partial(decrypted_file_path, chunk_list):
+    """復元先の一時ファイル (.partial) を作り、サイズが分かっていれば領域を確保して fd を返す。"""
+    tmp_file_path = decrypted_file_path + ".partial"
+    fd = os.open(tmp_file_path, os.O_WRONLY | os.O_CREAT | os.O_TRUNC, 0o600)
+    if is_positioned(chunk_list) and chunk_list:
+        try:
+            preallocate(fd, max(line["offset"] + line["size"] for line in chunk_list))
+        except BaseException:
+            os.close(fd)
+            os.remove(tmp_file_path)
+            raise
+    return fd
 
-##暗号化部分
-def encrypt(file_path,output_dir,password,master_mode=False):
-    base_db={}
-    filepath=file_path.split("/")
-    filename=filepath[-1]
-    base_db["name"]=filename
-    base_db["path"]=filepath[:-1]
-    base_db["chunkpath"]=output_dir
-    chunkrnd=os.urandom(16)
-    chunkbase=compute_sha256(chunkrnd+filename.encode("utf-8")+chunkrnd)
-    
-    #ソルトはbasekeyの生成に必要なのでパスワードと一緒に保存する必要がある
-    base_salt = get_random_bytes(AES.block_size)
-    base_db["base_salt"]=base_salt.hex()
-    base_key = derive_key(password, base_salt)
-    chunk_size = 1024*1024*50 # 50MB ごとのチャンク
-    encrypted_chunk_filenames = []
-    chunk_index = 0
-
-    with open(file_path, 'rb') as f_orig:
-        
-        while True:
-            
-            chunk = f_orig.read(chunk_size)
-            #ここで先にzip圧縮を追加する
-            #hashのチェック追加(同一なら処理を回避できるし改ざんされてないかのチェックもできる？)
-            if not chunk:
-                break
-            
-            encrypted_data_block = encrypt_chunk(chunk, base_key, chunk_index, file_path)
-            
-            # 各チャンクを独立したファイルとして保存
-            nfname=f"{chunkbase}_{chunk_index:05d}"
-            fname=compute_sha256(nfname.encode("utf-8"))
-            if master_mode:
-                fname="masterkey"
-            chunk_filename = os.path.join(output_dir, f"{fname}.enc")
-            with open(chunk_filename, 'wb') as f_chunk:
-                f_chunk.write(encrypted_data_block)
-            if master_mode:
-                return base_salt.hex()
+def close_partial(fd, decrypted_file_path, ok):
+    """一時ファイルを閉じ、全チャンクが検証済み (ok) ならリネーム、そうでなければ削除する。"""
+    tmp_file_path = decrypted_file_path + ".partial"
+    os.close(fd)
+    if ok:
+        os.replace(tmp_file_path, decrypted_file_path)
+    elif os.path.exists(tmp_file_path):
+        os.remove(tmp_file_path)
+
+def decrypt(chunk_list,decrypted_file_path,file_key,per_chunk_keys=False,metrics=None,storage=None):
+    """
+    チャンクを復号して1つのファイルに書き戻す。
+    per_chunk_keys=True の場合はチャンク毎に file_key からサブ鍵を導出する。
+    metrics (metrics.Metrics) を指定すると、チャンクの読み込み・復号・書き込みを記録する。
+    storage を指定すると、チャンクをその保存先から読む。
+
+    各チャンクは検証後すぐに一時ファイルの該当オフセットへ書き込むので、
+    メモリ使用量はファイルサイズに関係なくおよそ2チャンク分 (暗号文と平文のバッファ) で済む。
+    全チャンクのGCM検証が通った時点で一時ファイルを decrypted_file_path にリネームする。
+    途中で失敗した場合は一時ファイルを削除して例外を送出する。
+    """
+    positioned = is_positioned(chunk_list)
+    fd = open_partial(decrypted_file_path, chunk_list)
+    try:
+        for line in chunk_list:
+            decrypted_chunk = decrypt_chunk_file(line, file_key, per_chunk_keys, metrics, storage)
+            with timed(metrics, "io_wait"):
+                if positioned:
+                    write_all_at(fd, decrypted_chunk, line["offset"])
+                else:
+                    write_all(fd, decrypted_chunk)
+            if metrics is not None:
+                metrics.add("bytes_written", len(decrypted_chunk))
+    except BaseException:
+        close_partial(fd, decrypted_file_path, False)
+        raise
+    close_partial(fd, decrypted_file_path, True)
+
+def preallocate(fd, size):
+    """出力ファイルの領域を先に確保する (posix_fallocate が使えなければ ftruncate)。"""
+    if size <= 0:
+        return
+    try:
+        os.posix_fallocate(fd, 0, size)
+    except (AttributeError, OSError):
+        os.ftruncate(fd, size)
+
+def write_all_at(fd, data, offset):
+    """data を offset の位置に全て書き込む (pwrite は部分書き込みがあり得る)。"""
+    view = memoryview(data)
+    while view:
+        n = os.pwrite(fd, view, offset)
+        view = view[n:]
+        offset += n
+
+def write_all(fd, data):
+    view = memoryview(data)
+    while view:
+        n = os.write(fd, view)
+        view = view[n:]
+
+
+class RestoreProgress:
+    """
+    復元の進捗 (ファイル数・バイト数・MB/s) を集計する。
+    ワーカースレッドから呼ばれるのでロックで保護し、表示は interval 秒に一度だけ行う。
+    metrics (metrics.Metrics) を指定すると進捗とファイル毎の処理時間をそこに記録し、表示はそのシンクに任せる。
+    """
+    def __init__(self, total_files, total_bytes, interval=2.0, metrics=None):
+        # total_bytes は、大きさの分からない旧形式のエントリを含む場合は None
+        self.total_files = total_files
+        self.total_bytes = total_bytes
+        self.files = 0
+        self.bytes = 0
+        self.failures = []
+        self.interval = interval
+        self.metrics = metrics
+        self.started = time.monotonic()
+        self._last_report = self.started
+        self._lock = threading.Lock()
+        if metrics is not None:
+            metrics.set("files_expected", total_files)
+            if total_bytes is not None:
+                metrics.set("bytes_expected", total_bytes)
+
+    def add_bytes(self, n):
+        with self._lock:
+            self.bytes += n
+            self._maybe_report()
+        if self.metrics is not None:
+            self.metrics.add("bytes_processed", n)
+
+    def file_done(self, path, error=None, started=None):
+        """ファイル1つの復元が終わった (error があれば失敗した)。started はそのファイルの復元を始めた time.monotonic()。"""
+        with self._lock:
+            if error is None:
+                self.files += 1
             else:
-                chunkdb=base_db.copy()
-                chunkdb["chunk_id"]=chunk_index
-                chunkdb["chunk_name"]=chunk_filename
-                chunkdb["password"]=password
-                jsonl_write(chunkdb)
-                chunk_index += 1
+                self.failures.append((path, error))
+            self._maybe_report()
+        if self.metrics is not None:
+            self.metrics.add("files" if error is None else "files_failed")
+            if started is not None:
+                self.metrics.observe("file_latency", time.monotonic() - started)
 
-    return 0
+    def _maybe_report(self):
+        now = time.monotonic()
+        if self.metrics is None and now - self._last_report >= self.interval:
+            self._last_report = now
+            print(f"復元中: {self.line()}")
 
+    def line(self):
+        elapsed = max(time.monotonic() - self.started, 1e-9)
+        total = "?" if self.total_bytes is None else f"{self.total_bytes / 2**20:.1f}"
+        return (f"{self.files}/{self.total_files} ファイル, "
+                f"{self.bytes / 2**20:.1f}/{total} MB, "
+                f"{self.bytes / 2**20 / elapsed:.1f} MB/s, 失敗 {len(self.failures)}")
 
-###復号
-def decrypt(chunk_list,decrypted_file_path,password,base_salt):
-    #ソルトはbasekeyの生成に必要なのでパスワードと一緒に保存する必要がある
-    base_salt=bytes.fromhex(base_salt)
-    base_key = derive_key(password, base_salt)
 
+class _PartialFile:
+    """並列に復元中のファイル1つ分の状態。最後のチャンクが終わった時点で確定 (リネーム/削除) する。"""
+    def __init__(self, decrypted_file_path, chunk_list, progress):
+        self.path = decrypted_file_path
+        self.fd = open_partial(decrypted_file_path, chunk_list)
+        self.remaining = len(chunk_list)
+        self.error = None
+        self.progress = progress
+        self.started = time.monotonic()
+        self._lock = threading.Lock()
 
-    #decrypted_file_path = "reconstructed_document.txt"
-    #password = "MySecurePasswordForChunks!"
-      # --- 復号化フェーズ ---
-    reconstructed_data = b""
-    
-    for line in chunk_list:
-        i=line["chunk_id"]
-        chunk_filename=line["chunk_name"]
+    def chunk_done(self, error=None):
+        with self._lock:
+            if error is not None and self.error is None:
+                self.error = error
+            self.remaining -= 1
+            if self.remaining:
+                return
         try:
-            with open(chunk_filename, 'rb') as f_chunk:
-                encrypted_data_block = f_chunk.read()
-            
-            decrypted_chunk, aad_from_chunk = decrypt_chunk(encrypted_data_block, base_key)
-            
-            # AADからチャンクインデックスを検証（オプションだが推奨）
-            expected_aad_prefix = b"chunk_index:" + str(i).encode()
-            if not aad_from_chunk.startswith(expected_aad_prefix):
-                print(f"警告: チャンク {i} のAADが期待値と異なります。改ざんの可能性があります。")
-                # 必要に応じてエラーを発生させる
-            
-            reconstructed_data += decrypted_chunk
-            print(f"チャンク {i} を復号しました。")
+            close_partial(self.fd, self.path, self.error is None)
+        except OSError as e:
+            self.error = self.error or e
+        self.progress.file_done(self.path, self.error, self.started)
 
-        except ValueError as e:
-            print(f"チャンク {i} の復号に失敗しました: {e}")
-            # ここで処理を中断するか、エラーを記録して続行するかを決定
-            break # 例としてここで中断
-        except Exception as e:
-            print(f"チャンク {i} の処理中に予期せぬエラーが発生しました: {e}")
-            break
 
-    with open(decrypted_file_path, 'wb') as f_dec:
-        f_dec.write(reconstructed_data)
+def _restore_chunk_at(partial, line, file_key, per_chunk_keys, storage=None):
+    # 同じファイルの別チャンクが既に失敗していれば、無駄な復号はしない
+    if partial.error is None:
+        metrics = partial.progress.metrics
+        decrypted_chunk = decrypt_chunk_file(line, file_key, per_chunk_keys, metrics, storage)
+        with timed(metrics, "io_wait"):
+            write_all_at(partial.fd, decrypted_chunk, line["offset"])
+        if metrics is not None:
+            metrics.add("bytes_written", len(decrypted_chunk))
+        partial.progress.add_bytes(len(decrypted_chunk))
 
+def _restore_whole_file(progress, chunk_list, decrypted_file_path, record, master_key, storage=None):
+    # 旧形式のscryptもワーカー上で行い、複数ファイル分を並列に導出する
+    file_key, per_chunk_keys = resolve_file_key(record, master_key)
+    decrypt(chunk_list, decrypted_file_path, file_key, per_chunk_keys, progress.metrics, storage)
+    progress.add_bytes(os.path.getsize(decrypted_file_path))
 
+def _whole_file_cost(chunk_list, record):
+    """1ジョブで復元するファイルのメモリの見積もり。チャンクは順に復号し、旧形式はその前にscryptを行う。"""
+    # 旧形式のチャンクにはサイズが無いが、50MB固定で分割されている
+    cost = restore_cost(max((line.get("size", CHUNK_SIZE) for line in chunk_list), default=0))
+    if record.get("kdf") not in (KDF_HKDF, KDF_CONTENT):
+        cost = max(cost, scrypt_bytes())
+    return cost
 
-# --- ここから復号関連の関数を追加 ---
-def decrypt_master_key_file(encrypted_master_file_path, master_password, master_salt_hex):
+def restore_files(restore_jobs, master_key, jobs=1, progress=None, budget=None, storage=None):
     """
-    マスターキーファイル (暗号化された dirinfo.jsonl) を復号する。
+    restore_jobs: (decrypted_file_path, chunk_list, record) の列 (ジェネレータの場合は progress も渡すこと)
+    record はファイル鍵の導出に必要な情報 (kdf, key_salt / 旧形式の password, base_salt) を持つ。
+    ファイル単位と (大きなファイルの) チャンク単位のジョブを jobs 個のワーカーで並列に実行する。
+    1つのファイルの失敗で他のファイルの復元は止めず、失敗は progress.failures に集める。
+    budget (budget.MemoryBudget) を指定すると、ジョブが使うメモリ (旧形式のscryptを含む) を予約してから投入する。
+    storage を指定すると、チャンクをその保存先から読む (チャンク名はその中でのキー)。
     """
-    master_salt = bytes.fromhex(master_salt_hex)
-    master_key = derive_key(master_password, master_salt) # AES256GCM.py より
+    if progress is None:
+        progress = RestoreProgress(len(restore_jobs), 0)
+    if budget is None:
+        budget = MemoryBudget()
+    # 投入済みで未完了のジョブ数を制限し、開いたままの一時ファイルとバッファを抑える
+    slots = threading.BoundedSemaphore(max(jobs, 1) * 2)
+
+    def release_slot(future, cost=0):
+        budget.release(cost)
+        slots.release()
 
-    with open(encrypted_master_file_path, 'rb') as f:
-        encrypted_data_block = f.read()
+    with concurrent.futures.ThreadPoolExecutor(max_workers=max(jobs, 1)) as pool:
+        for decrypted_file_path, chunk_list, record in restore_jobs:
+            if len(chunk_list) <= 1 or not is_positioned(chunk_list):
+                # 小さなファイルと旧形式のファイルは1ジョブで順に復号する
+                slots.acquire()
+                cost = _whole_file_cost(chunk_list, record)
+                budget.acquire(cost)
+                started = time.monotonic()
+                future = pool.submit(_restore_whole_file, progress, chunk_list, decrypted_file_path, record, master_key,
+                                     storage)
+                future.add_done_callback(lambda f, cost=cost: release_slot(f, cost))
+                future.add_done_callback(
+                    lambda f, path=decrypted_file_path, started=started: progress.file_done(path, f.exception(), started))
+                continue
 
+            try:
+                file_key, per_chunk_keys = resolve_file_key(record, master_key)
+                partial = _PartialFile(decrypted_file_path, chunk_list, progress)
+            except (OSError, ValueError, KeyError) as e:
+                progress.file_done(decrypted_file_path, e)
+                continue
+            for line in chunk_list:
+                slots.acquire()
+                cost = restore_cost(line["size"])
+                budget.acquire(cost)
+                future = pool.submit(_restore_chunk_at, partial, line, file_key, per_chunk_keys, storage)
+                future.add_done_callback(lambda f, cost=cost: release_slot(f, cost))
+                future.add_done_callback(lambda f, partial=partial: partial.chunk_done(f.exception()))
+    return progress
+
+
+
+# --- ここから復号関連の関数を追加 ---
+def load_manifest(encrypted_master_file_path, master_key, base=None):
+    """
+    マスターキーファイル (masterkey.enc) を開き、エントリを順に読めるマニフェストを返す。
+    master_key はマスターパスワードとマスターソルトから導出済みの鍵。
+    旧形式 (暗号化された dirinfo.jsonl) も読み込める。復号できなければ None を返す。
+    チャンク名は base (省略時は masterkey.enc のあるディレクトリ) からのパスになる。
+    """
     try:
-        # decrypt_chunk は (plaintext, associated_data) を返す
-        decrypted_jsonl_data, _ = decrypt_chunk(encrypted_data_block, master_key)
-        return decrypted_jsonl_data.decode('utf-8') # バイト列を文字列に変換
+        return open_manifest(encrypted_master_file_path, master_key, base)
     except ValueError as e:
         print(f"マスターキーファイルの復号に失敗しました: {e}")
         return None
 
-def restore_directory_structure(output_base_dir, dir_info_jsonl_content):
+def _join_manifest(records, prior_entries):
     """
-    dirinfo.jsonl の内容に基づいてディレクトリ構造とファイルを復元する。
-    ファイルごとのパスワードは dir_info_jsonl_content から取得する。
+    path_sort_key の順に並んだ records (scanner.ScanRecord) と前回のマニフェストのエントリ (同じ順) を
+    突き合わせ、(レコード, 前回のエントリ または None) を順に yield する。今回無くなったファイルは
+    (None, 前回のエントリ)。両方を1度ずつ流し読みするだけなので、前回のマニフェストをメモリに載せない。
     """
-    if not os.path.exists(output_base_dir):
-        os.makedirs(output_base_dir)
-        print(f"復元先ベースディレクトリを作成しました: {output_base_dir}")
+    prior_iter = (entry for entry in prior_entries if not entry.get("deleted"))
+    prior = next(prior_iter, None)
+    for record in records:
+        sort_key = path_sort_key(record.path)
+        while prior is not None and path_sort_key(entry_key(prior)) < sort_key:
+            yield None, prior
+            prior = next(prior_iter, None)
+        if prior is not None and entry_key(prior) == record.path:
+            yield record, prior
+            prior = next(prior_iter, None)
+        else:
+            yield record, None
+    while prior is not None:
+        yield None, prior
+        prior = next(prior_iter, None)
 
-    files_to_reconstruct = {}
-    for line_str in dir_info_jsonl_content.strip().split('\n'):
-        if not line_str:
+def plan_incremental(records, prior_entries, hash_key=None):
+    """
+    前回のマニフェストと比較して、今回暗号化すべきファイルを決める。
+    records (scanner.ScanRecord) は path_sort_key の順に並べておくこと。
+    走査時の (size, mtime_ns, inode) が前回と同じファイルは変更なしとみなし、前回のエントリを引き継ぐ。
+    hash_key を指定した場合は、変更なしに見えるファイルも内容の鍵付きハッシュで確認する。
+    (暗号化するレコード, 件数の集計) を返す。
+    """
+    changed_records = []
+    counts = {"new": 0, "changed": 0, "unchanged": 0, "deleted": 0}
+    for record, prior in _join_manifest(records, prior_entries):
+        if record is None:
+            counts["deleted"] += 1
             continue
-        try:
-            record = json.loads(line_str)
-            # 元のファイルパスを復元するためのキーを生成
-            original_file_key = (tuple(record["path"]), record["name"])
-
-            if original_file_key not in files_to_reconstruct:
-                files_to_reconstruct[original_file_key] = {
-                    "base_salt": record["base_salt"],
-                    "password": record["password"], # dirinfo.json に保存されたパスワード
-                    "chunks": [],
-                    "original_path_list": record["path"],
-                    "original_filename": record["name"],
-                    "chunk_base_path": record["chunkpath"]
-                }
-            files_to_reconstruct[original_file_key]["chunks"].append({
-                "id": record["chunk_id"],
-                "name": record["chunk_name"] # chunk_name はフルパスのはず
-            })
-        except json.JSONDecodeError:
-            print(f"警告: JSONLの行の解析に失敗しました: {line_str}")
+        if prior is None:
+            counts["new"] += 1
+            changed_records.append(record)
             continue
-        except KeyError as e:
-            print(f"警告: JSONLのレコードに必要なキー ({e}) がありません: {record}")
+        unchanged = (prior.get("file_size") == record.size and
+                     prior.get("mtime_ns") == record.mtime_ns and
+                     prior.get("inode") == record.inode)
+        if unchanged and hash_key is not None:
+            unchanged = prior.get("content_hash") == file_content_hash(record.path, hash_key)
+        if unchanged:
+            counts["unchanged"] += 1
+        else:
+            counts["changed"] += 1
+            changed_records.append(record)
+    return changed_records, counts
+
+def merge_incremental(records, prior_entries, changed_records, encrypted_entries, record_deleted=True):
+    """
+    差分バックアップの新しいマニフェストのエントリを、records の順に yield する。
+    変更のないファイルは前回のエントリ (チャンク) をそのまま引き継ぎ、changed_records のファイルは
+    encrypted_entries (changed_records を同じ順に暗号化した結果) を使い、削除されたファイルは削除記録を残す
+    (record_deleted が False なら何も残さない)。
+    """
+    changed_paths = {record.path for record in changed_records}
+    encrypted_entries = iter(encrypted_entries)
+    for record, prior in _join_manifest(records, prior_entries):
+        if record is None:
+            if not record_deleted:
+                continue
+            yield {
+                "deleted": True,
+                "path": prior["path"],
+                "name": prior["name"],
+                "deleted_at_ns": time.time_ns(),
+            }
+        elif record.path in changed_paths:
+            yield next(encrypted_entries)
+        else:
+            yield prior
+    # 暗号化側を最後まで進めて完了処理 (パックの確定) を行わせる。途中で止めると失敗とみなされる
+    for _ in encrypted_entries:
+        pass
+
+def _join_entries(prior_entries, new_entries):
+    """
+    path_sort_key の順に並んだ前回と今回のマニフェストのエントリを突き合わせ、(前回, 今回) を順に yield する
+    (片方にしか無いパスは、もう片方が None)。
+    """
+    prior_iter = iter(prior_entries)
+    new_iter = iter(new_entries)
+    prior = next(prior_iter, None)
+    new = next(new_iter, None)
+    while prior is not None or new is not None:
+        prior_key = path_sort_key(entry_key(prior)) if prior is not None else None
+        new_key = path_sort_key(entry_key(new)) if new is not None else None
+        if new is None or (prior is not None and prior_key < new_key):
+            yield prior, None
+            prior = next(prior_iter, None)
+        elif prior is None or new_key < prior_key:
+            yield None, new
+            new = next(new_iter, None)
+        else:
+            yield prior, new
+            prior = next(prior_iter, None)
+            new = next(new_iter, None)
+
+def superseded_objects(prior_entries, new_entries):
+    """
+    前回のマニフェストのエントリが参照していて、新しいマニフェストが参照していないオブジェクトのキー
+    (storage.object_key) の集合 (変更・削除されたファイルの古いチャンクと、どのチャンクも参照しなくなったパック) を返す。
+    2つのマニフェストをパス順に流し読みして、同じパスのエントリが参照しなくなったものを候補にするので、
+    メモリに載るのは変更されたエントリの分だけ。重複排除のチャンクとパックは他のエントリからも参照され得るので、
+    候補にあれば new_entries をもう一度流し読みして、参照されているものを候補から外す。
+    """
+    superseded = set()
+    shared = False
+    for prior, new in _join_entries(prior_entries, new_entries):
+        if prior is None or not prior.get("chunks"):
             continue
+        kept = {object_key(chunk["chunk_name"]) for chunk in new.get("chunks", [])} if new is not None else set()
+        for chunk in prior["chunks"]:
+            key = object_key(chunk["chunk_name"])
+            if key not in kept:
+                superseded.add(key)
+                shared = shared or "cas" in chunk or "pack_offset" in chunk
+    if shared:
+        for entry in new_entries:
+            for chunk in entry.get("chunks", []):
+                superseded.discard(object_key(chunk["chunk_name"]))
+    return superseded
 
-    for original_file_key, data in files_to_reconstruct.items():
-        original_path_list = data["original_path_list"]
-        original_filename = data["original_filename"]
-        
-        current_output_dir = os.path.join(output_base_dir, *original_path_list)
-        if not os.path.exists(current_output_dir):
-            os.makedirs(current_output_dir)
-        
-        decrypted_file_path = os.path.join(current_output_dir, original_filename)
-        
-        file_specific_password = data.get("password")
-        if not file_specific_password:
-            print(f"警告: ファイル {os.path.join(*original_path_list, original_filename)} のパスワードがJSONLレコード内に見つかりません。スキップします。")
+def prune_objects(storage, keys):
+    """
+    keys のオブジェクトを削除し、(削除した数, バイト数) を返す。既に無いものは数えない。
+    新しいマニフェストを確定した後 (古いマニフェストに戻る必要が無くなってから) 呼ぶこと。
+    """
+    removed = 0
+    removed_bytes = 0
+    for key in sorted(keys):
+        size = storage.size(key)
+        if size is None:
             continue
+        storage.delete(key)
+        removed += 1
+        removed_bytes += size
+    storage.sync()
+    return removed, removed_bytes
 
-        base_salt_hex = data["base_salt"]
-        sorted_chunks_info = sorted(data["chunks"], key=lambda c: c["id"])
-        
-        chunk_list_for_decrypt = []
-        for chunk_info in sorted_chunks_info:
-            chunk_list_for_decrypt.append({
-                "chunk_id": chunk_info["id"],
-                "chunk_name": chunk_info["name"]
-            })
-
-        print(f"ファイルを復元中: {decrypted_file_path}")
-        try:
-            # main.py にある既存の decrypt 関数を呼び出す
-            decrypt(chunk_list_for_decrypt, decrypted_file_path, file_specific_password, base_salt_hex)
-            print(f"ファイルが復元されました: {decrypted_file_path}")
-        except Exception as e:
-            print(f"ファイル {decrypted_file_path} の復元中にエラーが発生しました: {e}")
+def entry_size(entry):
+    """
+    エントリのファイルの大きさ。旧形式のエントリにはファイルサイズもチャンクの大きさも記録されていないので None。
+    """
+    if entry.get("file_size") is not None:
+        return entry["file_size"]
+    chunks = entry.get("chunks", [])
+    if all("size" in chunk for chunk in chunks):
+        return sum(chunk["size"] for chunk in chunks)
+    return None
+
+def _restorable(entry):
+    """削除記録ではなく、ファイル鍵を求められるエントリなら True。"""
+    if entry.get("deleted"):
+        return False # 差分バックアップでの削除記録
+    return entry.get("kdf") in (KDF_HKDF, KDF_CONTENT) or bool(entry.get("password"))
 
-def main_decrypt_process(master_password_input, restoration_output_dir, encrypted_files_dir):
+def restore_directory_structure(output_base_dir, manifest, master_key, jobs=1, path_filter=None, budget=None,
+                                metrics=None, storage=None):
     """
-    全体の復号処理を実行するメインの関数。
-    encrypted_files_dir は masterkey.enc と master_salt.txt があるディレクトリ。
+    マニフェストのエントリに基づいてディレクトリ構造とファイルを復元する。
+    manifest はエントリを (何度でも) 順に返すもの (load_manifest の返り値)。
+    path_filter (PathFilter) を指定すると一致したファイルだけを復元し、それ以外のチャンクには触れない。
+    1回目の走査でディレクトリの作成と合計サイズの集計を行い、2回目の走査で復元するので、
+    マニフェスト全体をメモリに載せない。
+    新形式のファイル鍵は master_key から導出し、旧形式はエントリ内のパスワードを使う。
+    jobs 個のワーカーでファイル・チャンクを並列に復元し、進捗 (RestoreProgress) を返す。
+    budget (budget.MemoryBudget) を指定すると、その上限に収まる分だけのジョブを同時に実行する。
+    metrics (metrics.Metrics) を指定すると、進捗と読み書き・復号の時間を記録する。
+    storage を指定すると、チャンクをその保存先から読む。
     """
+    if not os.path.exists(output_base_dir):
+        os.makedirs(output_base_dir)
+        print(f"復元先ベースディレクトリを作成しました: {output_base_dir}")
+
+    # ディレクトリは復元前にまとめて作成しておく
+    directories = set()
+    total_files = 0
+    total_bytes = 0
+    for entry in manifest.select(path_filter):
+        if not _restorable(entry):
+            if not entry.get("deleted"):
+                print(f"警告: ファイル {entry_key(entry)} のパスワードがマニフェストに見つかりません。スキップします。")
+            continue
+        directories.add(os.path.join(output_base_dir, *entry["path"]))
+        total_files += 1
+        size = entry_size(entry)
+        total_bytes = None if total_bytes is None or size is None else total_bytes + size
+    for current_output_dir in sorted(directories):
+        os.makedirs(current_output_dir, exist_ok=True)
+    del directories
+    if path_filter is not None and not total_files:
+        print("警告: 指定したパターンに一致するファイルがありません。")
+
+    restore_jobs = (
+        (os.path.join(output_base_dir, *entry["path"], entry["name"]), entry["chunks"], entry)
+        for entry in manifest.select(path_filter) if _restorable(entry)
+    )
+    progress = RestoreProgress(total_files, total_bytes, metrics=metrics)
+    restore_files(restore_jobs, master_key, jobs, progress, budget, storage)
+
+    print(f"復元結果: {progress.line()}")
+    if progress.failures:
+        print(f"エラー: {len(progress.failures)} 個のファイルの復元に失敗しました:")
+        for failed_path, error in progress.failures:
+            print(f"  {failed_path}: {error}")
+    return progress
+
+def open_archive(master_password_input, encrypted_files_dir, budget=None, metrics=None, storage=None):
+    """
+    encrypted_files_dir (masterkey.enc と master_salt.txt があるディレクトリ) のマニフェストを開き、
+    (マニフェスト, マスター鍵) を返す。開けなければエラーを表示して None を返す。
+    budget (budget.MemoryBudget) を指定すると、scrypt の作業領域を予約してから鍵を導出する。
+    metrics (metrics.Metrics) を指定すると、鍵導出の時間を記録する。
+    storage (storage.S3Storage など) を指定すると、encrypted_files_dir の代わりにその保存先から読む。
+    マニフェストのチャンク名はその保存先でのキーになる。
+    """
+    if storage is not None:
+        return _open_remote_archive(master_password_input, storage, budget, metrics)
     encrypted_master_file = os.path.join(encrypted_files_dir, "masterkey.enc")
     master_salt_file = os.path.join(encrypted_files_dir, "master_salt.txt")
 
     if not os.path.exists(encrypted_master_file):
         print(f"エラー: 暗号化されたマスターファイルが見つかりません: {encrypted_master_file}")
-        return
+        return None
     if not os.path.exists(master_salt_file):
         print(f"エラー: マスターソルトファイルが見つかりません: {master_salt_file}")
-        return
+        return None
 
     with open(master_salt_file, 'r') as f:
         master_salt_hex = f.read().strip()
 
     print("マスターキーファイルを復号しています...")
-    decrypted_jsonl = decrypt_master_key_file(encrypted_master_file, master_password_input, master_salt_hex)
+    # マスター鍵のscryptは復号処理全体で一度だけ行う
+    with (budget or MemoryBudget()).reserve(scrypt_bytes()), timed(metrics, "kdf"):
+        master_key = derive_key(master_password_input, bytes.fromhex(master_salt_hex))
+    manifest = load_manifest(encrypted_master_file, master_key)
+    if manifest is None:
+        print("マニフェストの復号に失敗したため、処理を中止します。")
+        return None
+    return manifest, master_key
+
+def _open_remote_archive(master_password_input, storage, budget=None, metrics=None):
+    """open_archive の保存先版。masterkey.enc は一時ファイルに取ってきてから開く。"""
+    try:
+        master_salt_hex = storage.get("master_salt.txt").decode().strip()
+        master_file_data = storage.get("masterkey.enc")
+    except FileNotFoundError as e:
+        print(f"エラー: {e}")
+        return None
+    except OSError as e:
+        print(f"エラー: アーカイブを読み込めません: {e}")
+        return None
 
-    if decrypted_jsonl:
+    print("マスターキーファイルを復号しています...")
+    with (budget or MemoryBudget()).reserve(scrypt_bytes()), timed(metrics, "kdf"):
+        master_key = derive_key(master_password_input, bytes.fromhex(master_salt_hex))
+    fd, tmp_path = tempfile.mkstemp(prefix="masterkey-", suffix=".enc")
+    try:
+        with os.fdopen(fd, "wb") as f:
+            f.write(master_file_data)
+        # 開いた後は一時ファイルを消してもよい (ManifestReader は開いたファイルから読む)
+        manifest = load_manifest(tmp_path, master_key, base="")
+    finally:
+        os.remove(tmp_path)
+    if manifest is None:
+        print("マニフェストの復号に失敗したため、処理を中止します。")
+        return None
+    return manifest, master_key
+
+def main_decrypt_process(master_password_input, restoration_output_dir, encrypted_files_dir, jobs=1, path_filter=None,
+                         budget=None, metrics=None, storage=None):
+    """
+    全体の復号処理を実行するメインの関数。
+    encrypted_files_dir は masterkey.enc と master_salt.txt があるディレクトリ。
+    path_filter (PathFilter) を指定すると一致したファイルだけを復元する。
+    budget (budget.MemoryBudget) を指定すると、鍵導出と復元のメモリをその上限に収める。
+    metrics (metrics.Metrics) を指定すると、鍵導出・読み書き・復号の時間と進捗を記録する。
+    storage (storage.S3Storage など) を指定すると、アーカイブをその保存先から読む。
+    """
+    archive = open_archive(master_password_input, encrypted_files_dir, budget, metrics, storage)
+    if archive is None:
+        return None
+    manifest, master_key = archive
+    with manifest:
         print("ディレクトリ構造とファイルを復元しています...")
-        restore_directory_structure(restoration_output_dir, decrypted_jsonl)
-        print("復元処理が完了しました。")
+        progress = restore_directory_structure(restoration_output_dir, manifest, master_key, jobs, path_filter, budget,
+                                               metrics, storage)
+    if progress.failures:
+        print("復元処理は完了しましたが、一部のファイルを復元できませんでした。")
     else:
-        print("dirinfo.json の復号に失敗したため、処理を中止します。")
+        print("復元処理が完了しました。")
+    return progress
+
+def main_list_process(master_password_input, encrypted_files_dir, path_filter=None, storage=None):
+    """
+    マニフェストに記録されたファイルを、サイズとチャンク数とともに一覧表示する。
+    データのチャンクは読まない (マニフェストだけを復号する)。大きさの分からない旧形式のエントリは ? と表示する。
+    表示した件数を返す。
+    """
+    archive = open_archive(master_password_input, encrypted_files_dir, storage=storage)
+    if archive is None:
+        return None
+    manifest, _master_key = archive
+    files = 0
+    total_bytes = 0
+    unknown = 0
+    with manifest:
+        for entry in manifest.select(path_filter):
+            if entry.get("deleted"):
+                continue
+            chunks = entry.get("chunks", [])
+            size = entry_size(entry)
+            if size is None: # 旧形式のエントリは大きさが分からない
+                print(f"{'?':>15} {len(chunks):>6} {entry_key(entry)}")
+                unknown += 1
+            else:
+                print(f"{size:>15,} {len(chunks):>6} {entry_key(entry)}")
+                total_bytes += size
+            files += 1
+    unknown_note = f" (大きさ不明の旧形式のファイル {unknown} 件を除く)" if unknown else ""
+    print(f"合計: {files} ファイル, {total_bytes / 2**20:.1f} MB{unknown_note}")
+    return files
+
+def main_copy_process(master_password_input, source, destination, jobs=1, metrics=None):
+    """
+    アーカイブを source から destination (どちらもディレクトリか s3://バケット/プレフィックス) へコピーする。
+    マニフェストはオブジェクトを相対的なキーで記録しているので、書き換えずにそのままコピーする。
+    マニフェストが参照するオブジェクトだけを jobs 並列でコピーし (コピー先に同じ大きさで既にあれば飛ばす)、
+    それらを保存し終えてから master_salt.txt と masterkey.enc を書く。コピーしたオブジェクトの数を返す。
+    """
+    src = open_storage(source, jobs)
+    dst = open_storage(destination, jobs)
+    with src, dst:
+        # パスワードを確かめてから、マニフェストが参照するオブジェクトのキーを集める
+        archive = open_archive(master_password_input, source, metrics=metrics,
+                               storage=src if is_remote(source) else None)
+        if archive is None:
+            return None
+        manifest, _master_key = archive
+        keys = set()
+        with manifest:
+            for entry in manifest:
+                for chunk in entry.get("chunks", []):
+                    keys.add(src.key_of(chunk["chunk_name"]))
+        existing = {info.key: info.size for info in dst.list()}
+        sizes = {info.key: info.size for info in src.list() if info.key in keys}
+        missing = sorted(keys - sizes.keys())
+        if missing:
+            print(f"エラー: コピー元にマニフェストが参照するオブジェクトが {len(missing)} 個ありません "
+                  f"(例: {src.location(missing[0])})")
+            return None
+        todo = [key for key in sorted(keys) if existing.get(key) != sizes[key]]
+        if metrics is not None:
+            metrics.set("bytes_expected", sum(sizes[key] for key in todo))
+        print(f"{len(keys)} オブジェクト中 {len(todo)} 個をコピーします "
+              f"({sum(sizes[key] for key in todo) / 2**20:.1f} MB, {dst.location('')})。")
+
+        def copy_object(key):
+            data = src.get(key)
+            dst.put(key, data)
+            if metrics is not None:
+                metrics.add("bytes_read", len(data))
+                metrics.add("bytes_written", len(data))
+                metrics.add("bytes_processed", len(data))
+
+        # コピー先のワーカーで並列に取ってきて書く (同時に持つオブジェクトはワーカー数まで)
+        futures = [dst.submit(copy_object, key) for key in todo]
+        errors = []
+        for key, future in zip(todo, futures):
+            try:
+                future.result()
+            except OSError as e:
+                errors.append((key, e))
+        if errors:
+            for key, error in errors[:10]:
+                print(f"  {src.location(key)}: {error}")
+            print(f"エラー: {len(errors)} 個のオブジェクトをコピーできませんでした (マニフェストはコピーしていません)。")
+            return None
+        dst.sync()
+        # オブジェクトが揃ってから、ソルトとマニフェストを最後に書く
+        dst.put("master_salt.txt", src.get("master_salt.txt"))
+        dst.put("masterkey.enc", src.get("masterkey.enc"))
+        dst.sync()
+    print(f"アーカイブを {dst.location('masterkey.enc')} にコピーしました。")
+    return len(todo)
 
 # --- ここまで復号関連の関数を追加 ---
 
 
-if __name__ == '__main__':
-    if len(sys.argv) < 4:
-        print("使用法: python main.py <target_dir/restoration_dir> <output_dir/encrypted_files_dir> <master_password> [mode]")
-        print("  mode: 'encrypt' (デフォルト) または 'decrypt'")
-        print("  encrypt時: <target_dir> <output_dir> <master_password> encrypt")
-        print("  decrypt時: <restoration_dir> <encrypted_files_dir> <master_password> decrypt")
+def parse_size(text):
+    """'4M' や '64K' のようなサイズ指定をバイト数に変換する。"""
+    units = {"k": 1024, "m": 1024**2, "g": 1024**3, "t": 1024**4}
+    text = text.strip().lower().rstrip("b")
+    try:
+        if text and text[-1] in units:
+            return int(float(text[:-1]) * units[text[-1]])
+        return int(text)
+    except ValueError:
+        raise argparse.ArgumentTypeError(f"サイズの指定が不正です: {text}")
+
+def report_memory(budget):
+    """予約したメモリのピークと、比較のためにプロセスの実際の最大RSSを表示する。"""
+    max_rss = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss * 1024 # Linux では KB 単位
+    print(f"メモリ (追跡分): {budget.line()}, 最大RSS {max_rss / 2**20:.1f} MB")
+
+def check_journaled_chunk(base_db, chunk, master_key):
+    """ジャーナルに記録されたチャンクを復号して、記録どおりの平文の大きさになるか確かめる。"""
+    file_key, per_chunk_keys = resolve_file_key(base_db, master_key)
+    return len(decrypt_chunk_file(chunk, file_key, per_chunk_keys)) == chunk["size"]
+
+# 進捗の表示に使うモード毎の見出し
+PROGRESS_LABELS = {"encrypt": "暗号化中", "decrypt": "復元中", "verify": "検証中", "copy": "コピー中"}
+
+def start_instrumentation(args, mode):
+    """
+    オプションに従って計測 (Metrics) とそのシンク、--profile のプロファイラを用意して開始する。
+    sys.exit で終わる場合も最後の統計とプロファイルが書き出されるように、終了処理は atexit に登録する。
+    """
+    metrics = Metrics({"mode": mode})
+    if args.progress_interval > 0 and mode in PROGRESS_LABELS:
+        metrics.add_sink(ProgressSink(PROGRESS_LABELS[mode], args.progress_interval))
+    if args.stats_file:
+        metrics.add_sink(JSONLinesSink(args.stats_file, args.stats_interval))
+    if args.prometheus_file:
+        metrics.add_sink(PrometheusSink(args.prometheus_file, args.stats_interval))
+    if args.profile:
+        suffix = ".prof" if args.profile == "cprofile" else ".tracemalloc.txt"
+        profiler = Profiler(args.profile, args.profile_output or f"pycryptodrive-{mode}{suffix}")
+        profiler.start()
+        atexit.register(profiler.stop)
+    # atexit は登録と逆順に呼ばれるので、統計の書き出しはプロファイルの保存より先になる
+    atexit.register(metrics.close)
+    metrics.start()
+    return metrics
+
+def plan_restore_jobs(args):
+    """--memory-limit があれば、復元・検証のワーカー数を上限に収まるように減らして返す。"""
+    if args.memory_limit is None:
+        return args.jobs
+    try:
+        # チャンクの大きさはアーカイブで決まっているので、最大 (固定長の50MB) を仮定してワーカー数を決める
+        jobs = plan_restore(args.memory_limit, args.jobs, CHUNK_SIZE).jobs
+    except ValueError as e:
+        print(f"エラー: {e}")
         sys.exit(1)
+    if jobs != args.jobs:
+        print(f"メモリの上限に合わせてワーカー数を {args.jobs} -> {jobs} に減らしました。")
+    return jobs
 
-    # 引数の意味をモードによって明確化
+def build_arg_parser():
+    parser = argparse.ArgumentParser(
+        description="ファイル/フォルダをAES-256-GCMでクライアントサイド暗号化・復号します。",
+        epilog="encrypt時: <target_dir> <output_dir> <master_password> encrypt / "
+               "decrypt時: <restoration_dir> <encrypted_files_dir> <master_password> decrypt / "
+               "list時: - <encrypted_files_dir> <master_password> list / "
+               "verify時: <report.json または -> <encrypted_files_dir> <master_password> verify / "
+               "copy時: <copy先> <encrypted_files_dir> <master_password> copy "
+               "(encrypted_files_dir と copy先 は s3://バケット/プレフィックス も可。encrypt の出力先はローカルのみ)",
+    )
     # arg1: encrypt時は暗号化対象ディレクトリ、decrypt時は復元先ディレクトリ
     # arg2: encrypt時は暗号化ファイルの出力先ディレクトリ、decrypt時は暗号化ファイルが格納されているディレクトリ
     # arg3: マスターパスワード
-    # arg4: モード (encrypt/decrypt)
+    # arg4: モード (encrypt/decrypt/list/verify/copy)
+    parser.add_argument("arg1", help="target_dir (encrypt) / restoration_dir (decrypt) / 使わない (list) / "
+                                     "JSONレポートの出力先 (verify, - なら書き出さない) / コピー先 (copy)")
+    parser.add_argument("arg2", help="output_dir (encrypt) / encrypted_files_dir (decrypt, list, verify, copy)")
+    parser.add_argument("master_password")
+    parser.add_argument("mode", nargs="?", default="encrypt", type=str.lower,
+                        help="'encrypt' (デフォルト), 'decrypt', 'list', 'verify' または 'copy'")
+    parser.add_argument("--jobs", "-j", type=int, default=1,
+                        help="並列に暗号化・復元・コピーするワーカー数 (デフォルト: 1)")
+    parser.add_argument("--quick", action="store_true",
+                        help="verify でチャンクを復号せず、存在と大きさだけを確かめる")
+    parser.add_argument("--memory-limit", type=parse_size, default=None, metavar="SIZE",
+                        help="鍵導出 (scrypt) とチャンクのバッファに使うメモリの上限 (例: 2G)。"
+                             "収まるようにワーカー数とチャンクサイズを減らし、実行中も上限を超えないように仕事を投入する")
+    parser.add_argument("--include", action="append", default=[], metavar="PATTERN",
+                        help="元のパスがこのパターンに一致するファイルだけを対象にする (複数指定可)。"
+                             "/ で始まるパターンは絶対パスの先頭から、それ以外は末尾から比較し、ディレクトリを指定するとその下の全ファイルが対象")
+    parser.add_argument("--exclude", action="append", default=[], metavar="PATTERN",
+                        help="このパターンに一致するファイルを除く (複数指定可)。encrypt では一致したディレクトリは配下ごと走査しない")
+    parser.add_argument("--symlinks", choices=scanner.SYMLINK_MODES, default=scanner.SYMLINKS_FOLLOW,
+                        help="encrypt でシンボリックリンクを follow: リンク先を暗号化する (デフォルト, ループは1度だけ辿る) / skip: 無視する")
+    parser.add_argument("--executor", choices=["pipeline", "thread", "process"], default="pipeline",
+                        help="ワーカーの種類。pipeline は読み込み・暗号化・書き出しを別スレッドで重ねて行い、"
+                             "-j は暗号化のスレッド数になる。thread/process は1チャンクずつワーカーに任せる "
+                             "(デフォルト: pipeline)")
+    parser.add_argument("--chunking", choices=["fixed", "fastcdc"], default="fixed",
+                        help="fixed: 50MB固定長で分割 (デフォルト) / fastcdc: 内容で分割し、同じチャンクは一度だけ保存する")
+    parser.add_argument("--cdc-min", type=parse_size, default=cdc.DEFAULT_PARAMS.min_size,
+                        help="fastcdc の最小チャンクサイズ (例: 1M)")
+    parser.add_argument("--cdc-avg", type=parse_size, default=cdc.DEFAULT_PARAMS.avg_size,
+                        help="fastcdc の平均チャンクサイズ (例: 4M)")
+    parser.add_argument("--cdc-max", type=parse_size, default=cdc.DEFAULT_PARAMS.max_size,
+                        help="fastcdc の最大チャンクサイズ (例: 16M)")
+    parser.add_argument("--resume", action="store_true",
+                        help="中断した encrypt を出力ディレクトリのジャーナル (masterkey.journal) から再開する")
+    parser.add_argument("--incremental", action="store_true",
+                        help="出力先の前回のマニフェストと比較し、新規・変更されたファイルだけを暗号化する")
+    parser.add_argument("--keep-superseded", action="store_true",
+                        help="前回のマニフェストだけが参照していたオブジェクト (変更・削除されたファイルの古いチャンク) を"
+                             "削除せずに残す")
+    parser.add_argument("--hash-check", action="store_true",
+                        help="--incremental で、変更なしに見えるファイルも内容のハッシュで確認する (全ファイルを読む)")
+    parser.add_argument("--compress", choices=compression.CODECS, default=compression.CODEC_NONE,
+                        help="暗号化前にチャンクを圧縮するコーデック (デフォルト: none)。圧縮済みのデータは自動的にスキップする")
+    parser.add_argument("--compress-level", type=int, default=None,
+                        help="圧縮レベル (zlib: 1-9, lzma: 0-9, デフォルト: 6)")
+    parser.add_argument("--pack-small", type=parse_size, default=0, metavar="SIZE",
+                        help="このサイズ以下のチャンクを個別のファイルではなくパックファイルにまとめる (例: 1M, デフォルト: 0 = パックしない)")
+    parser.add_argument("--pack-size", type=parse_size, default=DEFAULT_PACK_SIZE, metavar="SIZE",
+                        help="パックファイル1つの目標サイズ (デフォルト: 64M)")
+    parser.add_argument("--progress-interval", type=float, default=2.0, metavar="SECONDS",
+                        help="進捗 (ファイル数・MB・MB/s・残り時間) を表示する間隔 (デフォルト: 2秒, 0 で表示しない)")
+    parser.add_argument("--stats-file", default=None, metavar="PATH",
+                        help="計測したカウンター・タイマー・ヒストグラムを JSON Lines で追記するファイル")
+    parser.add_argument("--prometheus-file", default=None, metavar="PATH",
+                        help="計測値を Prometheus のテキスト形式で書き出すファイル (node_exporter の textfile collector 用)")
+    parser.add_argument("--stats-interval", type=float, default=10.0, metavar="SECONDS",
+                        help="--stats-file と --prometheus-file を書き出す間隔 (デフォルト: 10秒, 終了時にも書き出す)")
+    parser.add_argument("--profile", choices=PROFILE_MODES, default=None,
+                        help="実行全体のプロファイルを取る。cprofile: 関数毎の時間 (メインスレッドのみ) / "
+                             "tracemalloc: メモリを確保した場所の上位")
+    parser.add_argument("--profile-output", default=None, metavar="PATH",
+                        help="プロファイルの保存先 (デフォルト: pycryptodrive-<mode>.prof または .tracemalloc.txt)")
+    return parser
 
-    arg1 = sys.argv[1]
-    arg2 = sys.argv[2]
-    master_password_arg = sys.argv[3]
-    
-    mode = "encrypt" # デフォルトは暗号化
-    if len(sys.argv) > 4:
-        mode = sys.argv[4].lower()
+if __name__ == '__main__':
+    args = build_arg_parser().parse_args()
+
+    arg1 = args.arg1
+    arg2 = args.arg2
+    master_password_arg = args.master_password
+    mode = args.mode # デフォルトは暗号化
+    path_filter = PathFilter(args.include, args.exclude) if (args.include or args.exclude) else None
+    metrics = start_instrumentation(args, mode)
+
+    # decrypt / list / verify / copy のアーカイブは s3://バケット/プレフィックス からも読める
+    storage = None
+    if mode in ("decrypt", "list", "verify") and is_remote(arg2):
+        try:
+            storage = open_storage(arg2, args.jobs)
+        except ValueError as e:
+            print(f"エラー: {e}")
+            sys.exit(1)
 
     if mode == "encrypt":
         target_dir_arg = arg1
         output_dir_arg = arg2
         print("--- 暗号化処理開始 ---")
+        if is_remote(output_dir_arg):
+            print("エラー: 暗号化の出力先はローカルのディレクトリを指定してください "
+                  "(S3 へはローカルに暗号化してから copy モードでコピーできます)。")
+            sys.exit(1)
         if not os.path.exists(output_dir_arg):
             os.makedirs(output_dir_arg)
             print(f"出力ディレクトリを作成しました: {output_dir_arg}")
 
-        jsonl_filename_default = "dirinfo.json" # encrypt関数内のデフォルトファイル名
-        # dirinfo.json は一時的にカレントディレクトリに作成されるため、そのパスを定義
-        temp_jsonl_path = os.path.abspath(jsonl_filename_default)
-
-        if os.path.exists(temp_jsonl_path):
-            os.remove(temp_jsonl_path) # 追記モードなので、実行前にカレントの同名ファイルを削除
-
         # 暗号化対象から除外するフルパスのリスト
-        # masterkey.enc と master_salt.txt は output_dir_arg に作られる
-        # dirinfo.json はカレントディレクトリに一時的に作られる
+        # masterkey.enc (書き込み中は masterkey.enc.tmp)、master_salt.txt と
+        # 進捗のジャーナル masterkey.journal は output_dir_arg に作られる
+        journal_path = os.path.join(output_dir_arg, "masterkey.journal")
         excluded_paths = [
             os.path.abspath(os.path.join(output_dir_arg, "masterkey.enc")),
+            os.path.abspath(os.path.join(output_dir_arg, "masterkey.enc.tmp")),
             os.path.abspath(os.path.join(output_dir_arg, "master_salt.txt")),
-            temp_jsonl_path
+            os.path.abspath(journal_path),
         ]
 
-        paths_to_encrypt = [
-            p for p in traverse_iterative([target_dir_arg]) 
-            if os.path.isfile(p) and os.path.abspath(p) not in excluded_paths
-        ]
+        # scandir で走査し、走査時の stat (size, mtime_ns, inode) を後段でもそのまま使う
+        scan_errors = []
+        paths_to_encrypt = list(scanner.scan_tree([target_dir_arg], jobs=args.jobs, symlinks=args.symlinks,
+                                                  path_filter=path_filter, skip_paths=excluded_paths,
+                                                  errors=scan_errors))
+        for error_path, error in scan_errors:
+            print(f"警告: 読み込めないためスキップしました: {error_path}: {error}")
+        # マニフェストはパス順に並べて書く (差分バックアップで前回のマニフェストと突き合わせるため)
+        paths_to_encrypt.sort(key=lambda record: path_sort_key(record.path))
         
-        if not paths_to_encrypt:
+        cdc_params = None
+        chunk_index = None
+        if args.chunking == "fastcdc":
+            try:
+                cdc_params = cdc.validate_params(cdc.CDCParams(args.cdc_min, args.cdc_avg, args.cdc_max))
+            except ValueError as e:
+                print(f"エラー: {e}")
+                sys.exit(1)
+
+        compression_settings = compression.make_settings(args.compress, args.compress_level)
+        compression_stats = compression.CompressionStats()
+
+        # メモリの上限があれば、scryptより前に収まるワーカー数とチャンクサイズを決めておく
+        budget = MemoryBudget(args.memory_limit)
+        jobs = args.jobs
+        chunk_size = CHUNK_SIZE
+        if args.memory_limit is not None:
+            try:
+                plan = plan_encrypt(args.memory_limit, args.jobs, CHUNK_SIZE, args.executor,
+                                    compression_settings is not None, cdc_params.max_size if cdc_params else None)
+            except ValueError as e:
+                print(f"エラー: {e}")
+                sys.exit(1)
+            if plan.jobs != jobs:
+                print(f"メモリの上限に合わせてワーカー数を {jobs} -> {plan.jobs} に減らしました。")
+            if cdc_params is None and plan.chunk_size != chunk_size:
+                print(f"メモリの上限に合わせてチャンクサイズを {chunk_size / 2**20:.0f} MB -> "
+                      f"{plan.chunk_size / 2**20:.0f} MB に減らしました。")
+                chunk_size = plan.chunk_size
+            jobs = plan.jobs
+            print(f"チャンク処理のメモリの見積もり: {(plan.working_set + BASE_OVERHEAD) / 2**20:.0f} MB "
+                  f"(上限 {args.memory_limit / 2**20:.0f} MB)")
+
+        # マスター鍵はこの実行で一度だけscryptで導出し、各ファイルの鍵はHKDFで派生させる
+        # 出力先に既存のアーカイブがあればそのソルトを引き継ぐ (同じパスワードなら同じマスター鍵になり、
+        # 以前の実行で書いた重複排除チャンクをそのまま参照できる)
+        # 再開する場合は、中断した実行が使ったソルトをジャーナルから読む (初回の実行では master_salt.txt は
+        # 最後に書かれるので、まだ無い)
+        master_salt_filepath = os.path.join(output_dir_arg, "master_salt.txt")
+        journal_exists = os.path.exists(journal_path)
+        output_storage = LocalStorage(output_dir_arg)
+        if args.resume and journal_exists:
+            master_salt = read_salt(journal_path)
+            if master_salt is None:
+                print(f"エラー: {journal_path} はジャーナルではありません。")
+                sys.exit(1)
+        elif os.path.exists(master_salt_filepath):
+            with open(master_salt_filepath, "r") as h:
+                master_salt = bytes.fromhex(h.read().strip())
+        else:
+            master_salt = get_random_bytes(AES.block_size)
+        with budget.reserve(scrypt_bytes()), metrics.timer("kdf"):
+            master_key = derive_key(master_password_arg, master_salt)
+
+        # 中断した実行のジャーナルから、完了済みのファイルと書き終えたチャンクを引き継ぐ
+        journal_reader = None
+        recovery = None
+        if args.resume and journal_exists:
+            try:
+                journal_reader = JournalReader(journal_path, master_key)
+            except ValueError as e:
+                print(f"エラー: {e}")
+                sys.exit(1)
+            recovery = Recovery(journal_reader, output_dir_arg,
+                                check_chunk=lambda base_db, chunk: check_journaled_chunk(base_db, chunk, master_key))
+            print(f"再開: 前回までに完了したファイル {recovery.complete} 件, 途中のファイル {len(recovery.partial)} 件, "
+                  f"書き終えたチャンク {recovery.chunks} 個を引き継ぎます "
+                  f"(記録されていなかった書きかけのオブジェクト {recovery.removed} 個を削除しました)。")
+        elif args.resume:
+            print("再開するジャーナルが無いため、最初から暗号化します。")
+        elif journal_exists:
+            print(f"警告: 中断した実行のジャーナル {journal_path} を破棄して最初から暗号化します "
+                  "(続きから再開するには --resume を指定してください)。")
+            os.remove(journal_path)
+
+        packer = None
+        if args.pack_small:
+            packer = PackWriter(output_dir_arg, args.pack_size, args.pack_small)
+
+        # 重複排除の索引は、再開時の書きかけのオブジェクトを削除した後で出力ディレクトリから作る
+        if cdc_params is not None:
+            chunk_index = ChunkIndex(output_dir_arg)
+
+        # 前回のマニフェストは差分バックアップと、パックに入った重複排除チャンクの参照に使う
+        encrypted_master_file = os.path.join(output_dir_arg, "masterkey.enc")
+        prior_manifest = None
+        if (args.incremental or chunk_index is not None) and os.path.exists(encrypted_master_file):
+            prior_manifest = load_manifest(encrypted_master_file, master_key)
+            if prior_manifest is not None and chunk_index is not None:
+                for entry in prior_manifest:
+                    if not entry.get("deleted"):
+                        chunk_index.add_entry(entry)
+        if recovery is not None and chunk_index is not None:
+            for entry in recovery:
+                chunk_index.add_entry(entry)
+            for base_db, chunks, _options in recovery.partial.values():
+                chunk_index.add_entry({"chunks": chunks})
+
+        hash_key = derive_file_hash_key(master_key) if args.hash_check else None
+        changed_records = paths_to_encrypt
+        incremental = False
+        if args.incremental:
+            if os.path.exists(encrypted_master_file):
+                if prior_manifest is None:
+                    print("エラー: 前回のマニフェストを復号できません。差分バックアップには前回と同じマスターパスワードが必要です。")
+                    sys.exit(1)
+                incremental = True
+            else:
+                print("前回のマニフェストが無いため、全ファイルを暗号化します。")
+        # ジャーナルで完了済みのファイルは差分バックアップの「変更なし」と同じように引き継ぐ
+        # (差分バックアップなら前回のマニフェストにジャーナルの分を重ねて比べる)
+        prior_entries = prior_manifest if incremental else None
+        resume = None
+        if recovery is not None:
+            prior_entries = recovery.overlay(prior_manifest) if incremental else recovery
+            resume = recovery.resumable(chunk_size)
+        if prior_entries is not None:
+            changed_records, counts = plan_incremental(paths_to_encrypt, prior_entries, hash_key)
+            if incremental:
+                print(f"差分バックアップ: 新規 {counts['new']}, 変更 {counts['changed']}, "
+                      f"変更なし {counts['unchanged']}, 削除 {counts['deleted']}")
+            if recovery is not None:
+                print(f"再開: 暗号化済み {counts['unchanged']} 件, 残り {len(changed_records)} 件")
+
+        if not paths_to_encrypt and not incremental and recovery is None:
             print(f"警告: {target_dir_arg} 内に暗号化対象ファイルが見つかりませんでした（除外パスを考慮した後）。")
+            print("暗号化対象ファイルが見つからなかったため、マスターキーファイルの作成をスキップしました。")
         else:
-            for path in paths_to_encrypt:
-                print(f"暗号化中: {path}")
-                file_password = gen_rndstring.generate_random_string(120)
-                # encrypt関数のjsonl_writeはカレントディレクトリの "dirinfo.json" に書き込む
-                encrypt(path, output_dir_arg, file_password) # master_mode はデフォルトで False
-        
-        if os.path.exists(temp_jsonl_path): # 何かファイルが暗号化され、dirinfo.jsonが生成された場合のみ
-            print(f"{temp_jsonl_path} をマスターパスワードで暗号化しています...")
-            # 最後にdirinfo.jsonをmaster_passwordで暗号化して終了
-            # encrypt関数は file_path として temp_jsonl_path を受け取る
-            final_master_salt = encrypt(temp_jsonl_path, output_dir_arg, master_password_arg, True) # master_mode=True
-            
-            os.remove(temp_jsonl_path) # 元のdirinfo.jsonは削除
-            
+            # 書き終えたチャンクと完了したファイルをジャーナルに記録しながら暗号化する
+            journal = JournalWriter(journal_path, master_key, master_salt, {
+                "chunking": args.chunking,
+                "chunk_size": chunk_size,
+                "cdc": list(cdc_params) if cdc_params is not None else None,
+                "incremental": args.incremental,
+            }, resume_from=journal_reader, storage=output_storage)
+            metrics.set("files_expected", len(changed_records))
+            metrics.set("bytes_expected", sum(record.st_size for record in changed_records))
+            # エントリは並列度に関係なくパス順で返ってくるので、そのままマニフェストに流し込む
+            entries = encrypt_paths(changed_records, output_dir_arg, master_key,
+                                    jobs=jobs, executor=args.executor, chunk_size=chunk_size,
+                                    cdc_params=cdc_params, index=chunk_index, hash_key=hash_key,
+                                    compression=compression_settings, compression_stats=compression_stats,
+                                    packer=packer, budget=budget, journal=journal, resume=resume, metrics=metrics,
+                                    storage=output_storage)
+            if prior_entries is not None:
+                # 変更のないファイル (ジャーナルで完了済みのファイル) は前回のチャンクをそのまま参照し、
+                # 差分バックアップなら削除されたファイルは記録だけ残す
+                entries = merge_incremental(paths_to_encrypt, prior_entries, changed_records, entries,
+                                            record_deleted=incremental)
+            # マニフェストは平文の一時ファイルを作らず、暗号化したセグメントを masterkey.enc.tmp に直接書き、
+            # 最後に masterkey.enc へリネームする
+            manifest_writer = ManifestWriter(encrypted_master_file, master_key)
+            try:
+                for entry in entries:
+                    manifest_writer.add(entry)
+                entries.close()
+                manifest_writer.close()
+            except Exception as e:
+                # 失敗したジョブがあればマニフェストを作らずに終了する (既存の masterkey.enc はそのまま)
+                entries.close()
+                manifest_writer.abort()
+                journal.close()
+                if prior_manifest is not None:
+                    prior_manifest.close()
+                print(f"エラー: 暗号化中にエラーが発生したため中止します: {e}")
+                print("原因を取り除いてから --resume を付けて実行すると、続きから再開できます。")
+                sys.exit(1)
+            # 前回のマニフェストだけが参照していたオブジェクトは、ソルトまで確定した後で削除する
+            superseded = set()
+            if prior_manifest is not None:
+                with prior_manifest, open_manifest(encrypted_master_file, master_key) as new_manifest:
+                    superseded = superseded_objects(prior_manifest, new_manifest)
+            if changed_records:
+                if packer is not None:
+                    print(f"パック: {packer.blobs} チャンクを {packer.packs} 個のパックファイルにまとめました "
+                          f"({packer.bytes / 2**20:.1f} MB)")
+                if compression_settings is not None:
+                    print(f"圧縮 ({compression_settings.codec}): {compression_stats.line()}")
+                if chunk_index is not None:
+                    print(f"重複排除: {chunk_index.chunks} チャンク中 {chunk_index.new_chunks} 個が新規, "
+                          f"重複排除率 {chunk_index.dedup_ratio:.2f}x, "
+                          f"削減 {chunk_index.saved_bytes / 2**20:.1f} MB / {chunk_index.bytes / 2**20:.1f} MB")
+
             # master_salt.txt も output_dir_arg に保存
-            master_salt_filepath = os.path.join(output_dir_arg, "master_salt.txt")
             with open(master_salt_filepath, "w") as h:
-                h.write(final_master_salt)
+                h.write(master_salt.hex())
             print(f"マスターソルトを {master_salt_filepath} に保存しました。")
-            print(f"マスターキーファイルは {os.path.join(output_dir_arg, 'masterkey.enc')} として保存されました。")
-        elif paths_to_encrypt: # 暗号化対象パスはあったが、dirinfo.jsonが何らかの理由で生成されなかった場合
-             print(f"警告: 暗号化対象ファイルはありましたが、{temp_jsonl_path} が生成されませんでした。マスターキーファイルの作成をスキップします。")
-        else: # 暗号化対象が最初からなかった場合
-            print("暗号化対象ファイルが見つからなかったため、dirinfo.json およびマスターキーファイルの作成をスキップしました。")
+            # マニフェストとソルトが揃ったので、ジャーナルはもう要らない
+            journal.remove()
+            print(f"マスターキーファイルは {encrypted_master_file} として保存されました "
+                  f"({manifest_writer.entries} エントリ)。")
+            if superseded and args.keep_superseded:
+                print(f"前回のマニフェストだけが参照していたオブジェクト {len(superseded)} 個を残しました "
+                      "(--keep-superseded)。")
+            elif superseded:
+                removed, removed_bytes = prune_objects(output_storage, superseded)
+                print(f"変更・削除されたファイルの古いオブジェクト {removed} 個 ({removed_bytes / 2**20:.1f} MB) "
+                      "を削除しました。")
+        report_memory(budget)
         print("--- 暗号化処理完了 ---")
 
     elif mode == "decrypt":
@@ -365,13 +1183,61 @@ if __name__ == '__main__':
             os.makedirs(restoration_dir_arg)
             print(f"復元先ディレクトリを作成しました: {restoration_dir_arg}")
 
-        main_decrypt_process(
+        budget = MemoryBudget(args.memory_limit)
+        jobs = plan_restore_jobs(args)
+
+        progress = main_decrypt_process(
             master_password_arg,
             restoration_dir_arg,
-            encrypted_files_dir_arg # masterkey.enc と master_salt.txt があるディレクトリ
+            encrypted_files_dir_arg, # masterkey.enc と master_salt.txt があるディレクトリ
+            jobs,
+            path_filter,
+            budget,
+            metrics,
+            storage
         )
+        report_memory(budget)
         print("--- 復号化処理完了 ---")
+        if progress is None or progress.failures:
+            sys.exit(1)
+
+    elif mode == "list":
+        if main_list_process(master_password_arg, arg2, path_filter, storage) is None:
+            sys.exit(1)
+
+    elif mode == "verify":
+        # verify は main の関数を使うので、ここで読み込む (先頭で読み込むと循環する)
+        import verify
+        print("\n--- 検証処理開始 ---")
+        budget = MemoryBudget(args.memory_limit)
+        jobs = plan_restore_jobs(args) if not args.quick else args.jobs
+        report = verify.main_verify_process(
+            master_password_arg,
+            arg2,
+            None if arg1 == "-" else arg1,
+            verify.MODE_QUICK if args.quick else verify.MODE_FULL,
+            jobs,
+            path_filter,
+            budget,
+            metrics,
+            storage
+        )
+        report_memory(budget)
+        print("--- 検証処理完了 ---")
+        if report is None or not report.ok:
+            sys.exit(1)
     
+    elif mode == "copy":
+        print("\n--- コピー処理開始 ---")
+        try:
+            copied = main_copy_process(master_password_arg, arg2, arg1, args.jobs, metrics)
+        except (OSError, ValueError) as e:
+            print(f"エラー: {e}")
+            copied = None
+        print("--- コピー処理完了 ---")
+        if copied is None:
+            sys.exit(1)
+
     else:
-        print(f"エラー: 不明なモード '{mode}'。'encrypt' または 'decrypt' を指定してください。")
+        print(f"エラー: 不明なモード '{mode}'。'encrypt', 'decrypt', 'list', 'verify' または 'copy' を指定してください。")
         sys.exit(1)
\ No newline at end of file
@@ -0,0 +1,451 @@
+"""
+アーカイブのマニフェスト (masterkey.enc)。
+
+ファイル毎のエントリ (パス・鍵導出情報・stat・チャンクのリスト) を、平文の一時ファイルを作らずに
+暗号化したセグメントとして直接書き出す。形式:
+
+    MAGIC
+    セグメント * N   (4バイト長 + encrypt_chunk 形式のブロック, AAD = manifest_segment:<番号>)
+    索引             (4バイト長 + encrypt_chunk 形式のブロック, AAD = manifest_index)
+    フッター         (索引のオフセット 8バイト + 索引の長さ 4バイト + MAGIC_END)
+
+セグメントの中身は zlib 圧縮したエントリの列で、パスは直前のエントリとの共通接頭辞の長さと
+残りの部分だけを持つ (front coding)。チャンクはアーカイブの中での相対的なキー (storage.object_key) だけを持ち、
+読み込むときにマニフェストを開いた場所を基準にパスに戻すので、アーカイブを移動・別の保存先にコピーしてもそのまま読める。
+索引はセグメント毎の (最小のパス, 最大のパス, オフセット, 長さ, 件数) なので、1つのパスを引くときは
+索引と該当するセグメントだけを復号すればよい。書き込み・読み込みともメモリは1セグメント分で済む。
+
+旧形式 (平文のJSONLを丸ごと1チャンクで暗号化したもの) も読み込める。
+"""
+import fnmatch
+import json
+import os
+import struct
+import zlib
+
+from AES256GCM import *
+from storage import object_key
+
+MAGIC = b"PCDMANI2"
+MAGIC_END = b"PCDMEND2"
+_FOOTER = struct.Struct(">QI8s")
+_LENGTH = struct.Struct(">I")
+
+# 1セグメントに入れるエントリ数と、圧縮前のバイト数の上限
+SEGMENT_ENTRIES = 4096
+SEGMENT_BYTES = 4 * 1024 * 1024
+
+# 旧形式のレコードのうち、チャンク単位のフィールド
+CHUNK_FIELDS = ("chunk_id", "chunk_name", "offset", "size", "cas", "codec", "pack_offset", "pack_length")
+
+
+def derive_manifest_key(master_key):
+    return derive_subkey(master_key, b"", b"pycryptodrive:manifest")
+
+
+def entry_key(entry):
+    """エントリのパス (元の絶対パス) を文字列で返す。"""
+    return "/".join(entry["path"] + [entry["name"]])
+
+
+def path_sort_key(path):
+    """
+    マニフェストの並び順。パスの要素毎に比較するので、ディレクトリを名前順に深さ優先で
+    たどった順と一致する (文字列のままだと "a.txt" と "a/b" の順が逆になる)。
+    """
+    return path.split("/")
+
+
+def _encode_varint(n, out):
+    while n >= 0x80:
+        out.append((n & 0x7f) | 0x80)
+        n >>= 7
+    out.append(n)
+
+
+def _decode_varint(data, pos):
+    n = shift = 0
+    while True:
+        b = data[pos]
+        pos += 1
+        n |= (b & 0x7f) << shift
+        if b < 0x80:
+            return n, pos
+        shift += 7
+
+
+def _pack_chunks(entry):
+    """チャンクのファイル名をアーカイブの中でのキー ("n") にする。"""
+    packed = []
+    for chunk in entry.get("chunks", []):
+        chunk = dict(chunk)
+        name = chunk.pop("chunk_name", None)
+        if name:
+            chunk["n"] = object_key(name)
+        packed.append(chunk)
+    return packed
+
+
+def _unpack_chunks(entry, base):
+    """
+    チャンクのキーを、マニフェストを開いたアーカイブ base の中のパスに戻す (base が "" ならキーのまま)。
+    絶対パスで記録された旧形式のチャンク名も、記録した場所ではなく base の中のオブジェクトとして読む。
+    """
+    for chunk in entry.get("chunks", []):
+        if "n" in chunk:
+            chunk["chunk_name"] = os.path.join(base, chunk.pop("n"))
+        elif chunk.get("chunk_name"):
+            chunk["chunk_name"] = os.path.join(base, object_key(chunk["chunk_name"]))
+
+
+def _encode_entry(entry, previous_key, out):
+    key = entry_key(entry).encode("utf-8")
+    shared = 0
+    limit = min(len(key), len(previous_key))
+    while shared < limit and key[shared] == previous_key[shared]:
+        shared += 1
+    meta = {k: v for k, v in entry.items() if k not in ("path", "name", "chunks")}
+    if "chunks" in entry:
+        meta["chunks"] = _pack_chunks(entry)
+    meta = json.dumps(meta, separators=(",", ":")).encode("utf-8")
+    _encode_varint(shared, out)
+    _encode_varint(len(key) - shared, out)
+    out += key[shared:]
+    _encode_varint(len(meta), out)
+    out += meta
+    return key
+
+
+def _decode_entries(payload, base):
+    previous_key = b""
+    pos = 0
+    while pos < len(payload):
+        shared, pos = _decode_varint(payload, pos)
+        suffix_len, pos = _decode_varint(payload, pos)
+        key = previous_key[:shared] + payload[pos:pos + suffix_len]
+        pos += suffix_len
+        meta_len, pos = _decode_varint(payload, pos)
+        entry = json.loads(payload[pos:pos + meta_len])
+        pos += meta_len
+        parts = key.decode("utf-8").split("/")
+        entry["path"] = parts[:-1]
+        entry["name"] = parts[-1]
+        _unpack_chunks(entry, base)
+        previous_key = key
+        yield entry
+
+
+_GLOB_CHARS = set("*?[")
+
+
+class PathFilter:
+    """
+    --include / --exclude のパターンでエントリを選ぶ。パターンは / 区切りの要素毎に fnmatch で比較する
+    (* は / をまたがない)。/ で始まるパターンは元の絶対パスの先頭から、それ以外は末尾の要素から比較する
+    ("*.conf" はどのディレクトリの .conf にも一致する)。ディレクトリに一致した場合はその下の全ファイルが一致する。
+    include が無ければ全て、あれば一致したものだけを選び、exclude に一致したものは除く。
+    """
+    def __init__(self, includes=(), excludes=()):
+        self.includes = [self._compile(p) for p in includes]
+        self.excludes = [self._compile(p) for p in excludes]
+        self.prefixes = self._literal_prefixes()
+
+    @staticmethod
+    def _compile(pattern):
+        anchored = pattern.startswith("/")
+        parts = [p for p in pattern.rstrip("/").split("/") if p]
+        return anchored, parts
+
+    def _literal_prefixes(self):
+        """
+        全ての include が / で始まる場合、ワイルドカードより前の部分 (path_sort_key の形) のリストを返す。
+        索引でこれらと範囲が重ならないセグメントは復号しなくてよい。絞り込めない場合は None。
+        """
+        if not self.includes or not all(anchored for anchored, _parts in self.includes):
+            return None
+        prefixes = []
+        for _anchored, parts in self.includes:
+            literal = []
+            for part in parts:
+                if _GLOB_CHARS & set(part):
+                    break
+                literal.append(part)
+            prefixes.append([""] + literal)
+        return prefixes
+
+    @staticmethod
+    def _matches_one(pattern, parts):
+        anchored, pattern_parts = pattern
+        n = len(pattern_parts)
+        # 対象自身か、その祖先のディレクトリのどれかに一致すれば一致
+        for end in range(len(parts), 0, -1):
+            candidate = parts[1:end] if anchored else parts[:end][-n:]
+            if len(candidate) == n and all(fnmatch.fnmatchcase(c, p) for c, p in zip(candidate, pattern_parts)):
+                return True
+        return False
+
+    def matches(self, path):
+        parts = path.split("/")
+        if self.includes and not any(self._matches_one(p, parts) for p in self.includes):
+            return False
+        return not any(self._matches_one(p, parts) for p in self.excludes)
+
+    def excluded(self, path):
+        """exclude のどれかに一致するか (走査時にディレクトリを配下ごと除くのに使う)。"""
+        parts = path.split("/")
+        return any(self._matches_one(p, parts) for p in self.excludes)
+
+
+def _segment_overlaps(first, last, prefix):
+    n = len(prefix)
+    return path_sort_key(first)[:n] <= prefix <= path_sort_key(last)[:n]
+
+
+class ManifestWriter:
+    """
+    エントリを受け取り、セグメント単位で暗号化しながら path.tmp に書き出す。
+    close() で索引とフッターを書いて fsync し、path にリネームする。
+    エントリは path_sort_key の順で渡すと索引での検索が1セグメントで済む (順不同でも正しく引ける)。
+    """
+    def __init__(self, path, master_key, segment_entries=SEGMENT_ENTRIES, segment_bytes=SEGMENT_BYTES):
+        self.path = path
+        self.key = derive_manifest_key(master_key)
+        self.segment_entries = segment_entries
+        self.segment_bytes = segment_bytes
+        self.entries = 0
+        self._file = open(path + ".tmp", "wb")
+        self._file.write(MAGIC)
+        self._offset = len(MAGIC)
+        self._index = []
+        self._reset_segment()
+
+    def _reset_segment(self):
+        self._payload = bytearray()
+        self._previous_key = b""
+        self._count = 0
+        self._min = None
+        self._max = None
+
+    def add(self, entry):
+        key = entry_key(entry)
+        sort_key = path_sort_key(key)
+        if self._min is None or sort_key < path_sort_key(self._min):
+            self._min = key
+        if self._max is None or sort_key > path_sort_key(self._max):
+            self._max = key
+        self._previous_key = _encode_entry(entry, self._previous_key, self._payload)
+        self._count += 1
+        self.entries += 1
+        if self._count >= self.segment_entries or len(self._payload) >= self.segment_bytes:
+            self._flush_segment()
+
+    def _write_block(self, plaintext, associated_data):
+        block = encrypt_chunk_with_aad(zlib.compress(bytes(plaintext), 6), self.key, associated_data)
+        self._file.write(_LENGTH.pack(len(block)))
+        self._file.write(block)
+        offset = self._offset
+        self._offset += _LENGTH.size + len(block)
+        return offset, _LENGTH.size + len(block)
+
+    def _flush_segment(self):
+        if not self._count:
+            return
+        number = len(self._index)
+        offset, length = self._write_block(self._payload, b"manifest_segment:" + str(number).encode())
+        self._index.append([self._min, self._max, offset, length, self._count])
+        self._reset_segment()
+
+    def close(self):
+        self._flush_segment()
+        index = json.dumps({"segments": self._index, "entries": self.entries}, separators=(",", ":")).encode("utf-8")
+        index_offset, index_length = self._write_block(index, b"manifest_index")
+        self._file.write(_FOOTER.pack(index_offset, index_length, MAGIC_END))
+        self._file.flush()
+        os.fsync(self._file.fileno())
+        self._file.close()
+        os.replace(self.path + ".tmp", self.path)
+
+    def abort(self):
+        self._file.close()
+        if os.path.exists(self.path + ".tmp"):
+            os.remove(self.path + ".tmp")
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc, tb):
+        if exc_type is None:
+            self.close()
+        else:
+            self.abort()
+        return False
+
+
+class ManifestReader:
+    """
+    新形式のマニフェストを読む。開いた時点では索引だけを復号する。
+    for で回すとセグメントを1つずつ復号しながらエントリを返し (何度でも回せる)、
+    lookup(path) は該当するセグメントだけを復号して1エントリを返す。
+    チャンクのパスは base (省略時はマニフェストのあるディレクトリ) を基準にする。
+    """
+    def __init__(self, path, master_key, base=None):
+        self.path = path
+        self.base = os.path.dirname(path) if base is None else base
+        self.key = derive_manifest_key(master_key)
+        self._fd = os.open(path, os.O_RDONLY)
+        try:
+            size = os.fstat(self._fd).st_size
+            if size < len(MAGIC) + _FOOTER.size:
+                raise ValueError("マニフェストが短すぎます。")
+            index_offset, index_length, magic_end = _FOOTER.unpack(os.pread(self._fd, _FOOTER.size, size - _FOOTER.size))
+            if magic_end != MAGIC_END:
+                raise ValueError("マニフェストのフッターが不正です (書き込みが完了していない可能性があります)。")
+            index = json.loads(self._read_block(index_offset, index_length, b"manifest_index"))
+        except BaseException:
+            os.close(self._fd)
+            raise
+        self.segments = index["segments"]
+        self.entries = index["entries"]
+        self._cached_segment = None
+        self._cached_entries = None
+
+    def _read_block(self, offset, length, expected_aad):
+        data = os.pread(self._fd, length, offset)
+        if len(data) != length:
+            raise ValueError("マニフェストが途中で切れています。")
+        plaintext, associated_data = decrypt_chunk(memoryview(data)[_LENGTH.size:], self.key)
+        if associated_data != expected_aad:
+            raise ValueError(f"マニフェストのブロックの順序が不正です (期待値 {expected_aad!r})。")
+        return zlib.decompress(plaintext)
+
+    def _segment_entries(self, number):
+        _min, _max, offset, length, _count = self.segments[number]
+        payload = self._read_block(offset, length, b"manifest_segment:" + str(number).encode())
+        return _decode_entries(payload, self.base)
+
+    def __iter__(self):
+        for number in range(len(self.segments)):
+            yield from self._segment_entries(number)
+
+    def __len__(self):
+        return self.entries
+
+    def select(self, path_filter=None):
+        """
+        path_filter (PathFilter) に一致するエントリを返す。パターンの先頭が固定のパスであれば、
+        索引でその範囲を含まないセグメントは読み飛ばすので、コストは選んだ範囲に比例する。
+        """
+        if path_filter is None:
+            yield from self
+            return
+        prefixes = path_filter.prefixes
+        for number, (first, last, *_rest) in enumerate(self.segments):
+            if prefixes is not None and not any(_segment_overlaps(first, last, p) for p in prefixes):
+                continue
+            for entry in self._segment_entries(number):
+                if path_filter.matches(entry_key(entry)):
+                    yield entry
+
+    def lookup(self, path):
+        """path (元の絶対パス) のエントリを返す。無ければ None。"""
+        sort_key = path_sort_key(path)
+        for number, (first, last, *_rest) in enumerate(self.segments):
+            if not (path_sort_key(first) <= sort_key <= path_sort_key(last)):
+                continue
+            # 整列済みの入力を順に引く場合 (差分バックアップ等) は同じセグメントが続くので、直前のものを使い回す
+            if self._cached_segment != number:
+                self._cached_entries = {entry_key(e): e for e in self._segment_entries(number)}
+                self._cached_segment = number
+            entry = self._cached_entries.get(path)
+            if entry is not None:
+                return entry
+        return None
+
+    def close(self):
+        if self._fd is not None:
+            os.close(self._fd)
+            self._fd = None
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        self.close()
+        return False
+
+
+class LegacyManifest:
+    """旧形式 (JSONL) のマニフェストをエントリの列として扱う。全体をメモリに載せる。チャンクのパスは base を基準にする。"""
+    def __init__(self, dir_info_jsonl_content, base=""):
+        self._entries = sorted(entries_from_jsonl(dir_info_jsonl_content), key=lambda e: path_sort_key(entry_key(e)))
+        for entry in self._entries:
+            _unpack_chunks(entry, base)
+        self._by_path = {entry_key(e): e for e in self._entries}
+        self.entries = len(self._entries)
+
+    def __iter__(self):
+        return iter(self._entries)
+
+    def __len__(self):
+        return self.entries
+
+    def select(self, path_filter=None):
+        if path_filter is None:
+            return iter(self._entries)
+        return (e for e in self._entries if path_filter.matches(entry_key(e)))
+
+    def lookup(self, path):
+        return self._by_path.get(path)
+
+    def close(self):
+        pass
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        return False
+
+
+def entries_from_jsonl(dir_info_jsonl_content):
+    """旧形式のチャンク毎のレコードを、ファイル毎のエントリにまとめる。"""
+    entries = {}
+    for line_str in dir_info_jsonl_content.strip().split("\n"):
+        if not line_str:
+            continue
+        try:
+            record = json.loads(line_str)
+        except json.JSONDecodeError:
+            print(f"警告: JSONLの行の解析に失敗しました: {line_str}")
+            continue
+        key = entry_key(record)
+        if record.get("deleted"):
+            entries[key] = record
+            continue
+        entry = entries.get(key)
+        if entry is None:
+            entry = {k: v for k, v in record.items() if k not in CHUNK_FIELDS}
+            entry["chunks"] = []
+            entries[key] = entry
+        entry["chunks"].append({k: record[k] for k in CHUNK_FIELDS if k in record})
+    for entry in entries.values():
+        entry.get("chunks", []).sort(key=lambda c: c["chunk_id"])
+    return list(entries.values())
+
+
+def open_manifest(path, master_key, base=None):
+    """
+    masterkey.enc を開いて ManifestReader (新形式) か LegacyManifest (旧形式) を返す。
+    鍵が違う・改ざんされている場合は ValueError を送出する。
+    チャンクのパスは base (省略時は path のあるディレクトリ、"" ならアーカイブの中でのキーのまま) を基準にする。
+    """
+    if base is None:
+        base = os.path.dirname(path)
+    with open(path, "rb") as f:
+        head = f.read(len(MAGIC))
+        if head == MAGIC:
+            return ManifestReader(path, master_key, base)
+        encrypted_data_block = head + f.read()
+    # 旧形式はマスター鍵で直接暗号化された1つのチャンク
+    decrypted_jsonl_data, _ = decrypt_chunk(encrypted_data_block, master_key)
+    return LegacyManifest(decrypted_jsonl_data.decode("utf-8"), base)
@@ -0,0 +1,347 @@
+"""
+計測 (カウンター・タイマー・ヒストグラム) と、その出力先 (シンク)。
+
+暗号化・復元の各段階は Metrics に値を足していくだけで、表示や書き出しはしない。
+Metrics.start() で起動するスレッドが一定間隔でスナップショットを取り、各シンクに渡す:
+    ProgressSink    人が読む1行の進捗 (interval 秒に一度だけ)
+    JSONLinesSink   スナップショットを1行1件の JSON で追記する統計ファイル
+    PrometheusSink  node_exporter の textfile collector 用のファイル (書き換えは一時ファイルからのリネーム)
+close() で最後のスナップショットを全てのシンクに渡す。
+
+値の更新はロック1つで足すだけなので、チャンク毎・ファイル毎に呼んでも表示のコストはかからない。
+Profiler は --profile で実行全体の cProfile / tracemalloc の結果を保存する。
+"""
+import bisect
+import contextlib
+import cProfile
+import io
+import json
+import os
+import pstats
+import sys
+import threading
+import time
+import tracemalloc
+
+METRIC_PREFIX = "pycryptodrive"
+
+# 1ファイルの処理時間 (秒) のヒストグラムの境界
+LATENCY_BUCKETS = (0.001, 0.005, 0.01, 0.05, 0.1, 0.5, 1.0, 5.0, 10.0, 60.0, 300.0)
+
+# 標準の計測項目: 名前 -> (種類, 説明)
+STANDARD_METRICS = {
+    "files": ("counter", "処理を終えたファイル数"),
+    "files_failed": ("counter", "失敗したファイル数"),
+    "files_expected": ("gauge", "処理する予定のファイル数"),
+    "bytes_expected": ("gauge", "処理する予定の平文のバイト数"),
+    "bytes_processed": ("counter", "処理を終えた平文のバイト数"),
+    "bytes_read": ("counter", "読み込んだバイト数"),
+    "bytes_written": ("counter", "書き出したバイト数"),
+    "chunks": ("counter", "暗号化・復号したチャンク数"),
+    "chunks_deduplicated": ("counter", "重複排除で参照だけしたチャンク数"),
+    "kdf": ("timer", "scrypt による鍵導出"),
+    "cipher": ("timer", "AES-GCM の暗号化・復号"),
+    "compress": ("timer", "圧縮・展開"),
+    "io_wait": ("timer", "ファイルの読み書きを待った時間"),
+    "file_latency": ("histogram", "1ファイルの処理にかかった時間"),
+}
+
+
+class Metrics:
+    """
+    名前付きのカウンター・ゲージ・タイマー・ヒストグラムを持つ。複数のスレッドから更新できる。
+    labels はすべての値に付けるラベル (Prometheus 用。例: {"mode": "encrypt"})。
+    """
+    def __init__(self, labels=None, buckets=LATENCY_BUCKETS):
+        self.labels = dict(labels or {})
+        self.buckets = tuple(buckets)
+        self.started = time.monotonic()
+        self._values = {}
+        self._timers = {}
+        self._histograms = {}
+        self._lock = threading.Lock()
+        self._sinks = []
+        self._stop = threading.Event()
+        self._thread = None
+        self._closed = False
+
+    def add(self, name, amount=1):
+        """カウンター name に amount を足す。"""
+        with self._lock:
+            self._values[name] = self._values.get(name, 0) + amount
+
+    def set(self, name, value):
+        """ゲージ name を value にする。"""
+        with self._lock:
+            self._values[name] = value
+
+    def add_time(self, name, seconds, count=1):
+        """タイマー name に seconds 秒 (count 回分) を足す。"""
+        with self._lock:
+            total, calls = self._timers.get(name, (0.0, 0))
+            self._timers[name] = (total + seconds, calls + count)
+
+    def timer(self, name):
+        """with 文の間の時間をタイマー name に足す。"""
+        return _Timing(self, name)
+
+    def observe(self, name, value):
+        """ヒストグラム name に value を1つ加える。"""
+        with self._lock:
+            histogram = self._histograms.get(name)
+            if histogram is None:
+                histogram = self._histograms[name] = [[0] * (len(self.buckets) + 1), 0.0, 0]
+            histogram[0][bisect.bisect_left(self.buckets, value)] += 1
+            histogram[1] += value
+            histogram[2] += 1
+
+    def value(self, name, default=0):
+        with self._lock:
+            return self._values.get(name, default)
+
+    def snapshot(self):
+        """
+        現在の値を JSON にできる辞書で返す:
+        {"elapsed": 秒, "values": {...}, "timers": {名前: {"seconds", "count"}},
+         "histograms": {名前: {"buckets": [[上限, 累積数], ...], "sum", "count"}}}
+        """
+        with self._lock:
+            values = dict(self._values)
+            timers = {name: {"seconds": total, "count": calls} for name, (total, calls) in self._timers.items()}
+            histograms = {}
+            for name, (counts, total, calls) in self._histograms.items():
+                cumulative = 0
+                buckets = []
+                for bound, count in zip(self.buckets + (float("inf"),), counts):
+                    cumulative += count
+                    buckets.append(["+Inf" if bound == float("inf") else bound, cumulative])
+                histograms[name] = {"buckets": buckets, "sum": total, "count": calls}
+        return {"elapsed": time.monotonic() - self.started, "values": values, "timers": timers,
+                "histograms": histograms}
+
+    # --- シンク ---
+
+    def add_sink(self, sink):
+        self._sinks.append(sink)
+
+    def start(self):
+        """シンクに定期的にスナップショットを渡すスレッドを起動する。"""
+        if self._sinks and self._thread is None:
+            self._thread = threading.Thread(target=self._report, daemon=True)
+            self._thread.start()
+
+    def _report(self):
+        interval = min(sink.interval for sink in self._sinks)
+        while not self._stop.wait(interval):
+            self._emit(final=False)
+
+    def _emit(self, final):
+        snapshot = self.snapshot()
+        for sink in self._sinks:
+            try:
+                sink.emit(self, snapshot, final)
+            except OSError as e:
+                print(f"警告: 統計を書き出せません: {e}", file=sys.stderr)
+
+    def close(self):
+        """定期的な出力を止め、最後のスナップショットを全てのシンクに渡す (2回目以降は何もしない)。"""
+        if self._closed:
+            return
+        self._closed = True
+        self._stop.set()
+        if self._thread is not None:
+            self._thread.join()
+        if self._sinks:
+            self._emit(final=True)
+
+
+def timed(metrics, name):
+    """metrics.timer(name) と同じだが、metrics が None なら何もしない。"""
+    if metrics is None:
+        return contextlib.nullcontext()
+    return metrics.timer(name)
+
+
+class _Timing:
+    def __init__(self, metrics, name):
+        self.metrics = metrics
+        self.name = name
+
+    def __enter__(self):
+        self.started = time.perf_counter()
+        return self
+
+    def __exit__(self, *exc):
+        self.metrics.add_time(self.name, time.perf_counter() - self.started)
+        return False
+
+
+class _Sink:
+    """interval 秒より短い間隔では出力しないシンク。final のときは必ず出力する。"""
+    def __init__(self, interval):
+        self.interval = interval
+        self._last = None
+
+    def emit(self, metrics, snapshot, final):
+        now = time.monotonic()
+        if not final and self._last is not None and now - self._last < self.interval:
+            return
+        self._last = now
+        self.write(metrics, snapshot, final)
+
+
+class ProgressSink(_Sink):
+    """「暗号化中: 120/300 ファイル, 1.2/4.0 GB ...」の形の進捗を interval 秒に一度表示する。最後の1行は表示しない。"""
+    def __init__(self, label, interval=2.0, stream=None):
+        super().__init__(interval)
+        self.label = label
+        self.stream = stream
+
+    def write(self, metrics, snapshot, final):
+        # 何も計測していない間 (走査や鍵導出の間) は表示しない
+        if not final and snapshot["values"]:
+            print(f"{self.label}: {progress_line(snapshot)}", file=self.stream or sys.stdout, flush=True)
+
+
+def progress_line(snapshot):
+    """スナップショットから人が読む1行を作る (処理済み/予定のファイル数・バイト数、速度、残り時間、失敗数)。"""
+    values = snapshot["values"]
+    elapsed = max(snapshot["elapsed"], 1e-9)
+    done = values.get("bytes_processed", 0)
+    expected = values.get("bytes_expected")
+    files = f"{values.get('files', 0)}"
+    if values.get("files_expected") is not None:
+        files += f"/{values['files_expected']}"
+    size = f"{done / 2**20:.1f}"
+    if expected is not None:
+        size += f"/{expected / 2**20:.1f}"
+    rate = done / elapsed
+    line = f"{files} ファイル, {size} MB, {rate / 2**20:.1f} MB/s"
+    if expected and rate > 0 and done < expected:
+        line += f", 残り約 {(expected - done) / rate:.0f}s"
+    failed = values.get("files_failed", 0)
+    if failed:
+        line += f", 失敗 {failed}"
+    return line
+
+
+class JSONLinesSink(_Sink):
+    """スナップショットに時刻を付けて、1行1件の JSON として path に追記する。"""
+    def __init__(self, path, interval=10.0):
+        super().__init__(interval)
+        self.path = path
+
+    def write(self, metrics, snapshot, final):
+        record = {"time": time.time(), "labels": metrics.labels, "final": final}
+        record.update(snapshot)
+        with open(self.path, "a") as h:
+            h.write(json.dumps(record, ensure_ascii=False) + "\n")
+
+
+class PrometheusSink(_Sink):
+    """
+    Prometheus のテキスト形式で path を書き換える (node_exporter の --collector.textfile.directory に置く)。
+    読み手が書きかけのファイルを見ないように、一時ファイルに書いてからリネームする。
+    """
+    def __init__(self, path, interval=10.0, prefix=METRIC_PREFIX):
+        super().__init__(interval)
+        self.path = path
+        self.prefix = prefix
+
+    def write(self, metrics, snapshot, final):
+        tmp_path = self.path + ".tmp"
+        with open(tmp_path, "w") as h:
+            h.write(prometheus_text(snapshot, metrics.labels, self.prefix))
+        os.replace(tmp_path, self.path)
+
+
+def _labels(labels, extra=None):
+    items = dict(labels)
+    if extra:
+        items.update(extra)
+    if not items:
+        return ""
+    escaped = (f'{key}="{str(value).replace(chr(92), chr(92) * 2).replace(chr(34), chr(92) + chr(34))}"'
+               for key, value in sorted(items.items()))
+    return "{" + ",".join(escaped) + "}"
+
+
+def prometheus_text(snapshot, labels=None, prefix=METRIC_PREFIX):
+    """スナップショットを Prometheus のテキスト形式にする。"""
+    labels = labels or {}
+    lines = []
+
+    def metric(name, kind, help_text, samples):
+        lines.append(f"# HELP {name} {help_text}")
+        lines.append(f"# TYPE {name} {kind}")
+        for suffix, extra, value in samples:
+            lines.append(f"{name}{suffix}{_labels(labels, extra)} {value}")
+
+    for name, value in sorted(snapshot["values"].items()):
+        kind, help_text = STANDARD_METRICS.get(name, ("gauge", name))
+        if kind == "counter":
+            metric(f"{prefix}_{name}_total", "counter", help_text, [("", None, value)])
+        else:
+            metric(f"{prefix}_{name}", "gauge", help_text, [("", None, value)])
+    for name, timer in sorted(snapshot["timers"].items()):
+        help_text = STANDARD_METRICS.get(name, ("timer", name))[1]
+        metric(f"{prefix}_{name}_seconds_total", "counter", f"{help_text} (秒)", [("", None, timer["seconds"])])
+        metric(f"{prefix}_{name}_calls_total", "counter", f"{help_text} (回数)", [("", None, timer["count"])])
+    for name, histogram in sorted(snapshot["histograms"].items()):
+        help_text = STANDARD_METRICS.get(name, ("histogram", name))[1]
+        samples = [("_bucket", {"le": bound}, count) for bound, count in histogram["buckets"]]
+        samples += [("_sum", None, histogram["sum"]), ("_count", None, histogram["count"])]
+        metric(f"{prefix}_{name}_seconds", "histogram", help_text, samples)
+    metric(f"{prefix}_elapsed_seconds", "gauge", "実行開始からの経過時間", [("", None, snapshot["elapsed"])])
+    return "\n".join(lines) + "\n"
+
+
+PROFILE_MODES = ("cprofile", "tracemalloc")
+
+
+class Profiler:
+    """
+    実行全体のプロファイルを取り、stop() で output に保存して要約を表示する。
+    cprofile: pstats 形式で保存し (python -m pstats で開ける)、累積時間の上位を表示する。
+              cProfile はメインスレッドだけを測る。ワーカーの時間は Metrics のタイマーで見ること。
+    tracemalloc: 確保した場所毎のメモリの上位を output にテキストで保存し、ピークを表示する。
+    """
+    def __init__(self, mode, output, top=20):
+        if mode not in PROFILE_MODES:
+            raise ValueError(f"不明なプロファイルの種類です: {mode}")
+        self.mode = mode
+        self.output = output
+        self.top = top
+        self._profile = None
+        self._stopped = False
+
+    def start(self):
+        if self.mode == "cprofile":
+            self._profile = cProfile.Profile()
+            self._profile.enable()
+        else:
+            tracemalloc.start()
+
+    def stop(self):
+        if self._stopped:
+            return
+        self._stopped = True
+        if self.mode == "cprofile":
+            self._profile.disable()
+            self._profile.dump_stats(self.output)
+            summary = io.StringIO()
+            pstats.Stats(self._profile, stream=summary).sort_stats("cumulative").print_stats(self.top)
+            print(summary.getvalue())
+        else:
+            snapshot = tracemalloc.take_snapshot()
+            current, peak = tracemalloc.get_traced_memory()
+            tracemalloc.stop()
+            statistics = snapshot.statistics("lineno")
+            with open(self.output, "w") as h:
+                h.write(f"current {current} bytes, peak {peak} bytes\n")
+                for stat in statistics[:200]:
+                    h.write(f"{stat}\n")
+            print(f"tracemalloc: 現在 {current / 2**20:.1f} MB, ピーク {peak / 2**20:.1f} MB")
+            for stat in statistics[:self.top]:
+                print(f"  {stat}")
+        print(f"プロファイルを {self.output} に保存しました。")
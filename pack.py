@@ -0,0 +1,88 @@
+"""
+小さな暗号化チャンクをまとめて保存するパックファイル。
+
+小さなファイルが大量にあると、1チャンク1ファイルでは fsync・inode・ディレクトリの列挙・
+コールドストレージへのコピーがファイル数に比例して遅くなる。
+小さなチャンクは暗号化したブロックをそのまま pack-<ランダム>.pack に連結して書き、
+マニフェストには (パックファイル, オフセット, 長さ) を記録する。
+"""
+import os
+
+DEFAULT_PACK_SIZE = 64 * 1024 * 1024
+DEFAULT_PACK_THRESHOLD = 1024 * 1024
+
+
+class PackWriter:
+    """
+    暗号化済みのブロックをパックファイルに追記していく。
+    パックは target_size を超えた時点で閉じて次のパックを開く。書き込み中は .tmp で、
+    閉じるときに fsync してから本来の名前にリネームする。
+    append はメインスレッドから順に呼ぶ前提 (並列に暗号化したブロックも投入順に追記される)。
+    """
+    def __init__(self, output_dir, target_size=DEFAULT_PACK_SIZE, threshold=DEFAULT_PACK_THRESHOLD):
+        self.output_dir = output_dir
+        self.target_size = target_size
+        self.threshold = threshold
+        self.finished = []
+        self.packs = 0
+        self.blobs = 0
+        self.bytes = 0
+        self._path = None
+        self._file = None
+        self._offset = 0
+
+    def accepts(self, length):
+        """平文が length バイトのチャンクをパックに入れるか。"""
+        return length <= self.threshold
+
+    def _open(self):
+        self._path = os.path.join(self.output_dir, f"pack-{os.urandom(16).hex()}.pack")
+        self._file = open(self._path + ".tmp", "wb")
+        self._offset = 0
+        self.packs += 1
+
+    def append(self, encrypted_data_block):
+        """ブロックを追記し、マニフェストに記録する位置 (chunk_name, pack_offset, pack_length) を返す。"""
+        if self._file is None:
+            self._open()
+        offset = self._offset
+        self._file.write(encrypted_data_block)
+        self._offset += len(encrypted_data_block)
+        self.blobs += 1
+        self.bytes += len(encrypted_data_block)
+        location = {"chunk_name": self._path, "pack_offset": offset, "pack_length": len(encrypted_data_block)}
+        if self._offset >= self.target_size:
+            self._finish()
+        return location
+
+    def sync(self):
+        """書き込み中のパックのここまでの内容を fsync する (ジャーナルに記録する前に呼ぶ)。"""
+        if self._file is not None:
+            self._file.flush()
+            os.fsync(self._file.fileno())
+
+    def _finish(self):
+        self._file.flush()
+        os.fsync(self._file.fileno())
+        self._file.close()
+        os.replace(self._path + ".tmp", self._path)
+        self.finished.append(self._path)
+        self._file = None
+
+    def close(self):
+        """書き込み中のパックを確定する。"""
+        if self._file is not None:
+            self._finish()
+
+    def abort(self):
+        """この実行で書いたパック (書き込み中のものも含む) を全て削除する。"""
+        if self._file is not None:
+            self._file.close()
+            self._file = None
+            self.finished.append(self._path + ".tmp")
+        for path in self.finished:
+            try:
+                os.remove(path)
+            except OSError:
+                pass
+        self.finished = []
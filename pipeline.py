@@ -0,0 +1,282 @@
+"""
+チャンク暗号化のパイプライン。
+
+1つのチャンクの処理を 読み込み → 暗号化 (圧縮) → 書き出し の3段に分け、段の間を長さに上限のある
+キューでつなぐ。ディスクの読み書きとAESの計算が重なるので、1つの大きなファイルでも
+min(ディスク帯域, AES帯域) に近い速度が出る。
+
+* 読み込みは preadv で、あらかじめ確保したバッファ (BufferPool) に直接読み込む。
+* 暗号化は AES-GCM の output= で暗号文用のバッファに直接書き込む。
+* 書き出しはヘッダー・暗号文・タグを連結せずに os.writev でまとめて書く。
+チャンク毎の大きなメモリ確保は圧縮した場合の圧縮結果だけになる。
+
+同じ段の関数を1つのワーカーで順に呼ぶ encrypt_job は、スレッドプール/プロセスプール用。
+"""
+import collections
+import concurrent.futures
+import os
+import queue
+import threading
+import time
+
+from AES256GCM import *
+import cdc
+from compression import CODEC_NONE, compress_chunk
+
+# ジョブの結果: 平文のバイト数, 保存したバイト数 (圧縮後), 使ったコーデック (圧縮しなければ None、
+# 試して圧縮しなかった場合は CODEC_NONE), 圧縮に使ったCPU時間,
+# パックに入れるチャンクの場合は暗号化したブロック (ファイルに書き出した場合は None),
+# 読み込み・暗号化・書き出しにかかった時間 (秒) と暗号化したブロックのバイト数 (計測用)
+ChunkResult = collections.namedtuple("ChunkResult", [
+    "size", "stored_size", "codec", "compress_seconds", "blob",
+    "read_seconds", "cipher_seconds", "write_seconds", "block_size",
+], defaults=(0.0, 0.0, 0.0, 0))
+
+# チャンク1つ分の暗号化ジョブ。
+# content_id が None なら通常のチャンク (AADは chunk_index と元のパス)、そうでなければ重複排除チャンク
+# (AADはコンテンツID)。id_key を指定すると、読み込んだ内容のコンテンツIDが content_id と一致するか確かめる。
+# chunk_filename が None のチャンクはパックに入れるので、書き出さずにブロックを結果に入れて返す。
+ChunkJob = collections.namedtuple("ChunkJob", [
+    "file_path", "offset", "length", "key", "chunk_index", "content_id", "id_key", "chunk_filename", "compression",
+])
+
+
+def read_stage(job, buffer):
+    """ファイルの [offset, offset+length) を buffer (bytearray) に読み込み、その memoryview を返す。"""
+    if len(buffer) < job.length:
+        buffer.extend(bytes(job.length - len(buffer)))
+    view = memoryview(buffer)[:job.length]
+    fd = os.open(job.file_path, os.O_RDONLY)
+    try:
+        read = 0
+        while read < job.length:
+            n = os.preadv(fd, [view[read:]], job.offset + read)
+            if not n:
+                break
+            read += n
+    finally:
+        os.close(fd)
+    view = view[:read]
+    if job.id_key is not None and cdc.content_id(job.id_key, view) != job.content_id:
+        raise IOError(f"暗号化中にファイルが変更されました: {job.file_path}")
+    return view
+
+
+def cipher_stage(job, plain, buffer):
+    """
+    平文を (必要なら圧縮してから) 暗号化し、(ブロックの部品 [ヘッダー, 暗号文, タグ], ChunkResult) を返す。
+    暗号文は buffer (bytearray) 上に書かれる。ChunkResult の blob はまだ入っていない。
+    圧縮しなかったチャンク (CODEC_NONE) のAADにはコーデックを入れない (圧縮を使わない場合と同じブロックになる)。
+    """
+    codec = None
+    payload = plain
+    compress_seconds = 0.0
+    if job.compression is not None:
+        started = time.thread_time()
+        codec, payload = compress_chunk(plain, job.compression)
+        compress_seconds = time.thread_time() - started
+    if len(buffer) < len(payload):
+        buffer.extend(bytes(len(payload) - len(buffer)))
+    aad_codec = None if codec == CODEC_NONE else codec
+    if job.content_id is None:
+        associated_data = chunk_aad(job.chunk_index, job.file_path, aad_codec)
+    else:
+        associated_data = content_aad(job.content_id, aad_codec)
+    started = time.perf_counter()
+    parts = encrypt_chunk_parts(payload, job.key, associated_data, output=buffer)
+    cipher_seconds = time.perf_counter() - started
+    return parts, ChunkResult(len(plain), len(payload), codec, compress_seconds, None,
+                              cipher_seconds=cipher_seconds, block_size=sum(len(p) for p in parts))
+
+
+def _writev_all(fd, parts):
+    """parts を全て書き込む (writev は部分書き込みがあり得る)。"""
+    views = [memoryview(p) for p in parts if len(p)]
+    while views:
+        n = os.writev(fd, views)
+        while views and n >= len(views[0]):
+            n -= len(views[0])
+            views.pop(0)
+        if n:
+            views[0] = views[0][n:]
+
+
+def write_stage(job, parts):
+    """
+    ブロックを chunk_filename に書き出し (一時ファイルに書いてから rename するので、途中で失敗しても
+    壊れたチャンクは残らない)、None を返す。chunk_filename が None (パックに入れるチャンク) の場合は
+    書き出さずにブロックを返し、メインスレッドがパックファイルに追記する。
+    """
+    if job.chunk_filename is None:
+        return b"".join(parts)
+    tmp_filename = job.chunk_filename + ".tmp"
+    fd = os.open(tmp_filename, os.O_WRONLY | os.O_CREAT | os.O_TRUNC, 0o644)
+    try:
+        _writev_all(fd, parts)
+    finally:
+        os.close(fd)
+    os.replace(tmp_filename, job.chunk_filename)
+    return None
+
+
+# encrypt_job のバッファはワーカースレッド毎に1組だけ持ち、チャンク間で使い回す
+_job_buffers = threading.local()
+
+
+def encrypt_job(job):
+    """読み込み・暗号化・書き出しを1つのワーカーで順に行い、ChunkResult を返す。"""
+    if not hasattr(_job_buffers, "plain"):
+        _job_buffers.plain = bytearray()
+        _job_buffers.cipher = bytearray()
+    try:
+        started = time.perf_counter()
+        plain = read_stage(job, _job_buffers.plain)
+        read_seconds = time.perf_counter() - started
+        parts, result = cipher_stage(job, plain, _job_buffers.cipher)
+        started = time.perf_counter()
+        blob = write_stage(job, parts)
+        return result._replace(blob=blob, read_seconds=read_seconds, write_seconds=time.perf_counter() - started)
+    except BaseException:
+        # 例外のトレースバックがバッファの memoryview を掴んだままになる (サイズを変えられない) ので作り直す
+        _job_buffers.plain = bytearray()
+        _job_buffers.cipher = bytearray()
+        raise
+
+
+class BufferPool:
+    """
+    同じ用途のバッファを count 個だけ持ち、使い回す。空いていなければ acquire は待つ。
+    バッファは必要に応じて拡張されるので、release する前にその memoryview を全て手放すこと。
+    """
+    def __init__(self, count):
+        self._free = queue.Queue()
+        for _ in range(count):
+            self._free.put(bytearray())
+
+    def acquire(self):
+        return self._free.get()
+
+    def release(self, buffer):
+        self._free.put(buffer)
+
+    def discard(self, buffer):
+        """例外で memoryview が残っているかもしれないバッファの代わりに、新しいバッファを戻す。"""
+        self._free.put(bytearray())
+
+
+_STOP = object()
+
+
+class ChunkPipeline:
+    """
+    読み込み1スレッド・暗号化 cipher_workers スレッド・書き出し1スレッドのパイプライン。
+    engine の executor として使う: submit(encrypt_job, job) はパイプラインに流して Future を返し、
+    それ以外の関数は別のスレッドプールで実行する。
+
+    段の間のキューの長さと平文・暗号文のバッファ数は depth (省略時は cipher_workers + 1。読み込みと書き出しが
+    暗号化と重なる最小の数) なので、メモリ使用量はおよそ 2 * depth チャンク分で頭打ちになる。
+    """
+    def __init__(self, cipher_workers=1, depth=None):
+        self.cipher_workers = max(cipher_workers, 1)
+        self.depth = depth or self.cipher_workers + 1
+        self._plain_buffers = BufferPool(self.depth)
+        self._cipher_buffers = BufferPool(self.depth)
+        self._read_queue = queue.Queue(self.depth)
+        self._cipher_queue = queue.Queue(self.depth)
+        self._write_queue = queue.Queue(self.depth)
+        self._other = concurrent.futures.ThreadPoolExecutor(max_workers=self.cipher_workers)
+        self._threads = [threading.Thread(target=self._reader, daemon=True)]
+        self._threads += [threading.Thread(target=self._cipher, daemon=True) for _ in range(self.cipher_workers)]
+        self._threads.append(threading.Thread(target=self._writer, daemon=True))
+        for thread in self._threads:
+            thread.start()
+
+    def submit(self, fn, *args):
+        if fn is not encrypt_job:
+            return self._other.submit(fn, *args)
+        future = concurrent.futures.Future()
+        self._read_queue.put((args[0], future))
+        return future
+
+    # 各段はバッファを次の段へ渡した後、そのバッファの memoryview を参照する変数を必ず消す
+    # (次に同じバッファを拡張するときに BufferError にならないように)
+
+    def _reader(self):
+        while True:
+            item = self._read_queue.get()
+            if item is _STOP:
+                for _ in range(self.cipher_workers):
+                    self._cipher_queue.put(_STOP)
+                return
+            job, future = item
+            del item
+            if not future.set_running_or_notify_cancel():
+                continue
+            buffer = self._plain_buffers.acquire()
+            started = time.perf_counter()
+            try:
+                plain = read_stage(job, buffer)
+            except BaseException as e:
+                self._plain_buffers.discard(buffer)
+                future.set_exception(e)
+                continue
+            self._cipher_queue.put((job, future, buffer, plain, time.perf_counter() - started))
+            del plain, buffer
+
+    def _cipher(self):
+        while True:
+            item = self._cipher_queue.get()
+            if item is _STOP:
+                self._write_queue.put(_STOP)
+                return
+            job, future, plain_buffer, plain, read_seconds = item
+            del item
+            buffer = self._cipher_buffers.acquire()
+            try:
+                parts, result = cipher_stage(job, plain, buffer)
+                result = result._replace(read_seconds=read_seconds)
+            except BaseException as e:
+                del plain
+                self._plain_buffers.discard(plain_buffer)
+                self._cipher_buffers.discard(buffer)
+                future.set_exception(e)
+                continue
+            del plain
+            self._plain_buffers.release(plain_buffer)
+            self._write_queue.put((job, future, buffer, parts, result))
+            del parts, buffer
+
+    def _writer(self):
+        stopped = 0
+        while stopped < self.cipher_workers:
+            item = self._write_queue.get()
+            if item is _STOP:
+                stopped += 1
+                continue
+            job, future, buffer, parts, result = item
+            del item
+            started = time.perf_counter()
+            try:
+                blob = write_stage(job, parts)
+            except BaseException as e:
+                del parts
+                self._cipher_buffers.discard(buffer)
+                future.set_exception(e)
+                continue
+            del parts
+            self._cipher_buffers.release(buffer)
+            future.set_result(result._replace(blob=blob, write_seconds=time.perf_counter() - started))
+
+    def shutdown(self, wait=True):
+        self._read_queue.put(_STOP)
+        if wait:
+            for thread in self._threads:
+                thread.join()
+        self._other.shutdown(wait=wait)
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        self.shutdown()
+        return False
@@ -0,0 +1,228 @@
+"""
+S3 互換バックエンド (storage.S3Storage) を試すための、ローカルで動く最小限の S3 の代わりのサーバー。
+
+    python s3_standin.py ./s3data --port 9000
+    AWS_ENDPOINT_URL=http://127.0.0.1:9000 AWS_ACCESS_KEY_ID=standin AWS_SECRET_ACCESS_KEY=standin \\
+        python main.py s3://bucket/archive ./encrypted_archive "パスワード" copy
+
+パス形式の PUT / GET (Range) / HEAD / DELETE と ListObjectsV2 だけに対応し、オブジェクトは
+<データディレクトリ>/<バケット>/<キー> にファイルとして置く (バケットは最初の PUT で作られる)。
+リクエストの SigV4 署名と本文の SHA-256 は確かめるので、署名の誤りはここで見つかる。
+"""
+import argparse
+import datetime
+import hashlib
+import hmac
+import http.server
+import os
+import re
+import threading
+import urllib.parse
+from xml.sax.saxutils import escape
+
+from storage import canonical_query, signature
+
+DEFAULT_KEY = "standin"
+LIST_PAGE = 1000
+
+_AUTHORIZATION = re.compile(
+    r"AWS4-HMAC-SHA256 Credential=(?P<access_key>[^/]+)/(?P<date>\d{8})/(?P<region>[^/]+)/s3/aws4_request,\s*"
+    r"SignedHeaders=(?P<signed>[^,]+),\s*Signature=(?P<signature>[0-9a-f]{64})")
+
+
+class StandinServer(http.server.ThreadingHTTPServer):
+    daemon_threads = True
+
+    def __init__(self, address, root, access_key=DEFAULT_KEY, secret_key=DEFAULT_KEY, region="us-east-1"):
+        super().__init__(address, _Handler)
+        self.root = root
+        self.access_key = access_key
+        self.secret_key = secret_key
+        self.region = region
+
+    @property
+    def endpoint(self):
+        host, port = self.server_address[:2]
+        return f"http://{host}:{port}"
+
+
+class _Handler(http.server.BaseHTTPRequestHandler):
+    protocol_version = "HTTP/1.1"
+
+    def log_message(self, *args):
+        pass
+
+    def _reply(self, status, body=b"", headers=None, send_body=True):
+        """応答を返す。HEAD (send_body=False) では headers の Content-Length をそのまま返し、本文は送らない。"""
+        headers = dict(headers or {})
+        length = headers.pop("Content-Length", str(len(body)))
+        self.send_response(status)
+        for name, value in headers.items():
+            self.send_header(name, value)
+        self.send_header("Content-Length", length)
+        self.end_headers()
+        if send_body and body:
+            self.wfile.write(body)
+
+    def _error(self, status, code, message, send_body=True):
+        body = (f'<?xml version="1.0" encoding="UTF-8"?>\n<Error><Code>{code}</Code>'
+                f"<Message>{escape(message)}</Message></Error>").encode()
+        self._reply(status, body, {"Content-Type": "application/xml"}, send_body)
+
+    def _parse(self):
+        """(バケット, キー, クエリ, 本文) を返す。署名か本文のハッシュが合わなければエラーを返して None。"""
+        url = urllib.parse.urlsplit(self.path)
+        length = int(self.headers.get("Content-Length") or 0)
+        body = self.rfile.read(length) if length else b""
+        send_body = self.command != "HEAD"
+        match = _AUTHORIZATION.fullmatch(self.headers.get("Authorization", ""))
+        if match is None or match["access_key"] != self.server.access_key:
+            self._error(403, "AccessDenied", "認証情報がありません", send_body)
+            return None
+        payload_hash = self.headers.get("x-amz-content-sha256", "")
+        if payload_hash != hashlib.sha256(body).hexdigest():
+            self._error(400, "XAmzContentSHA256Mismatch", "本文の SHA-256 が一致しません", send_body)
+            return None
+        signed = match["signed"].split(";")
+        headers = {name: self.headers.get(name, "") for name in signed}
+        query = urllib.parse.parse_qsl(url.query, keep_blank_values=True)
+        expected = signature(self.command, url.path, canonical_query(query), headers, signed, payload_hash,
+                             self.server.secret_key, self.headers.get("x-amz-date", ""), match["region"])
+        if not hmac.compare_digest(expected, match["signature"]):
+            self._error(403, "SignatureDoesNotMatch", "署名が一致しません", send_body)
+            return None
+        bucket, _, key = urllib.parse.unquote(url.path).lstrip("/").partition("/")
+        if not bucket or ".." in key.split("/"):
+            self._error(400, "InvalidRequest", "バケットかキーが不正です", send_body)
+            return None
+        return bucket, key, dict(query), body
+
+    def _path(self, bucket, key):
+        return os.path.join(self.server.root, bucket, *key.split("/"))
+
+    def do_PUT(self):
+        parsed = self._parse()
+        if parsed is None:
+            return
+        bucket, key, _query, body = parsed
+        path = self._path(bucket, key)
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        tmp_path = f"{path}.{threading.get_ident()}.upload"
+        with open(tmp_path, "wb") as f:
+            f.write(body)
+        os.replace(tmp_path, path)
+        self._reply(200, headers={"ETag": f'"{hashlib.md5(body).hexdigest()}"'})
+
+    def do_HEAD(self):
+        self._get(send_body=False)
+
+    def do_GET(self):
+        self._get(send_body=True)
+
+    def _get(self, send_body):
+        parsed = self._parse()
+        if parsed is None:
+            return
+        bucket, key, query, _body = parsed
+        if not key:
+            if query.get("list-type") == "2":
+                self._list(bucket, query)
+            else:
+                self._error(400, "InvalidRequest", "ListObjectsV2 だけに対応しています")
+            return
+        path = self._path(bucket, key)
+        if not os.path.isfile(path):
+            self._error(404, "NoSuchKey", key, send_body)
+            return
+        size = os.path.getsize(path)
+        start, end = 0, size - 1
+        status = 200
+        byte_range = self.headers.get("Range")
+        if byte_range:
+            match = re.fullmatch(r"bytes=(\d+)-(\d*)", byte_range)
+            if match is None or int(match[1]) >= size:
+                self._error(416, "InvalidRange", byte_range, send_body)
+                return
+            start = int(match[1])
+            end = min(int(match[2]), size - 1) if match[2] else size - 1
+            status = 206
+        headers = {"Content-Type": "application/octet-stream", "Accept-Ranges": "bytes"}
+        if status == 206:
+            headers["Content-Range"] = f"bytes {start}-{end}/{size}"
+        if not send_body:
+            headers["Content-Length"] = str(size)
+            self._reply(200, headers=headers, send_body=False)
+            return
+        with open(path, "rb") as f:
+            f.seek(start)
+            body = f.read(end - start + 1)
+        self._reply(status, body, headers)
+
+    def _list(self, bucket, query):
+        prefix = query.get("prefix", "")
+        after = query.get("continuation-token", "")
+        base = os.path.join(self.server.root, bucket)
+        keys = []
+        for directory, _dirs, files in os.walk(base):
+            for name in files:
+                if name.endswith(".upload"):
+                    continue
+                key = os.path.relpath(os.path.join(directory, name), base).replace(os.sep, "/")
+                if key.startswith(prefix) and key > after:
+                    keys.append(key)
+        keys.sort()
+        page, truncated = keys[:LIST_PAGE], len(keys) > LIST_PAGE
+        items = []
+        for key in page:
+            st = os.stat(os.path.join(base, *key.split("/")))
+            modified = datetime.datetime.fromtimestamp(st.st_mtime, datetime.timezone.utc)
+            items.append(f"<Contents><Key>{escape(key)}</Key>"
+                         f"<LastModified>{modified.strftime('%Y-%m-%dT%H:%M:%S.%f')[:-3]}Z</LastModified>"
+                         f"<Size>{st.st_size}</Size></Contents>")
+        token = f"<NextContinuationToken>{escape(page[-1])}</NextContinuationToken>" if truncated else ""
+        body = ('<?xml version="1.0" encoding="UTF-8"?>\n'
+                '<ListBucketResult xmlns="http://s3.amazonaws.com/doc/2006-03-01/">'
+                f"<Name>{escape(bucket)}</Name><Prefix>{escape(prefix)}</Prefix><KeyCount>{len(page)}</KeyCount>"
+                f"<IsTruncated>{'true' if truncated else 'false'}</IsTruncated>{token}{''.join(items)}"
+                "</ListBucketResult>").encode()
+        self._reply(200, body, {"Content-Type": "application/xml"})
+
+    def do_DELETE(self):
+        parsed = self._parse()
+        if parsed is None:
+            return
+        bucket, key, _query, _body = parsed
+        try:
+            os.remove(self._path(bucket, key))
+        except FileNotFoundError:
+            pass
+        self._reply(204)
+
+
+def start_server(root, port=0, host="127.0.0.1", access_key=DEFAULT_KEY, secret_key=DEFAULT_KEY, region="us-east-1"):
+    """別スレッドでサーバーを起動して返す (port=0 なら空いているポート)。止めるときは shutdown() を呼ぶ。"""
+    server = StandinServer((host, port), root, access_key, secret_key, region)
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    return server
+
+
+def main():
+    parser = argparse.ArgumentParser(description="storage.S3Storage を試すためのローカルの S3 互換サーバー")
+    parser.add_argument("root", help="オブジェクトを置くディレクトリ")
+    parser.add_argument("--host", default="127.0.0.1")
+    parser.add_argument("--port", type=int, default=9000)
+    parser.add_argument("--access-key", default=DEFAULT_KEY)
+    parser.add_argument("--secret-key", default=DEFAULT_KEY)
+    parser.add_argument("--region", default="us-east-1")
+    args = parser.parse_args()
+    os.makedirs(args.root, exist_ok=True)
+    server = StandinServer((args.host, args.port), args.root, args.access_key, args.secret_key, args.region)
+    print(f"S3 互換サーバーを {server.endpoint} で起動しました (データ: {args.root})")
+    try:
+        server.serve_forever()
+    except KeyboardInterrupt:
+        pass
+
+
+if __name__ == "__main__":
+    main()
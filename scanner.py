@@ -0,0 +1,147 @@
+"""
+暗号化対象のファイルを列挙するスキャナー。
+
+os.scandir の DirEntry を使い、ディレクトリかファイルかの判定は readdir が返す種別 (d_type) で行う
+(追加のシステムコールは不要)。stat はファイル1つにつき1回だけで、その結果 (size, mtime_ns, inode) を
+ScanRecord として返すので、後段 (差分バックアップの判定・暗号化) でもう一度 stat しなくてよい。
+jobs > 1 の場合はサブディレクトリの走査をスレッドプールで並列に行う (NFSなど待ち時間の長い環境で効く)。
+"""
+import collections
+import concurrent.futures
+import os
+import stat
+
+
+class ScanRecord(collections.namedtuple("ScanRecord", ["path", "size", "mtime_ns", "inode"])):
+    """走査で見つけたファイル。os.stat_result と同じ名前の属性 (st_size 等) でも参照できる。"""
+    __slots__ = ()
+
+    @property
+    def st_size(self):
+        return self.size
+
+    @property
+    def st_mtime_ns(self):
+        return self.mtime_ns
+
+    @property
+    def st_ino(self):
+        return self.inode
+
+
+SYMLINKS_FOLLOW = "follow"
+SYMLINKS_SKIP = "skip"
+SYMLINK_MODES = (SYMLINKS_FOLLOW, SYMLINKS_SKIP)
+
+
+def record_for(path):
+    """パス1つ分の ScanRecord を os.stat から作る。"""
+    st = os.stat(path)
+    return ScanRecord(path, st.st_size, st.st_mtime_ns, st.st_ino)
+
+
+class _Rules:
+    """どのエントリを辿り、どのファイルを返すかの規則。"""
+    def __init__(self, symlinks, path_filter, skip_paths):
+        if symlinks not in SYMLINK_MODES:
+            raise ValueError(f"不明なシンボリックリンクの扱いです: {symlinks}")
+        self.follow = symlinks == SYMLINKS_FOLLOW
+        self.path_filter = path_filter
+        self.skip_paths = skip_paths
+
+    def excluded(self, path):
+        """除外パターンに一致するか (ディレクトリなら配下ごと辿らない)。"""
+        if path in self.skip_paths:
+            return True
+        return self.path_filter is not None and self.path_filter.excluded(path)
+
+    def selected(self, path):
+        return self.path_filter is None or self.path_filter.matches(path)
+
+
+def _scan_directory(directory, ancestors, rules):
+    """
+    ディレクトリ1つを走査し、(ScanRecord のリスト, [(サブディレクトリ, その祖先)], エラーのリスト) を返す。
+    シンボリックリンクを辿る場合は、祖先のディレクトリの (st_dev, st_ino) と同じディレクトリには入らない
+    (リンクによるループを避ける。stat はディレクトリ毎に1回だけ増える)。
+    """
+    records = []
+    subdirs = []
+    errors = []
+    try:
+        with os.scandir(directory) as entries:
+            for entry in entries:
+                try:
+                    if entry.is_symlink() and not rules.follow:
+                        continue
+                    if rules.excluded(entry.path):
+                        continue
+                    if entry.is_dir(follow_symlinks=True):
+                        if rules.follow:
+                            st = entry.stat(follow_symlinks=True)
+                            if (st.st_dev, st.st_ino) in ancestors:
+                                continue
+                            subdirs.append((entry.path, ancestors | {(st.st_dev, st.st_ino)}))
+                        else:
+                            subdirs.append((entry.path, ancestors))
+                    elif entry.is_file(follow_symlinks=True) and rules.selected(entry.path):
+                        st = entry.stat(follow_symlinks=True)
+                        records.append(ScanRecord(entry.path, st.st_size, st.st_mtime_ns, st.st_ino))
+                except OSError as e:
+                    # 壊れたシンボリックリンクや、走査中に消えたファイル
+                    errors.append((entry.path, e))
+    except OSError as e:
+        errors.append((directory, e))
+    return records, subdirs, errors
+
+
+def scan_tree(roots, jobs=1, symlinks=SYMLINKS_FOLLOW, path_filter=None, skip_paths=(), errors=None):
+    """
+    roots 以下の通常ファイルを ScanRecord として yield する。順序は決まっていない (必要なら呼び出し側で並べる)。
+
+    symlinks: "follow" ならリンク先のファイル・ディレクトリも対象にする (祖先へ戻るループは辿らない)。
+              "skip" ならシンボリックリンクは無視する。
+    path_filter (manifest.PathFilter): exclude に一致したファイル・ディレクトリ (配下ごと) を除き、
+              include を指定した場合は一致したファイルだけを返す。
+    skip_paths: 除外する絶対パスの集合 (出力先のマニフェスト等)。
+    errors: リストを渡すと、読めなかったディレクトリ・ファイルを (パス, 例外) として追加する。
+    """
+    rules = _Rules(symlinks, path_filter, {os.path.abspath(p) for p in skip_paths})
+    directories = []
+    for root in roots:
+        root = os.path.abspath(root)
+        if root in rules.skip_paths or (not rules.follow and os.path.islink(root)):
+            continue
+        try:
+            st = os.stat(root)
+        except OSError as e:
+            if errors is not None:
+                errors.append((root, e))
+            continue
+        if stat.S_ISDIR(st.st_mode):
+            directories.append((root, frozenset([(st.st_dev, st.st_ino)])))
+        elif rules.selected(root):
+            yield ScanRecord(root, st.st_size, st.st_mtime_ns, st.st_ino)
+
+    def collect(result):
+        records, subdirs, scan_errors = result
+        if errors is not None:
+            errors.extend(scan_errors)
+        return records, subdirs
+
+    if jobs <= 1:
+        while directories:
+            records, subdirs = collect(_scan_directory(*directories.pop(), rules))
+            directories.extend(subdirs)
+            yield from records
+        return
+
+    with concurrent.futures.ThreadPoolExecutor(max_workers=jobs) as pool:
+        pending = {pool.submit(_scan_directory, d, ancestors, rules) for d, ancestors in directories}
+        while pending:
+            done, pending = concurrent.futures.wait(pending, return_when=concurrent.futures.FIRST_COMPLETED)
+            for future in done:
+                records, subdirs = collect(future.result())
+                for subdir, ancestors in subdirs:
+                    pending.add(pool.submit(_scan_directory, subdir, ancestors, rules))
+                yield from records
@@ -0,0 +1,448 @@
+"""
+暗号化したオブジェクト (チャンク・パック・マニフェスト) の保存先。
+
+マニフェストはオブジェクトをアーカイブの中での相対的なキー ("ab/cd/<ハッシュ>.enc" や "pack-<ランダム>.pack")
+で記録するので、同じマニフェストのままアーカイブを別の場所・別の保存先へ移せる。
+    LocalStorage  ローカルのディレクトリ。チャンクはハッシュの先頭で ab/cd/ のサブディレクトリに振り分ける
+                  (1つのディレクトリに数百万のエントリがあると ext4 / XFS で検索・列挙が遅くなるため)
+    S3Storage     S3 互換のオブジェクトストレージ (標準ライブラリだけで SigV4 署名する)
+どちらも put / get / read_into / size / delete / list を持ち、submit でワーカーに並列に実行させられる
+(S3Storage はワーカー数だけ HTTP の接続を使い回す)。
+"""
+import collections
+import concurrent.futures
+import datetime
+import hashlib
+import hmac
+import http.client
+import os
+import queue
+import threading
+import time
+import urllib.parse
+import xml.etree.ElementTree as ElementTree
+
+# オブジェクト名の先頭から SHARD_WIDTH 文字ずつ SHARD_LEVELS 階層のディレクトリに振り分ける
+SHARD_LEVELS = 2
+SHARD_WIDTH = 2
+
+S3_SCHEME = "s3://"
+
+# 一覧の1件: キー, バイト数, 更新時刻 (ナノ秒)
+ObjectInfo = collections.namedtuple("ObjectInfo", ["key", "size", "mtime_ns"])
+
+_HEX = set("0123456789abcdef")
+
+
+def shard_key(name):
+    """オブジェクト名 (先頭が16進のハッシュ) を "ab/cd/<名前>" のキーにする。"""
+    parts = [name[i * SHARD_WIDTH:(i + 1) * SHARD_WIDTH] for i in range(SHARD_LEVELS)]
+    return "/".join(parts + [name])
+
+
+def object_key(name):
+    """
+    チャンク名 (出力ディレクトリの中のパス) をアーカイブの中でのキーにする。振り分け用のサブディレクトリに
+    あれば "ab/cd/<名前>"、そうでなければ (旧形式の、出力ディレクトリの直下のオブジェクトとパック) 名前だけ。
+    """
+    name = name.replace(os.sep, "/")
+    base = name.rsplit("/", 1)[-1]
+    key = shard_key(base)
+    if name == key or name.endswith("/" + key):
+        return key
+    return base
+
+
+def _is_shard(name):
+    return len(name) == SHARD_WIDTH and set(name) <= _HEX
+
+
+def is_remote(location):
+    return location.startswith(S3_SCHEME)
+
+
+def open_storage(location, jobs=1):
+    """location が s3://バケット/プレフィックス なら S3Storage、それ以外はディレクトリとして LocalStorage を返す。"""
+    if is_remote(location):
+        return S3Storage.from_url(location, jobs)
+    return LocalStorage(location, jobs)
+
+
+class _Storage:
+    """保存先に共通の部分。submit は jobs 個のワーカーのスレッドプールで関数を実行する。"""
+    def __init__(self, jobs=1):
+        self.jobs = max(jobs, 1)
+        self._pool = None
+        self._pool_lock = threading.Lock()
+
+    def submit(self, fn, *args):
+        with self._pool_lock:
+            if self._pool is None:
+                self._pool = concurrent.futures.ThreadPoolExecutor(max_workers=self.jobs)
+        return self._pool.submit(fn, *args)
+
+    def put_async(self, key, data):
+        return self.submit(self.put, key, data)
+
+    def get_async(self, key):
+        return self.submit(self.get, key)
+
+    def get(self, key):
+        """オブジェクト全体を bytes で返す。"""
+        return bytes(self.read_into(key, bytearray()))
+
+    def close(self):
+        if self._pool is not None:
+            self._pool.shutdown()
+            self._pool = None
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        self.close()
+        return False
+
+
+def _fsync_path(path, directory=False):
+    fd = os.open(path, os.O_RDONLY | (os.O_DIRECTORY if directory else 0))
+    try:
+        os.fsync(fd)
+    finally:
+        os.close(fd)
+
+
+class LocalStorage(_Storage):
+    """
+    ディレクトリ root にオブジェクトを置く。キーは root からの相対パス ("/" 区切り)。
+    put は一時ファイルに書いてからリネームし、sync でそれまでに書いたファイルと、それらのディレクトリ・
+    新しく作ったディレクトリの親をディレクトリ毎に1回ずつ fsync する (root は毎回 fsync する)。
+    """
+    def __init__(self, root, jobs=1):
+        super().__init__(jobs)
+        self.root = root
+        self._created = set()
+        self._unsynced = set()
+        self._dirty = set()
+        self._lock = threading.Lock()
+
+    def path(self, key):
+        """キーのファイルのパス。絶対パス (旧形式のチャンク名) はそのまま返す。"""
+        return os.path.join(self.root, key)
+
+    def location(self, key):
+        return self.path(key)
+
+    def key_of(self, name):
+        """マニフェストのチャンク名 (パス) を root からのキーにする。"""
+        return os.path.relpath(os.path.realpath(name), os.path.realpath(self.root)).replace(os.sep, "/")
+
+    def prepare(self, key):
+        """キーのファイルを置くディレクトリを (無ければ) 作り、ファイルのパスを返す。"""
+        path = self.path(key)
+        directory = os.path.dirname(path)
+        if directory not in self._created:
+            parent = directory
+            missing = []
+            while parent and not os.path.isdir(parent):
+                missing.append(parent)
+                parent = os.path.dirname(parent)
+            os.makedirs(directory, exist_ok=True)
+            with self._lock:
+                self._created.add(directory)
+                # 新しく作ったディレクトリのエントリが残るように、その親も次の sync で fsync する
+                self._dirty.update(os.path.dirname(d) or "." for d in missing)
+        return path
+
+    def note(self, path):
+        """path (この保存先に書いたファイル) を次の sync で fsync する。"""
+        with self._lock:
+            self._unsynced.add(path)
+
+    def put(self, key, data):
+        path = self.prepare(key)
+        tmp_path = path + ".tmp"
+        fd = os.open(tmp_path, os.O_WRONLY | os.O_CREAT | os.O_TRUNC, 0o644)
+        try:
+            view = memoryview(data)
+            while view:
+                n = os.write(fd, view)
+                view = view[n:]
+        finally:
+            os.close(fd)
+        os.replace(tmp_path, path)
+        self.note(path)
+
+    def read_into(self, key, buffer, offset=0, length=None):
+        """オブジェクトの [offset, offset+length) を buffer (bytearray) に読み込み、その memoryview を返す。"""
+        with open(self.path(key), "rb", buffering=0) as f:
+            size = os.fstat(f.fileno()).st_size - offset if length is None else length
+            if len(buffer) < size:
+                buffer.extend(bytes(size - len(buffer)))
+            view = memoryview(buffer)[:size]
+            read = 0
+            while read < size:
+                n = os.preadv(f.fileno(), [view[read:]], offset + read)
+                if not n:
+                    break
+                read += n
+        return view[:read]
+
+    def size(self, key):
+        """オブジェクトのバイト数 (無ければ None)。"""
+        try:
+            return os.stat(self.path(key)).st_size
+        except FileNotFoundError:
+            return None
+
+    def delete(self, key):
+        path = self.path(key)
+        os.remove(path)
+        with self._lock:
+            self._dirty.add(os.path.dirname(path) or ".")
+
+    def list(self):
+        """
+        root の直下と振り分け用のサブディレクトリ (ab/cd/) にあるファイルを ObjectInfo で返す
+        (書き込み中の .tmp も含む)。それ以外のサブディレクトリには入らない。
+        """
+        def walk(directory, prefix, depth):
+            with os.scandir(directory) as entries:
+                for item in entries:
+                    if item.is_dir(follow_symlinks=False):
+                        if depth < SHARD_LEVELS and _is_shard(item.name):
+                            yield from walk(item.path, prefix + item.name + "/", depth + 1)
+                    elif item.is_file(follow_symlinks=False):
+                        st = item.stat()
+                        yield ObjectInfo(prefix + item.name, st.st_size, st.st_mtime_ns)
+        if not os.path.isdir(self.root):
+            return iter(())
+        return walk(self.root, "", 0)
+
+    def sync(self):
+        """put / note したファイルと、変更のあったディレクトリを fsync する。"""
+        with self._lock:
+            files, self._unsynced = self._unsynced, set()
+            directories, self._dirty = self._dirty, set()
+        directories.add(self.root)
+        for path in sorted(files):
+            _fsync_path(path)
+            directories.add(os.path.dirname(path) or ".")
+        for directory in sorted(directories):
+            _fsync_path(directory, directory=True)
+
+
+# --- S3 ---
+
+_EMPTY_SHA256 = hashlib.sha256(b"").hexdigest()
+_S3_NS = "{http://s3.amazonaws.com/doc/2006-03-01/}"
+
+
+def _quote(text, safe="-_.~"):
+    return urllib.parse.quote(text, safe=safe)
+
+
+def canonical_query(pairs):
+    """SigV4 の正規化したクエリ文字列 ((名前, 値) の列から)。"""
+    return "&".join(f"{_quote(k)}={_quote(v)}" for k, v in sorted(pairs))
+
+
+def signing_key(secret_key, date, region, service="s3"):
+    key = hmac.new(("AWS4" + secret_key).encode(), date.encode(), hashlib.sha256).digest()
+    for part in (region, service, "aws4_request"):
+        key = hmac.new(key, part.encode(), hashlib.sha256).digest()
+    return key
+
+
+def signature(method, path, query, headers, signed_headers, payload_hash, secret_key, amz_date, region,
+              service="s3"):
+    """
+    SigV4 の署名 (16進) を求める。path は URL エンコード済みのパス、query は canonical_query の結果、
+    headers は小文字のヘッダー名から値への辞書で、signed_headers に挙げたものを署名に含める。
+    """
+    canonical_headers = "".join(f"{name}:{' '.join(headers[name].split())}\n" for name in signed_headers)
+    canonical_request = "\n".join([method, path, query, canonical_headers, ";".join(signed_headers), payload_hash])
+    scope = f"{amz_date[:8]}/{region}/{service}/aws4_request"
+    string_to_sign = "\n".join(["AWS4-HMAC-SHA256", amz_date, scope,
+                                hashlib.sha256(canonical_request.encode()).hexdigest()])
+    return hmac.new(signing_key(secret_key, amz_date[:8], region, service), string_to_sign.encode(),
+                    hashlib.sha256).hexdigest()
+
+
+class S3Error(OSError):
+    """S3 のリクエストが失敗した (status は HTTP のステータス)。"""
+    def __init__(self, message, status=None):
+        super().__init__(message)
+        self.status = status
+
+
+class S3Storage(_Storage):
+    """
+    S3 互換のオブジェクトストレージ。キーは prefix の下の相対的なキー。
+    パス形式 (endpoint/バケット/キー) でアクセスするので、MinIO などの互換サーバーや s3_standin.py でも使える。
+    接続はワーカー毎に使い回し、接続の失敗と 5xx は retries 回まで間をおいてやり直す。
+    """
+    def __init__(self, endpoint, bucket, prefix="", access_key="", secret_key="", region="us-east-1",
+                 session_token=None, jobs=1, timeout=60, retries=3):
+        super().__init__(jobs)
+        url = urllib.parse.urlsplit(endpoint)
+        if url.scheme not in ("http", "https") or not url.hostname:
+            raise ValueError(f"S3 のエンドポイントが不正です: {endpoint}")
+        self.endpoint = endpoint
+        self.secure = url.scheme == "https"
+        self.host = url.netloc
+        self.bucket = bucket
+        self.prefix = prefix.strip("/") + "/" if prefix.strip("/") else ""
+        self.access_key = access_key
+        self.secret_key = secret_key
+        self.region = region
+        self.session_token = session_token
+        self.timeout = timeout
+        self.retries = retries
+        self._connections = queue.LifoQueue()
+
+    @classmethod
+    def from_url(cls, url, jobs=1):
+        """
+        s3://バケット/プレフィックス から作る。エンドポイントと認証情報は環境変数
+        AWS_ENDPOINT_URL (省略時は https://s3.<リージョン>.amazonaws.com)、AWS_ACCESS_KEY_ID、AWS_SECRET_ACCESS_KEY、
+        AWS_SESSION_TOKEN、AWS_REGION (または AWS_DEFAULT_REGION、省略時は us-east-1) から読む。
+        """
+        bucket, _, prefix = url[len(S3_SCHEME):].partition("/")
+        if not bucket:
+            raise ValueError(f"バケットが指定されていません: {url}")
+        region = os.environ.get("AWS_REGION") or os.environ.get("AWS_DEFAULT_REGION") or "us-east-1"
+        endpoint = os.environ.get("AWS_ENDPOINT_URL") or f"https://s3.{region}.amazonaws.com"
+        access_key = os.environ.get("AWS_ACCESS_KEY_ID")
+        secret_key = os.environ.get("AWS_SECRET_ACCESS_KEY")
+        if not access_key or not secret_key:
+            raise ValueError("AWS_ACCESS_KEY_ID と AWS_SECRET_ACCESS_KEY を設定してください。")
+        return cls(endpoint, bucket, prefix, access_key, secret_key, region,
+                   os.environ.get("AWS_SESSION_TOKEN"), jobs)
+
+    def location(self, key):
+        return f"{S3_SCHEME}{self.bucket}/{self.prefix}{key}"
+
+    def key_of(self, name):
+        """マニフェストのチャンク名はこの保存先ではそのままキー。"""
+        return name
+
+    def _connect(self):
+        if self.secure:
+            return http.client.HTTPSConnection(self.host, timeout=self.timeout)
+        return http.client.HTTPConnection(self.host, timeout=self.timeout)
+
+    def _headers(self, method, path, query, body_hash, extra):
+        amz_date = time.strftime("%Y%m%dT%H%M%SZ", time.gmtime())
+        headers = {"host": self.host, "x-amz-date": amz_date, "x-amz-content-sha256": body_hash}
+        if self.session_token:
+            headers["x-amz-security-token"] = self.session_token
+        signed = sorted(headers)
+        sig = signature(method, path, query, headers, signed, body_hash, self.secret_key, amz_date, self.region)
+        headers["authorization"] = (f"AWS4-HMAC-SHA256 Credential={self.access_key}/{amz_date[:8]}/{self.region}"
+                                    f"/s3/aws4_request, SignedHeaders={';'.join(signed)}, Signature={sig}")
+        headers.update(extra or {})
+        return headers
+
+    def _request(self, method, key=None, query=(), body=b"", headers=None, into=None, ok=(200,)):
+        """
+        リクエストを送り (ステータス, レスポンスヘッダー, 本文) を返す。into (memoryview) を指定すると本文は
+        そこに読み込み、本文の代わりに読み込んだバイト数を返す。ok 以外のステータスは S3Error
+        (404 は FileNotFoundError) にする。
+        """
+        path = _quote(f"/{self.bucket}" + (f"/{self.prefix}{key}" if key is not None else ""), safe="/-_.~")
+        query_string = canonical_query(query)
+        body_hash = hashlib.sha256(body).hexdigest() if body else _EMPTY_SHA256
+        target = path + (f"?{query_string}" if query_string else "")
+        for attempt in range(self.retries + 1):
+            try:
+                connection = self._connections.get_nowait()
+            except queue.Empty:
+                connection = self._connect()
+            try:
+                connection.request(method, target, body=body or None,
+                                   headers=self._headers(method, path, query_string, body_hash, headers))
+                response = connection.getresponse()
+                if into is not None and response.status in ok:
+                    data = 0
+                    while data < len(into):
+                        n = response.readinto(into[data:])
+                        if not n:
+                            break
+                        data += n
+                    response.read() # 残りを読み捨てて接続を使い回せるようにする
+                else:
+                    data = response.read()
+            except (OSError, http.client.HTTPException) as e:
+                connection.close()
+                if attempt == self.retries:
+                    raise S3Error(f"S3 の {method} {self.location(key or '')} に失敗しました: {e}")
+                time.sleep(0.2 * 2 ** attempt)
+                continue
+            self._connections.put(connection)
+            if response.status >= 500 and attempt < self.retries:
+                time.sleep(0.2 * 2 ** attempt)
+                continue
+            if response.status in ok:
+                return response.status, response.headers, data
+            if response.status == 404:
+                raise FileNotFoundError(f"オブジェクトがありません: {self.location(key or '')}")
+            detail = data.decode("utf-8", "replace")[:200] if isinstance(data, bytes) else ""
+            raise S3Error(f"S3 の {method} {self.location(key or '')} が {response.status} {response.reason} "
+                          f"を返しました: {detail}", response.status)
+
+    def put(self, key, data):
+        self._request("PUT", key, body=bytes(data))
+
+    def read_into(self, key, buffer, offset=0, length=None):
+        if length is None:
+            size = self.size(key)
+            if size is None:
+                raise FileNotFoundError(f"オブジェクトがありません: {self.location(key)}")
+            length = size - offset
+        if len(buffer) < length:
+            buffer.extend(bytes(length - len(buffer)))
+        view = memoryview(buffer)[:length]
+        if not length:
+            return view
+        _status, _headers, read = self._request("GET", key, headers={"range": f"bytes={offset}-{offset + length - 1}"},
+                                                into=view, ok=(200, 206))
+        return view[:read]
+
+    def size(self, key):
+        try:
+            _status, headers, _data = self._request("HEAD", key)
+        except FileNotFoundError:
+            return None
+        return int(headers["Content-Length"])
+
+    def delete(self, key):
+        self._request("DELETE", key, ok=(200, 204))
+
+    def list(self):
+        """prefix の下の全オブジェクトを ObjectInfo で返す (ListObjectsV2 を続きのトークンで繰り返す)。"""
+        token = None
+        while True:
+            query = [("list-type", "2"), ("prefix", self.prefix)]
+            if token:
+                query.append(("continuation-token", token))
+            _status, _headers, data = self._request("GET", query=query)
+            root = ElementTree.fromstring(data)
+            for item in root.iter(f"{_S3_NS}Contents"):
+                key = item.findtext(f"{_S3_NS}Key")[len(self.prefix):]
+                modified = datetime.datetime.fromisoformat(item.findtext(f"{_S3_NS}LastModified").replace("Z", "+00:00"))
+                yield ObjectInfo(key, int(item.findtext(f"{_S3_NS}Size")), int(modified.timestamp() * 1e9))
+            if root.findtext(f"{_S3_NS}IsTruncated") != "true":
+                return
+            token = root.findtext(f"{_S3_NS}NextContinuationToken")
+
+    def sync(self):
+        """PUT は完了した時点で保存されているので何もしない。"""
+
+    def close(self):
+        super().close()
+        while True:
+            try:
+                self._connections.get_nowait().close()
+            except queue.Empty:
+                return
@@ -0,0 +1,71 @@
+"""
+verify --quick の回帰テスト。
+
+main.py を別プロセスで実行する (scrypt のパラメータだけ小さくして時間を短くする)。
+"""
+import os
+import random
+import shutil
+import subprocess
+import sys
+import tempfile
+import unittest
+
+REPO = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+
+_RUNNER = """
+import runpy, sys
+sys.path.insert(0, sys.argv[1])
+import AES256GCM
+AES256GCM.SCRYPT_N = 2**10; AES256GCM.SCRYPT_R = 8; AES256GCM.SCRYPT_P = 1
+script = sys.argv[1] + "/main.py"
+sys.argv = [script] + sys.argv[2:]
+runpy.run_path(script, run_name="__main__")
+"""
+
+CDC_ARGS = ["--chunking", "fastcdc", "--cdc-min", "64K", "--cdc-avg", "256K", "--cdc-max", "1M"]
+
+
+def run_main(*args):
+    result = subprocess.run([sys.executable, "-c", _RUNNER, REPO, *args], capture_output=True, text=True)
+    if result.returncode:
+        raise AssertionError(result.stdout + result.stderr)
+    return result.stdout
+
+
+def problem_count(output):
+    for line in output.splitlines():
+        if line.startswith("検証結果:"):
+            return int(line.rsplit("問題", 1)[1])
+    raise AssertionError(output)
+
+
+class QuickVerifyTest(unittest.TestCase):
+    def setUp(self):
+        self.work = tempfile.mkdtemp()
+        self.source = os.path.join(self.work, "src")
+        self.archive = os.path.join(self.work, "archive")
+        os.mkdir(self.source)
+        rnd = random.Random(1)
+        words = ["".join(rnd.choice("abcdefghij") for _ in range(rnd.randint(2, 9))) for _ in range(2000)]
+        with open(os.path.join(self.source, "z.txt"), "w") as f:
+            f.write(" ".join(rnd.choice(words) for _ in range(300000)))
+        with open(os.path.join(self.source, "r.bin"), "wb") as f:
+            f.write(rnd.randbytes(1024 * 1024))
+
+    def tearDown(self):
+        shutil.rmtree(self.work)
+
+    def test_incremental_dedup_of_compressed_chunks(self):
+        """差分バックアップで圧縮済みのチャンクを重複排除で参照しても、--quick が大きさの不一致を報告しない。"""
+        run_main(self.source, self.archive, "pw", "encrypt", *CDC_ARGS, "--compress", "zlib")
+        shutil.copy(os.path.join(self.source, "z.txt"), os.path.join(self.source, "a.txt"))
+        shutil.copy(os.path.join(self.source, "r.bin"), os.path.join(self.source, "b.bin"))
+        output = run_main(self.source, self.archive, "pw", "encrypt", *CDC_ARGS, "--compress", "zlib", "--incremental")
+        self.assertIn("個が新規", output)
+        self.assertEqual(problem_count(run_main("-", self.archive, "pw", "verify", "--quick")), 0)
+        self.assertEqual(problem_count(run_main("-", self.archive, "pw", "verify")), 0)
+
+
+if __name__ == "__main__":
+    unittest.main()
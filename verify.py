@@ -0,0 +1,350 @@
+"""
+アーカイブの検証 (verify モード)。
+
+平文をディスクに書かずに、マニフェストが参照する全てのチャンクを調べる。
+* quick: チャンクのファイル (パックの場合はパックファイルの該当範囲) があり、大きさが記録と合うかだけを見る。
+  データは読まないので、毎日のような頻度で実行できる。
+* full: 全チャンクを並列に復号し、GCMの認証タグ・AADのチャンク番号 (重複排除チャンクはコンテンツID)・
+  平文の長さを確かめる。平文はその場で捨てる。
+
+どちらのモードでも、エントリ毎にチャンク番号の欠け・重複と平文のオフセットの隙間・重なりを確かめ、
+出力ディレクトリ (保存先) にあってどのエントリからも参照されていない .enc / パックファイル (孤立したオブジェクト)
+を数える。存在・大きさと孤立の判定には、保存先のオブジェクトを最初に一度だけ一覧した結果を使う。
+1つのチャンクの失敗で止めずに全ての問題を集め、JSON のレポートにまとめる。
+"""
+import collections
+import json
+import os
+import threading
+import time
+import concurrent.futures
+
+from AES256GCM import *
+from budget import MemoryBudget, restore_cost, scrypt_bytes
+from engine import BLOCK_OVERHEAD, CHUNK_SIZE, expected_block_length
+from main import ChunkAADError, decrypt_chunk_file, is_positioned, open_archive, resolve_file_key
+from manifest import entry_key
+from storage import LocalStorage, is_remote
+
+# 問題の種類 (レポートの "kind")
+MISSING = "missing"            # チャンクのファイル・パックファイルが無い
+UNREADABLE = "unreadable"      # 読み込めない
+SIZE_MISMATCH = "size_mismatch"  # チャンクのファイル (パックの範囲) の大きさが記録と合わない
+AUTH_FAILED = "auth_failed"    # GCMの検証か展開に失敗した (改ざん・破損・鍵の誤り)
+AAD_MISMATCH = "aad_mismatch"  # 検証は通ったが別のチャンクだった (入れ替え)
+LENGTH_MISMATCH = "length_mismatch"  # 復号した平文の長さが記録と違う
+SEQUENCE = "sequence"          # チャンク番号の欠け・重複、オフセットの隙間・重なり、合計とファイルサイズの不一致
+KEY = "key"                    # ファイル鍵を求められない
+ERROR = "error"                # 検証中に上のどれにも当たらない例外が起きた (壊れたレコードなど)
+
+MODE_QUICK = "quick"
+MODE_FULL = "full"
+
+REPORT_VERSION = 1
+
+
+def check_sequence(entry):
+    """エントリのチャンクの並びを確かめ、問題の説明のリストを返す (問題が無ければ空)。"""
+    chunks = entry.get("chunks", [])
+    problems = []
+    ids = collections.Counter(chunk["chunk_id"] for chunk in chunks)
+    if sorted(ids) != list(range(len(chunks))):
+        missing = sorted(set(range(len(chunks))) - set(ids))
+        duplicated = sorted(i for i, count in ids.items() if count > 1)
+        problems.append(f"チャンク番号が 0..{len(chunks) - 1} の連番になっていません "
+                        f"(欠け: {missing[:10]}, 重複: {duplicated[:10]})")
+    if not is_positioned(chunks):
+        return problems # 旧形式のエントリには平文の位置が無い
+    expected = 0
+    for chunk in sorted(chunks, key=lambda c: c["offset"]):
+        if chunk["offset"] != expected:
+            kind = "隙間" if chunk["offset"] > expected else "重なり"
+            problems.append(f"チャンク {chunk['chunk_id']} のオフセット {chunk['offset']} の前に{kind}があります "
+                            f"(期待値 {expected})")
+        expected = max(expected, chunk["offset"] + chunk["size"])
+    file_size = entry.get("file_size")
+    if file_size is not None and expected != file_size:
+        problems.append(f"チャンクの合計 {expected} バイトがファイルサイズ {file_size} バイトと一致しません")
+    return problems
+
+
+class VerifyReport:
+    """
+    検証の結果を集める。ワーカースレッドから呼ばれるのでロックで保護し、進捗は interval 秒に一度だけ表示する。
+    metrics (metrics.Metrics) を指定すると進捗をそこに記録し、表示はそのシンクに任せる。
+    """
+    def __init__(self, encrypted_files_dir, mode, interval=2.0, metrics=None):
+        self.archive = encrypted_files_dir if is_remote(encrypted_files_dir) else os.path.abspath(encrypted_files_dir)
+        self.mode = mode
+        self.files = 0
+        self.chunks = 0
+        self.bytes = 0
+        self.problems = []
+        self.orphans = []
+        self.interval = interval
+        self.metrics = metrics
+        self.started_at = time.strftime("%Y-%m-%dT%H:%M:%S%z")
+        self.started = time.monotonic()
+        self.seconds = 0.0
+        self._last_report = self.started
+        self._lock = threading.Lock()
+
+    def problem(self, kind, path, detail, chunk=None):
+        item = {"kind": kind, "path": path, "detail": str(detail)}
+        if chunk is not None:
+            item["chunk_id"] = chunk.get("chunk_id")
+            item["chunk_name"] = chunk.get("chunk_name")
+            if "pack_offset" in chunk:
+                item["pack_offset"] = chunk["pack_offset"]
+        with self._lock:
+            self.problems.append(item)
+
+    def chunk_done(self, size):
+        with self._lock:
+            self.chunks += 1
+            self.bytes += size
+            now = time.monotonic()
+            if self.metrics is None and now - self._last_report >= self.interval:
+                self._last_report = now
+                print(f"検証中: {self.line()}")
+        if self.metrics is not None:
+            self.metrics.add("bytes_processed", size)
+
+    @property
+    def ok(self):
+        return not self.problems
+
+    def line(self):
+        elapsed = max(time.monotonic() - self.started, 1e-9)
+        return (f"{self.files} ファイル, {self.chunks} チャンク, {self.bytes / 2**20:.1f} MB, "
+                f"{self.bytes / 2**20 / elapsed:.1f} MB/s, 問題 {len(self.problems)}")
+
+    def as_dict(self):
+        return {
+            "version": REPORT_VERSION,
+            "archive": self.archive,
+            "mode": self.mode,
+            "started_at": self.started_at,
+            "seconds": round(self.seconds, 3),
+            "ok": self.ok,
+            "files": self.files,
+            "chunks": self.chunks,
+            "bytes": self.bytes,
+            "problems": self.problems,
+            "orphans": self.orphans,
+            "orphan_bytes": sum(orphan["size"] for orphan in self.orphans),
+        }
+
+    def write(self, report_path):
+        """レポートを JSON で書き出す (一時ファイルに書いてからリネームする)。"""
+        tmp_path = report_path + ".tmp"
+        with open(tmp_path, "w") as f:
+            json.dump(self.as_dict(), f, ensure_ascii=False, indent=2)
+            f.write("\n")
+        os.replace(tmp_path, report_path)
+
+
+def _object_location(store, chunk):
+    """チャンクの保存場所 (同じチャンクを共有するエントリで同じになる)。"""
+    return store.key_of(chunk["chunk_name"]), chunk.get("pack_offset")
+
+
+class _QuickChecker:
+    """オブジェクトの大きさだけを見る。sizes は保存先を一覧したキーからバイト数への辞書。"""
+    def __init__(self, store, sizes):
+        self.store = store
+        self.sizes = sizes
+
+    def check(self, entry, chunk, report):
+        path = entry_key(entry)
+        size = self.sizes.get(self.store.key_of(chunk["chunk_name"]))
+        if size is None:
+            report.problem(MISSING, path, "チャンクのファイルがありません", chunk)
+            return
+        expected = expected_block_length(entry, chunk)
+        if "pack_offset" in chunk:
+            end = chunk["pack_offset"] + chunk["pack_length"]
+            if size < end:
+                report.problem(SIZE_MISMATCH, path, f"パックファイル ({size} バイト) が範囲の終わり {end} より短いです", chunk)
+                return
+            block_length = chunk["pack_length"]
+        else:
+            block_length = size
+        if expected is not None and block_length != expected:
+            report.problem(SIZE_MISMATCH, path, f"ブロックが {block_length} バイトです (期待値 {expected})", chunk)
+            return
+        if block_length < BLOCK_OVERHEAD:
+            report.problem(SIZE_MISMATCH, path, f"ブロックが {block_length} バイトしかありません", chunk)
+            return
+        report.chunk_done(chunk.get("size", 0))
+
+
+def _verify_chunk(path, chunk, file_key, per_chunk_keys, report, storage=None):
+    """チャンクを1つ復号して検証し、平文は捨てる (ワーカー上で実行される)。"""
+    try:
+        plain = decrypt_chunk_file(chunk, file_key, per_chunk_keys, report.metrics, storage)
+        length = len(plain)
+        del plain
+    except FileNotFoundError:
+        report.problem(MISSING, path, "チャンクのファイルがありません", chunk)
+        return
+    except OSError as e:
+        report.problem(UNREADABLE, path, e, chunk)
+        return
+    except ChunkAADError as e:
+        report.problem(AAD_MISMATCH, path, e, chunk)
+        return
+    except ValueError as e:
+        report.problem(AUTH_FAILED, path, e, chunk)
+        return
+    if "size" in chunk and length != chunk["size"]:
+        report.problem(LENGTH_MISMATCH, path, f"平文が {length} バイトです (記録は {chunk['size']} バイト)", chunk)
+    report.chunk_done(length)
+
+
+def _verify_legacy_file(path, entry, master_key, chunks, report, storage=None):
+    """旧形式のファイルはscryptで鍵を導出してから、チャンクを順に検証する。"""
+    try:
+        file_key, per_chunk_keys = resolve_file_key(entry, master_key)
+    except (KeyError, ValueError) as e:
+        report.problem(KEY, path, f"ファイル鍵を導出できません: {e}")
+        return
+    for chunk in chunks:
+        _verify_chunk(path, chunk, file_key, per_chunk_keys, report, storage)
+
+
+def find_orphans(store, sizes, referenced):
+    """
+    保存先の .enc / パックファイル (sizes は一覧したキーからバイト数への辞書) のうち、
+    referenced (キーの集合) に無いものを返す。
+    """
+    orphans = []
+    for key, size in sizes.items():
+        if key == "masterkey.enc" or not (key.endswith(".enc") or key.endswith(".pack")):
+            continue
+        if key not in referenced:
+            orphans.append({"path": store.location(key), "size": size})
+    orphans.sort(key=lambda orphan: orphan["path"])
+    return orphans
+
+
+def verify_archive(manifest, master_key, encrypted_files_dir, mode=MODE_FULL, jobs=1, path_filter=None,
+                   budget=None, metrics=None, storage=None):
+    """
+    manifest (open_manifest の返り値) が参照するチャンクを検証し、VerifyReport を返す。
+    mode が "quick" なら存在と大きさだけ、"full" なら jobs 個のワーカーで全チャンクを復号して確かめる。
+    複数のエントリで共有されている重複排除チャンクは一度だけ検証する。
+    path_filter (PathFilter) を指定すると一致したファイルだけを検証する。孤立したオブジェクトの判定には
+    全てのエントリの参照が必要なので、マニフェストは全体を読む。
+    budget (budget.MemoryBudget) を指定すると、復号に使うメモリを予約してからジョブを投入する。
+    metrics (metrics.Metrics) を指定すると、進捗と読み込み・復号の時間を記録する。
+    storage (storage.S3Storage など) を指定すると、encrypted_files_dir の代わりにその保存先を検証する。
+    """
+    report = VerifyReport(encrypted_files_dir, mode, metrics=metrics)
+    if budget is None:
+        budget = MemoryBudget()
+    store = storage or LocalStorage(encrypted_files_dir)
+    sizes = {info.key: info.size for info in store.list() if not info.key.endswith(".tmp")}
+    quick = _QuickChecker(store, sizes) if mode == MODE_QUICK else None
+    referenced = set()
+    checked = set()
+    # 投入済みで未完了のジョブ数を制限する
+    slots = threading.BoundedSemaphore(max(jobs, 1) * 2)
+
+    def release(future, cost):
+        budget.release(cost)
+        slots.release()
+
+    def check_failed(future, path, chunk):
+        # ワーカーが想定外の例外で終わったチャンクも、検証済みにも問題なしにもせずに報告する
+        error = future.exception()
+        if error is not None:
+            report.problem(ERROR, path, f"検証中に予期しないエラーが発生しました: {error!r}", chunk)
+
+    def submit(cost, path, chunk, fn, *args):
+        slots.acquire()
+        budget.acquire(cost)
+        future = pool.submit(fn, *args)
+        future.add_done_callback(lambda f: release(f, cost))
+        future.add_done_callback(lambda f: check_failed(f, path, chunk))
+
+    with concurrent.futures.ThreadPoolExecutor(max_workers=max(jobs, 1)) as pool:
+        for entry in manifest:
+            if entry.get("deleted"):
+                continue
+            chunks = entry.get("chunks", [])
+            for chunk in chunks:
+                referenced.add(store.key_of(chunk["chunk_name"]))
+            path = entry_key(entry)
+            if path_filter is not None and not path_filter.matches(path):
+                continue
+            report.files += 1
+            if metrics is not None:
+                metrics.add("files")
+            for detail in check_sequence(entry):
+                report.problem(SEQUENCE, path, detail)
+
+            # 共有されているチャンクは最初に参照したエントリで一度だけ調べる
+            unchecked = []
+            for chunk in chunks:
+                location = _object_location(store, chunk)
+                if location not in checked:
+                    checked.add(location)
+                    unchecked.append(chunk)
+
+            if quick is not None:
+                for chunk in unchecked:
+                    quick.check(entry, chunk, report)
+                continue
+            if not unchecked:
+                continue
+            if entry.get("kdf") not in (KDF_HKDF, KDF_CONTENT):
+                # 旧形式のファイル毎のscryptもワーカー上で行う
+                largest = max(chunk.get("size", CHUNK_SIZE) for chunk in unchecked)
+                submit(max(restore_cost(largest), scrypt_bytes()), path, None,
+                       _verify_legacy_file, path, entry, master_key, unchecked, report, storage)
+                continue
+            try:
+                file_key, per_chunk_keys = resolve_file_key(entry, master_key)
+            except (KeyError, ValueError) as e:
+                report.problem(KEY, path, f"ファイル鍵を導出できません: {e}")
+                continue
+            for chunk in unchecked:
+                submit(restore_cost(chunk.get("size", 0)), path, chunk,
+                       _verify_chunk, path, chunk, file_key, per_chunk_keys, report, storage)
+
+    report.orphans = find_orphans(store, sizes, referenced)
+    report.seconds = time.monotonic() - report.started
+    return report
+
+
+def main_verify_process(master_password_input, encrypted_files_dir, report_path=None, mode=MODE_FULL, jobs=1,
+                        path_filter=None, budget=None, metrics=None, storage=None):
+    """
+    verify モードの本体。結果を表示し、report_path を指定すると JSON のレポートも書き出す。
+    VerifyReport を返す (アーカイブを開けなければ None)。
+    metrics (metrics.Metrics) を指定すると、鍵導出・読み込み・復号の時間と進捗を記録する。
+    storage (storage.S3Storage など) を指定すると、アーカイブをその保存先から読む。
+    """
+    archive = open_archive(master_password_input, encrypted_files_dir, budget, metrics, storage)
+    if archive is None:
+        return None
+    manifest, master_key = archive
+    with manifest:
+        print(f"チャンクを検証しています ({'存在と大きさのみ' if mode == MODE_QUICK else '全チャンクを復号'})...")
+        report = verify_archive(manifest, master_key, encrypted_files_dir, mode, jobs, path_filter, budget, metrics,
+                                storage)
+
+    print(f"検証結果: {report.line()}")
+    for problem in report.problems[:20]:
+        chunk = f" (チャンク {problem['chunk_id']})" if "chunk_id" in problem else ""
+        print(f"  [{problem['kind']}] {problem['path']}{chunk}: {problem['detail']}")
+    if len(report.problems) > 20:
+        print(f"  ...他 {len(report.problems) - 20} 件 (全件はレポートを参照してください)")
+    if report.orphans:
+        print(f"孤立したオブジェクト: {len(report.orphans)} 個, "
+              f"{sum(orphan['size'] for orphan in report.orphans) / 2**20:.1f} MB (どのエントリからも参照されていません)")
+    if report_path:
+        report.write(report_path)
+        print(f"レポートを {report_path} に保存しました。")
+    return report